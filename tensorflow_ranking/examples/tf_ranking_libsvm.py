@@ -113,17 +113,26 @@ def example_feature_columns():
   }
 
 
-def load_libsvm_data(path, list_size):
-  """Returns features and labels in numpy.array."""
+def load_libsvm_data(path, list_size, with_docid=False):
+  """Returns features and labels in numpy.array.
+
+  If `with_docid` is True, the features also contain "docid", an int64 array
+  with shape [num_queries, list_size, 1] parsed from "docid = ..." comments
+  (see `tfr.data.parse_docid`). Missing and padded entries are -1.
+  """
 
   def _parse_line(line):
     """Parses a single line in LibSVM format."""
-    tokens = line.split("#")[0].split()
+    data, _, comment = line.partition("#")
+    tokens = data.split()
     assert len(tokens) >= 2, "Ill-formatted line: {}".format(line)
     label = float(tokens[0])
     qid = tokens[1]
     kv_pairs = [kv.split(":") for kv in tokens[2:]]
     features = {k: float(v) for (k, v) in kv_pairs}
+    docid = tfr.data.parse_docid(comment)
+    if with_docid and docid is not None:
+      features["docid"] = docid
     return qid, features, label
 
   tf.compat.v1.logging.info("Loading data from {}".format(path))
@@ -136,6 +145,8 @@ def load_libsvm_data(path, list_size):
   # a shape of [num_queries, list_size]. We use list for each of them due to the
   # unknown number of quries.
   feature_map = {k: [] for k in example_feature_columns()}
+  if with_docid:
+    feature_map["docid"] = []
   label_list = []
   total_docs = 0
   discarded_docs = 0
@@ -147,7 +158,10 @@ def load_libsvm_data(path, list_size):
         qid_to_index[qid] = len(qid_to_index)
         qid_to_ndoc[qid] = 0
         for k in feature_map:
-          feature_map[k].append(np.zeros([list_size, 1], dtype=np.float32))
+          if k == "docid":
+            feature_map[k].append(np.full([list_size, 1], -1, dtype=np.int64))
+          else:
+            feature_map[k].append(np.zeros([list_size, 1], dtype=np.float32))
         label_list.append(np.ones([list_size], dtype=np.float32) * -1.)
       total_docs += 1
       batch_idx = qid_to_index[qid]
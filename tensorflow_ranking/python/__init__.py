@@ -20,6 +20,7 @@ from __future__ import print_function
 
 from tensorflow_ranking.python import data
 from tensorflow_ranking.python import feature
+from tensorflow_ranking.python import feature_stats
 from tensorflow_ranking.python import head
 from tensorflow_ranking.python import losses
 from tensorflow_ranking.python import metrics
@@ -29,7 +30,8 @@ from tensorflow_ranking.python import utils
 from tensorflow.python.util.all_util import remove_undocumented  # pylint: disable=g-bad-import-order
 
 _allowed_symbols = [
-    'data', 'feature', 'head', 'losses', 'metrics', 'model', 'utils'
+    'data', 'feature', 'feature_stats', 'head', 'losses', 'metrics', 'model',
+    'utils'
 ]
 
 remove_undocumented(__name__, _allowed_symbols)
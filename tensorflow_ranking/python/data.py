@@ -25,6 +25,9 @@ from __future__ import division
 from __future__ import print_function
 
 import functools
+import hashlib
+import multiprocessing
+import re
 import numpy as np
 import six
 
@@ -37,6 +40,19 @@ _LABEL_FEATURE = "label"
 # ignored in loss and metrics.
 _PADDING_LABEL = -1.
 
+# The document ID parsed from a "docid = ..." comment in LibSVM data.
+_DOCID_FEATURE = "docid"
+
+# Padding document IDs. Valid document IDs are non-negative.
+_PADDING_DOCID = -1
+
+_DOCID_PATTERN = re.compile(r"docid\s*=\s*(\S+)")
+# A document ID of ASCII digits only, which is kept as a number.
+_NUMERIC_DOCID_PATTERN = re.compile(r"^[0-9]+$")
+# Numeric document IDs below this bound are kept as they are. Other IDs are
+# hashed to 60 bits at or above it, so that the two ranges do not overlap.
+_HASHED_DOCID_OFFSET = 2**62
+
 
 def _get_scalar_default_value(dtype, default_value):
   """Gets the scalar compatible default value."""
@@ -185,6 +201,189 @@ def parse_from_sequence_example(serialized,
   return features
 
 
+def _read_records(file_pattern, reader, reader_args, shuffle, shuffle_seed,
+                  reader_num_threads, sloppy_ordering):
+  """Returns a `Dataset` of serialized records read from `file_pattern`."""
+  files = tf.data.Dataset.list_files(
+      file_pattern, shuffle=shuffle, seed=shuffle_seed)
+
+  reader_args = reader_args or []
+  dataset = files.apply(
+      tf.data.experimental.parallel_interleave(
+          lambda filename: reader(filename, *reader_args),
+          cycle_length=reader_num_threads,
+          sloppy=sloppy_ordering))
+
+  # Extract values if tensors are stored as key-value tuples. This happens when
+  # the reader is tf.data.SSTableDataset.
+  if dataset.output_types == (tf.string, tf.string):
+    dataset = dataset.map(lambda _, v: v)
+
+  return dataset
+
+
+def _sample_sequence_examples(dataset, sampling_fn):
+  """Samples serialized SequenceExamples with a `sampling_fn`.
+
+  Args:
+    dataset: A `Dataset` of serialized SequenceExamples.
+    sampling_fn: A function created by `make_query_importance_sampling_fn`.
+
+  Returns:
+    A `Dataset` of (serialized, extra_features) tuples for the kept
+    SequenceExamples, where `extra_features` are the features returned by
+    `sampling_fn`.
+  """
+  dataset = dataset.map(lambda serialized: (serialized,) + tuple(
+      sampling_fn(serialized)))
+  dataset = dataset.filter(lambda serialized, keep, extra_features: keep)
+  return dataset.map(
+      lambda serialized, keep, extra_features: (serialized, extra_features))
+
+
+def _batch_and_parse_sequence_examples(dataset,
+                                       batch_size,
+                                       list_size,
+                                       context_feature_spec,
+                                       example_feature_spec,
+                                       prefetch_buffer_size,
+                                       drop_remainder,
+                                       with_extra_features=False):
+  """Batches serialized SequenceExamples and parses them to features.
+
+  When `with_extra_features` is True, the elements of `dataset` are
+  (serialized, extra_features) tuples, e.g., from `_sample_sequence_examples`,
+  and the batched `extra_features` are merged into the parsed features.
+  """
+  # Apply batching. If drop_remainder is True, allows for static inference of
+  # batch size.
+  dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+
+  # Parse batched SequenceExample.
+  kwargs = {
+      "list_size": list_size,
+      "context_feature_spec": context_feature_spec,
+      "example_feature_spec": example_feature_spec,
+  }
+  if with_extra_features:
+
+    def _parse_fn(serialized, extra_features):
+      features = parse_from_sequence_example(serialized, **kwargs)
+      features.update(extra_features)
+      return features
+
+    dataset = dataset.map(_parse_fn)
+  else:
+    dataset = dataset.map(
+        functools.partial(parse_from_sequence_example, **kwargs))
+
+  # Prefetching allows for data fetching to happen on host while model runs
+  # on the accelerator. When run on CPU, makes data fecthing asynchronous.
+  dataset = dataset.prefetch(buffer_size=prefetch_buffer_size)
+
+  return dataset
+
+
+def make_query_importance_sampling_fn(weights_feature_name,
+                                      importance_feature_name=None,
+                                      query_feature_name=None,
+                                      importance_table=None,
+                                      default_importance=1.,
+                                      sampling_rate=1.,
+                                      min_probability=1e-3,
+                                      seed=None):
+  """Returns a function that samples SequenceExamples by query importance.
+
+  Each list is kept with probability
+
+    p = min(1, max(min_probability, sampling_rate * importance))
+
+  and a kept list is weighted by 1 / p in the `weights_feature_name` feature
+  with shape [1], i.e., a list-wise weight. Passing the same name as
+  `weights_feature_name` to `make_loss_fn` and `make_ranking_metric_fn` makes
+  the expected loss and metrics over the sampled lists equal to those over all
+  the lists, while training on a fraction of them.
+
+  The importance of a list is read either from the float context feature
+  `importance_feature_name`, or from `importance_table` keyed by the int64 or
+  string context feature `query_feature_name`. When `importance_table` is
+  used, the returned function must be created in the same graph as the
+  dataset, e.g., in the `input_fn`, and the table is initialized by
+  `tf.compat.v1.tables_initializer()`.
+
+  Args:
+    weights_feature_name: (str) The name of the output weights feature.
+    importance_feature_name: (str) The name of a float context feature holding
+      the importance of a list.
+    query_feature_name: (str) The name of a context feature holding the query
+      id used to look up `importance_table`.
+    importance_table: (dict) A mapping from query ids (int or str) to
+      importance.
+    default_importance: (float) The importance of a list with a missing
+      importance feature or a query id not in `importance_table`.
+    sampling_rate: (float) A factor applied to the importance to derive the
+      sampling probability.
+    min_probability: (float) The minimum sampling probability, which bounds the
+      weight of a sampled list by 1 / min_probability.
+    seed: (int) Randomization seed used for sampling.
+
+  Returns:
+    A function that takes a serialized SequenceExample and returns a tuple of
+    a boolean scalar `Tensor` for whether to keep it and a dict with the
+    weights feature. It can be passed as `sampling_fn` to
+    `read_batched_sequence_example_dataset`.
+
+  Raises:
+    ValueError: If not exactly one of `importance_feature_name` and
+      `importance_table` is specified, or if `importance_table` is specified
+      without `query_feature_name`.
+  """
+  if (importance_feature_name is None) == (importance_table is None):
+    raise ValueError("Exactly one of importance_feature_name and "
+                     "importance_table must be specified.")
+  if importance_table is not None and query_feature_name is None:
+    raise ValueError("query_feature_name must be specified with "
+                     "importance_table.")
+
+  if importance_table is not None:
+    keys = list(importance_table)
+    key_dtype = (
+        tf.string
+        if all(isinstance(k, (six.binary_type, six.text_type)) for k in keys)
+        else tf.int64)
+    table = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(
+            tf.constant(keys, dtype=key_dtype),
+            tf.constant([importance_table[k] for k in keys],
+                        dtype=tf.float32)),
+        default_value=float(default_importance))
+    context_feature_spec = {
+        query_feature_name: tf.io.FixedLenFeature([], key_dtype)
+    }
+  else:
+    context_feature_spec = {
+        importance_feature_name:
+            tf.io.FixedLenFeature([],
+                                  tf.float32,
+                                  default_value=float(default_importance))
+    }
+
+  def _sampling_fn(serialized):
+    """Samples a serialized SequenceExample by its importance."""
+    context, _ = tf.io.parse_single_sequence_example(
+        serialized, context_features=context_feature_spec)
+    if importance_table is not None:
+      importance = table.lookup(context[query_feature_name])
+    else:
+      importance = context[importance_feature_name]
+    probability = tf.clip_by_value(sampling_rate * importance,
+                                   min_probability, 1.)
+    keep = tf.less(tf.random.uniform([], seed=seed), probability)
+    return keep, {weights_feature_name: tf.reshape(1. / probability, [1])}
+
+  return _sampling_fn
+
+
 def read_batched_sequence_example_dataset(file_pattern,
                                           batch_size,
                                           list_size,
@@ -199,7 +398,8 @@ def read_batched_sequence_example_dataset(file_pattern,
                                           prefetch_buffer_size=32,
                                           reader_num_threads=10,
                                           sloppy_ordering=True,
-                                          drop_final_batch=False):
+                                          drop_final_batch=False,
+                                          sampling_fn=None):
   """Returns a `Dataset` of features from `SequenceExample`.
 
   Example:
@@ -322,6 +522,10 @@ def read_batched_sequence_example_dataset(file_pattern,
     drop_final_batch: (bool) If `True`, and the batch size does not evenly
       divide the input dataset size, the final smaller batch will be dropped.
       Defaults to `True`. If `True`, the batch_size can be statically inferred.
+    sampling_fn: A function that decides whether to keep a serialized
+      SequenceExample and returns extra features for it, e.g., created by
+      `make_query_importance_sampling_fn`. The extra features are added to the
+      parsed features. If None, all SequenceExamples are kept.
 
   Returns:
     A dataset of `dict` elements. Each `dict` maps feature keys to
@@ -330,49 +534,171 @@ def read_batched_sequence_example_dataset(file_pattern,
     are mapped to a rank-3 tensor of shape [batch_size, list_size,
     feature_size], where list_size is the number of examples.
   """
-  # TODO: Move the file reading part into a common function for all
-  # batch readers.
-  files = tf.data.Dataset.list_files(
-      file_pattern, shuffle=shuffle, seed=shuffle_seed)
-
-  reader_args = reader_args or []
-  dataset = files.apply(
-      tf.data.experimental.parallel_interleave(
-          lambda filename: reader(filename, *reader_args),
-          cycle_length=reader_num_threads,
-          sloppy=sloppy_ordering))
-
-  # Extract values if tensors are stored as key-value tuples. This happens when
-  # the reader is tf.data.SSTableDataset.
-  if dataset.output_types == (tf.string, tf.string):
-    dataset = dataset.map(lambda _, v: v)
+  dataset = _read_records(
+      file_pattern,
+      reader=reader,
+      reader_args=reader_args,
+      shuffle=shuffle,
+      shuffle_seed=shuffle_seed,
+      reader_num_threads=reader_num_threads,
+      sloppy_ordering=sloppy_ordering)
 
   # Repeat and shuffle, if needed.
   if num_epochs != 1:
     dataset = dataset.repeat(num_epochs)
+  if sampling_fn is not None:
+    dataset = _sample_sequence_examples(dataset, sampling_fn)
   if shuffle:
     dataset = dataset.shuffle(
         buffer_size=shuffle_buffer_size, seed=shuffle_seed)
 
-  # Apply batching. If drop_remainder is True, allows for static inference of
-  # batch size.
-  dataset = dataset.batch(
-      batch_size, drop_remainder=drop_final_batch or num_epochs is None)
+  return _batch_and_parse_sequence_examples(
+      dataset,
+      batch_size=batch_size,
+      list_size=list_size,
+      context_feature_spec=context_feature_spec,
+      example_feature_spec=example_feature_spec,
+      prefetch_buffer_size=prefetch_buffer_size,
+      drop_remainder=drop_final_batch or num_epochs is None,
+      with_extra_features=sampling_fn is not None)
+
+
+def read_mixed_batched_sequence_example_dataset(file_patterns,
+                                                batch_size,
+                                                list_size,
+                                                context_feature_spec,
+                                                example_feature_spec,
+                                                weights=None,
+                                                reader=tf.data.TFRecordDataset,
+                                                reader_args=None,
+                                                num_epochs=None,
+                                                shuffle=True,
+                                                shuffle_buffer_size=1000,
+                                                shuffle_seed=None,
+                                                prefetch_buffer_size=32,
+                                                reader_num_threads=10,
+                                                sloppy_ordering=True,
+                                                drop_final_batch=False,
+                                                sampling_fn=None):
+  """Returns a `Dataset` of features mixed from several `SequenceExample` sets.
+
+  Each entry of `file_patterns` is a source of SequenceExample protos with the
+  same context and example feature specs, e.g., human-rated lists and click
+  lists. Records are read from every source by its own interleaved readers and
+  sampled according to `weights` before the shared shuffling, batching and
+  parsing of `read_batched_sequence_example_dataset`. Since each source is read
+  independently, a slow source does not stall a fast one.
 
-  # Parse batched SequenceExample.
-  kwargs = {
-      "list_size": list_size,
-      "context_feature_spec": context_feature_spec,
-      "example_feature_spec": example_feature_spec,
-  }
-  dataset = dataset.map(
-      functools.partial(parse_from_sequence_example, **kwargs))
+  Args:
+    file_patterns: (list) A list of sources. Each source is a `str` or a list
+      of `str` with files or patterns of file paths containing
+      tf.SequenceExample protos. See `tf.gfile.Glob` for pattern rules.
+    batch_size: (int) Number of records to combine in a single batch.
+    list_size: (int) The number of frames to keep in a SequenceExample. If
+      specified, truncation or padding may happen. Otherwise, set it to None to
+      allow dynamic list size.
+    context_feature_spec: (dict) A mapping from  feature keys to
+      `FixedLenFeature` or `VarLenFeature` values.
+    example_feature_spec: (dict) A mapping feature keys to `FixedLenFeature` or
+      `VarLenFeature` values.
+    weights: (list) Sampling weights of the sources, with the same length as
+      `file_patterns`. The weights are normalized to sampling probabilities. If
+      None, the sources are sampled uniformly.
+    reader: A function or class that can be called with a `filenames` tensor and
+      (optional) `reader_args` and returns a `Dataset`. Defaults to
+      `tf.data.TFRecordDataset`.
+    reader_args: (list) Additional argument list to pass to the reader class.
+    num_epochs: (int) Number of times to read through each source. If None,
+      cycles through the sources forever. Defaults to `None`. When a finite
+      source is exhausted, the remaining sources are sampled with renormalized
+      weights.
+    shuffle: (bool) Indicates whether the input should be shuffled. Defaults to
+      `True`.
+    shuffle_buffer_size: (int) Buffer size of the ShuffleDataset. A large
+      capacity ensures better shuffling but would increase memory usage and
+      startup time.
+    shuffle_seed: (int) Randomization seed to use for shuffling and sampling.
+    prefetch_buffer_size: (int) Number of feature batches to prefetch in order
+      to improve performance. Recommended value is the number of batches
+      consumed per training step. Defaults to 32.
+    reader_num_threads: (int | list(int)) Number of threads used to read
+      records. If a list, it has the same length as `file_patterns` and sets
+      the number of threads per source. If greater than 1, the results will be
+      interleaved.
+    sloppy_ordering: (bool) If `True`, reading performance will be improved at
+      the cost of non-deterministic ordering. If `False`, the order of elements
+      produced is deterministic prior to shuffling (elements are still
+      randomized if `shuffle=True`. Note that if the seed is set, then order of
+      elements after shuffling is deterministic). Defaults to `True`.
+    drop_final_batch: (bool) If `True`, and the batch size does not evenly
+      divide the input dataset size, the final smaller batch will be dropped.
+      Defaults to `False`. The final batch is always dropped when `num_epochs`
+      is None. If `True`, the batch_size can be statically inferred.
+    sampling_fn: A function that decides whether to keep a serialized
+      SequenceExample and returns extra features for it, e.g., created by
+      `make_query_importance_sampling_fn`. The extra features are added to the
+      parsed features. If None, all SequenceExamples are kept.
 
-  # Prefetching allows for data fetching to happen on host while model runs
-  # on the accelerator. When run on CPU, makes data fecthing asynchronous.
-  dataset = dataset.prefetch(buffer_size=prefetch_buffer_size)
+  Returns:
+    A dataset of `dict` elements. See `read_batched_sequence_example_dataset`.
 
-  return dataset
+  Raises:
+    ValueError: If `file_patterns` is empty, if `weights` or
+      `reader_num_threads` do not match the number of sources, or if `weights`
+      has a negative weight or does not sum to a positive value.
+  """
+  if not file_patterns:
+    raise ValueError("file_patterns cannot be None or empty.")
+  num_sources = len(file_patterns)
+  if weights is not None and len(weights) != num_sources:
+    raise ValueError("file_patterns and weights must have the same size.")
+  if weights is not None and (any(w < 0 for w in weights) or
+                              sum(weights) <= 0):
+    raise ValueError(
+        "weights must be non-negative with a positive sum: {}".format(weights))
+  if isinstance(reader_num_threads, (list, tuple)):
+    if len(reader_num_threads) != num_sources:
+      raise ValueError(
+          "file_patterns and reader_num_threads must have the same size.")
+  else:
+    reader_num_threads = [reader_num_threads] * num_sources
+
+  datasets = []
+  for file_pattern, num_threads in zip(file_patterns, reader_num_threads):
+    dataset = _read_records(
+        file_pattern,
+        reader=reader,
+        reader_args=reader_args,
+        shuffle=shuffle,
+        shuffle_seed=shuffle_seed,
+        reader_num_threads=num_threads,
+        sloppy_ordering=sloppy_ordering)
+    # Repeat each source separately so that the mixing weights hold across
+    # epochs of sources with different sizes.
+    if num_epochs != 1:
+      dataset = dataset.repeat(num_epochs)
+    datasets.append(dataset)
+
+  if weights is not None:
+    weights = [float(w) / sum(weights) for w in weights]
+  dataset = tf.data.experimental.sample_from_datasets(
+      datasets, weights=weights, seed=shuffle_seed)
+
+  if sampling_fn is not None:
+    dataset = _sample_sequence_examples(dataset, sampling_fn)
+  if shuffle:
+    dataset = dataset.shuffle(
+        buffer_size=shuffle_buffer_size, seed=shuffle_seed)
+
+  return _batch_and_parse_sequence_examples(
+      dataset,
+      batch_size=batch_size,
+      list_size=list_size,
+      context_feature_spec=context_feature_spec,
+      example_feature_spec=example_feature_spec,
+      prefetch_buffer_size=prefetch_buffer_size,
+      drop_remainder=drop_final_batch or num_epochs is None,
+      with_extra_features=sampling_fn is not None)
 
 
 def build_sequence_example_serving_input_receiver_fn(input_size,
@@ -419,28 +745,277 @@ def build_sequence_example_serving_input_receiver_fn(input_size,
   return serving_input_receiver_fn
 
 
+def _feature_values(feature, dtype):
+  """Returns the repeated value field of `feature` that stores `dtype`."""
+  if dtype.kind == "f":
+    return feature.float_list.value
+  elif dtype.kind in ("i", "u", "b"):
+    return feature.int64_list.value
+  else:
+    return feature.bytes_list.value
+
+
+def _to_list(values):
+  """Converts a numpy array to a (nested) list of values for protos."""
+  if values.dtype.kind == "b":
+    values = values.astype(np.int64)
+  elif values.dtype.kind not in ("f", "i", "u"):
+    return np.vectorize(tf.compat.as_bytes, otypes=[object])(values).tolist()
+  return values.tolist()
+
+
+def _arrays_to_sequence_example(context_values, example_values, size):
+  """Builds a `tf.train.SequenceExample` from arrays of a single list.
+
+  Args:
+    context_values: (dict) A mapping from context feature keys to arrays of
+      shape [feature_size].
+    example_values: (dict) A mapping from example feature keys to arrays of
+      shape [list_size, feature_size].
+    size: (int) The number of leading frames to keep.
+
+  Returns:
+    A `tf.train.SequenceExample`.
+  """
+  sequence_example = tf.train.SequenceExample()
+  for k, v in six.iteritems(context_values):
+    _feature_values(sequence_example.context.feature[k],
+                    v.dtype).extend(_to_list(v))
+  for k, v in six.iteritems(example_values):
+    frames = sequence_example.feature_lists.feature_list[k].feature
+    # Converts all the kept frames at once, which is much faster than
+    # converting the values one by one.
+    for frame in _to_list(v[:size]):
+      _feature_values(frames.add(), v.dtype).extend(frame)
+  return sequence_example
+
+
+def _write_sequence_example_shard(args):
+  """Serializes a shard of lists to a TFRecord file.
+
+  Args:
+    args: A tuple of (path, context_features, example_features, list_sizes) for
+      a single shard. See `write_sequence_example_tfrecords`.
+
+  Returns:
+    The number of written records.
+  """
+  path, context_features, example_features, list_sizes = args
+  with tf.io.TFRecordWriter(path) as writer:
+    for i, size in enumerate(list_sizes):
+      sequence_example = _arrays_to_sequence_example(
+          {k: v[i] for k, v in six.iteritems(context_features)},
+          {k: v[i] for k, v in six.iteritems(example_features)}, size)
+      writer.write(sequence_example.SerializeToString())
+  return len(list_sizes)
+
+
+def write_sequence_example_tfrecords(path,
+                                     context_features,
+                                     example_features,
+                                     list_sizes=None,
+                                     num_shards=1,
+                                     num_processes=1):
+  """Writes dense arrays of lists to sharded TFRecords of `SequenceExample`.
+
+  This is the inverse of `parse_from_sequence_example`. Each list becomes one
+  SequenceExample whose context features come from `context_features` and whose
+  `feature_lists` come from `example_features`. Frames beyond the size of a list
+  are padding and are not written, so they are restored with the
+  `default_value` of the example feature spec (e.g., -1 for labels) when
+  parsed.
+
+  Float arrays are written as `float_list`, integer and boolean arrays as
+  `int64_list`, and string arrays as `bytes_list`.
+
+  Per-list values that only depend on the labels, such as the ideal DCG from
+  `compute_ideal_dcg`, can be written as context features so that they are not
+  recomputed at every training step.
+
+  Args:
+    path: (str) The output path. When `num_shards` > 1, the shards are written
+      to files named "<path>-<shard>-of-<num_shards>".
+    context_features: (dict) A mapping from context feature keys to arrays of
+      shape [num_lists] or [num_lists, feature_size].
+    example_features: (dict) A mapping from example feature keys to arrays of
+      shape [num_lists, list_size] or [num_lists, list_size, feature_size].
+    list_sizes: (list) The number of valid frames for each list, with shape
+      [num_lists]. If None, all the frames are written.
+    num_shards: (int) The number of output files.
+    num_processes: (int) The number of processes used to serialize the shards.
+      If 1, the shards are written in the current process.
+
+  Returns:
+    A list of the written file paths.
+
+  Raises:
+    ValueError: If no example feature is given or if the features and
+      `list_sizes` disagree on the number of lists.
+  """
+  if not example_features:
+    raise ValueError("example_features cannot be None or empty.")
+  context_features = context_features or {}
+
+  def _reshape(features, ndims):
+    """Reshapes each array to `ndims` dims by adding a feature dim."""
+    reshaped = {}
+    for k, v in six.iteritems(features):
+      v = np.asarray(v)
+      reshaped[k] = v.reshape(v.shape + (1,)) if v.ndim == ndims - 1 else v
+    return reshaped
+
+  context_features = _reshape(context_features, 2)
+  example_features = _reshape(example_features, 3)
+  num_lists, list_size = next(six.itervalues(example_features)).shape[:2]
+  if list_sizes is None:
+    list_sizes = np.full([num_lists], list_size)
+  list_sizes = np.asarray(list_sizes, dtype=np.int64)
+  for k, v in list(six.iteritems(context_features)) + list(
+      six.iteritems(example_features)):
+    if v.shape[0] != num_lists:
+      raise ValueError("Feature {} has {} lists, but expected {}.".format(
+          k, v.shape[0], num_lists))
+  if list_sizes.shape != (num_lists,):
+    raise ValueError("list_sizes must have shape [{}], but found {}.".format(
+        num_lists, list_sizes.shape))
+
+  if num_shards == 1:
+    paths = [path]
+  else:
+    paths = [
+        "{}-{:05d}-of-{:05d}".format(path, i, num_shards)
+        for i in range(num_shards)
+    ]
+  shards = []
+  for shard_path, indices in zip(
+      paths, np.array_split(np.arange(num_lists), num_shards)):
+    shards.append((shard_path,
+                   {k: v[indices] for k, v in six.iteritems(context_features)},
+                   {k: v[indices] for k, v in six.iteritems(example_features)},
+                   list_sizes[indices]))
+
+  if num_processes > 1:
+    pool = multiprocessing.Pool(processes=num_processes)
+    try:
+      pool.map(_write_sequence_example_shard, shards)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for shard in shards:
+      _write_sequence_example_shard(shard)
+  return paths
+
+
+def compute_ideal_dcg(labels,
+                      list_sizes=None,
+                      topn=None,
+                      gain_fn=lambda labels: np.power(2., labels) - 1.,
+                      rank_discount_fn=lambda rank: 1. / np.log1p(rank)):
+  """Computes the ideal DCG of lists of labels with NumPy.
+
+  This is the max DCG of `utils.inverse_max_dcg` and of the NDCG metric,
+  computed once when the data is written, e.g., as a context feature for
+  `write_sequence_example_tfrecords`. The losses and metrics then use it
+  through their `ideal_dcg_feature_name` instead of sorting the labels at each
+  step. It must be computed with the same gain, discount and cutoff as the
+  losses and metrics that use it; the defaults match the NDCG metric, the
+  ApproxNDCG loss and `losses.create_ndcg_lambda_weight`.
+
+  Args:
+    labels: (np.ndarray) The labels with shape [num_lists, list_size]. Negative
+      labels are invalid and ignored.
+    list_sizes: (list) The number of valid items of each list, with shape
+      [num_lists]. The items beyond are ignored. If None, all items are used.
+    topn: (int) The cutoff of the DCG. If None, all items are used.
+    gain_fn: (function) The gain function of NumPy arrays.
+    rank_discount_fn: (function) The discount function of NumPy arrays of
+      1-based ranks.
+
+  Returns:
+    A float32 np.ndarray with shape [num_lists].
+  """
+  labels = np.array(labels, dtype=np.float64)
+  if list_sizes is not None:
+    positions = np.arange(labels.shape[1])
+    labels[positions >= np.expand_dims(list_sizes, 1)] = _PADDING_LABEL
+  labels[labels < 0.] = 0.
+  sorted_labels = -np.sort(-labels, axis=1)[:, :topn]
+  ranks = np.arange(1, sorted_labels.shape[1] + 1, dtype=np.float64)
+  return np.sum(
+      gain_fn(sorted_labels) * rank_discount_fn(ranks),
+      axis=1).astype(np.float32)
+
+
+def docid_to_int64(docid):
+  """Converts a document ID string to a compact non-negative int64.
+
+  Numeric document IDs of ASCII digits below 2^62 are kept as they are. Other
+  IDs are hashed with a stable (process independent) fingerprint to values in
+  [2^62, 2^62 + 2^60), so the same ID maps to the same value when the data is
+  written and when predictions are joined back to documents, and a hashed ID
+  never takes the value of a numeric ID.
+
+  Args:
+    docid: (string) The document ID.
+
+  Returns:
+    A non-negative integer that fits in an int64.
+  """
+  if (_NUMERIC_DOCID_PATTERN.match(docid) and
+      int(docid) < _HASHED_DOCID_OFFSET):
+    return int(docid)
+  if isinstance(docid, six.text_type):
+    docid = docid.encode("utf-8")
+  return _HASHED_DOCID_OFFSET + int(hashlib.md5(docid).hexdigest()[:15], 16)
+
+
+def parse_docid(comment):
+  """Parses the document ID from the comment of a LibSVM line.
+
+  Args:
+    comment: (string) The comment of a LibSVM line, i.e., the text after "#".
+
+  Returns:
+    The document ID of a "docid = <id>" entry converted by `docid_to_int64`, or
+    None if the comment has no such entry.
+  """
+  match = _DOCID_PATTERN.search(comment)
+  if match:
+    return docid_to_int64(match.group(1))
+  return None
+
+
 def _libsvm_parse_line(libsvm_line):
   """Parses a single LibSVM line to a query ID and a feature dictionary.
 
+  Everything after "#" is treated as a comment. A "docid = <id>" entry in the
+  comment is kept as the "docid" feature, see `parse_docid`.
+
   Args:
     libsvm_line: (string) input line in LibSVM format.
 
   Returns:
     A tuple of query ID and a dict mapping from feature ID (string) to value
     (float). "label" is a special feature ID that represents the relevance
-    grade.
+    grade and "docid" is a special feature ID for the document ID (int).
   """
-  tokens = libsvm_line.split()
+  data, _, comment = libsvm_line.partition("#")
+  tokens = data.split()
   qid = int(tokens[1].split(":")[1])
 
   features = {_LABEL_FEATURE: float(tokens[0])}
   key_values = [key_value.split(":") for key_value in tokens[2:]]
   features.update({key: float(value) for (key, value) in key_values})
 
+  docid = parse_docid(comment)
+  if docid is not None:
+    features[_DOCID_FEATURE] = docid
+
   return qid, features
 
 
-def _libsvm_generate(num_features, list_size, doc_list):
+def _libsvm_generate(num_features, list_size, doc_list, with_docid=False):
   """Unpacks a list of document features into `Tensor`s.
 
   Args:
@@ -448,6 +1023,9 @@ def _libsvm_generate(num_features, list_size, doc_list):
     list_size: Size of the document list per query.
     doc_list: A list of dictionaries (one per document) where each dictionary is
       a mapping from feature ID (string) to feature value (float).
+    with_docid: If True, the features contain "docid", an int64 array of shape
+      [list_size, 1] with the document IDs. Documents without an ID and padded
+      entries get -1.
 
   Returns:
     A tuple consisting of a dictionary (feature ID to `Tensor`s) and a label
@@ -457,6 +1035,10 @@ def _libsvm_generate(num_features, list_size, doc_list):
   features = {}
   for fid in range(num_features):
     features[str(fid + 1)] = np.zeros([list_size, 1], dtype=np.float32)
+  if with_docid:
+    features[_DOCID_FEATURE] = np.full([list_size, 1],
+                                       _PADDING_DOCID,
+                                       dtype=np.int64)
   labels = np.ones([list_size], dtype=np.float32) * (_PADDING_LABEL)
 
   # Shuffle the document list and trim to a prescribed list_size.
@@ -470,13 +1052,20 @@ def _libsvm_generate(num_features, list_size, doc_list):
     for feature_id, value in six.iteritems(doc):
       if feature_id == _LABEL_FEATURE:
         labels[idx] = value
+      elif feature_id == _DOCID_FEATURE:
+        if with_docid:
+          features[_DOCID_FEATURE][idx, 0] = value
       else:
         features.get(feature_id)[idx, 0] = value
 
   return features, labels
 
 
-def libsvm_generator(path, num_features, list_size, seed=None):
+def libsvm_generator(path,
+                     num_features,
+                     list_size,
+                     seed=None,
+                     with_docid=False):
   """Parses a LibSVM-formatted input file and aggregates data points by qid.
 
   Args:
@@ -484,6 +1073,9 @@ def libsvm_generator(path, num_features, list_size, seed=None):
     num_features: An integer representing the number of features per instance.
     list_size: Size of the document list per query.
     seed: Randomization seed used when shuffling the document list.
+    with_docid: If True, the generated features contain an int64 "docid"
+      feature with shape [list_size, 1] parsed from "docid = ..." comments. It
+      can be passed through to predictions, see `create_ranking_head`.
 
   Returns:
     A generator function that can be passed to tf.data.Dataset.from_generator().
@@ -523,12 +1115,12 @@ def libsvm_generator(path, num_features, list_size, seed=None):
           doc_list.append(doc)
           continue
 
-        yield _libsvm_generate(num_features, list_size, doc_list)
+        yield _libsvm_generate(num_features, list_size, doc_list, with_docid)
 
         # Reset current pointer and re-initialize document list.
         cur = qid
         doc_list = [doc]
 
-    yield _libsvm_generate(num_features, list_size, doc_list)
+    yield _libsvm_generate(num_features, list_size, doc_list, with_docid)
 
   return inner_generator
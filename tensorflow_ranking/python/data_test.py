@@ -26,6 +26,7 @@ import tensorflow as tf
 
 from google.protobuf import text_format
 from tensorflow_ranking.python import data as data_lib
+from tensorflow_ranking.python import utils
 
 SEQ_EXAMPLE_PROTO_1 = text_format.Parse(
     """
@@ -280,6 +281,96 @@ class SequenceExampleTest(tf.test.TestCase, parameterized.TestCase):
       self.assertAllEqual(feature_map["utility"],
                           [[[0.], [1.0]], [[0.], [-1.]]])
 
+  def _write_tfrecord(self, file_name, serialized_records):
+    data_file = os.path.join(tf.compat.v1.test.get_temp_dir(), file_name)
+    if tf.io.gfile.exists(data_file):
+      tf.io.gfile.remove(data_file)
+    with tf.io.TFRecordWriter(data_file) as writer:
+      for s in serialized_records:
+        writer.write(s)
+    return data_file
+
+  def test_read_mixed_batched_sequence_example_dataset(self):
+    rated_file = self._write_tfrecord(
+        "test_rated.tfrecord", [SEQ_EXAMPLE_PROTO_1.SerializeToString()] * 10)
+    click_file = self._write_tfrecord(
+        "test_click.tfrecord", [SEQ_EXAMPLE_PROTO_2.SerializeToString()] * 10)
+
+    batched_dataset = data_lib.read_mixed_batched_sequence_example_dataset(
+        file_patterns=[rated_file, click_file],
+        batch_size=100,
+        list_size=2,
+        context_feature_spec=CONTEXT_FEATURE_SPEC,
+        example_feature_spec=EXAMPLE_FEATURE_SPEC,
+        weights=[3., 1.],
+        shuffle_seed=1,
+        reader_num_threads=[4, 1])
+
+    features = tf.compat.v1.data.make_one_shot_iterator(
+        batched_dataset).get_next()
+    self.assertAllEqual(
+        sorted(features), ["query_length", "unigrams", "utility"])
+    # Check static shapes for dense tensors.
+    self.assertAllEqual([100, 1],
+                        features["query_length"].get_shape().as_list())
+    self.assertAllEqual([100, 2, 1], features["utility"].get_shape().as_list())
+
+    with tf.compat.v1.Session() as sess:
+      query_length = np.concatenate(
+          [sess.run(features["query_length"]) for _ in range(10)])
+      # PROTO_1 has query_length 3 and PROTO_2 has query_length 2.
+      self.assertAllInSet(query_length, [2, 3])
+      self.assertNear(np.mean(query_length == 3), 0.75, 0.05)
+
+  def test_read_mixed_batched_sequence_example_dataset_single_source(self):
+    rated_file = self._write_tfrecord(
+        "test_rated.tfrecord", [SEQ_EXAMPLE_PROTO_1.SerializeToString()] * 10)
+    click_file = self._write_tfrecord(
+        "test_click.tfrecord", [SEQ_EXAMPLE_PROTO_2.SerializeToString()] * 10)
+
+    batched_dataset = data_lib.read_mixed_batched_sequence_example_dataset(
+        file_patterns=[rated_file, click_file],
+        batch_size=4,
+        list_size=2,
+        context_feature_spec=CONTEXT_FEATURE_SPEC,
+        example_feature_spec=EXAMPLE_FEATURE_SPEC,
+        weights=[0., 1.],
+        num_epochs=1,
+        shuffle=False)
+
+    features = tf.compat.v1.data.make_one_shot_iterator(
+        batched_dataset).get_next()
+    with tf.compat.v1.Session() as sess:
+      feature_map = sess.run(features)
+      self.assertAllEqual(feature_map["query_length"], [[2]] * 4)
+      self.assertAllEqual(feature_map["utility"], [[[0.], [-1.]]] * 4)
+
+  def test_read_mixed_batched_sequence_example_dataset_invalid_args(self):
+    kwargs = {
+        "batch_size": 2,
+        "list_size": 2,
+        "context_feature_spec": CONTEXT_FEATURE_SPEC,
+        "example_feature_spec": EXAMPLE_FEATURE_SPEC,
+    }
+    with self.assertRaisesRegexp(ValueError, r"cannot be None or empty"):
+      data_lib.read_mixed_batched_sequence_example_dataset([], **kwargs)
+    with self.assertRaisesRegexp(ValueError, r"weights must have the same"):
+      data_lib.read_mixed_batched_sequence_example_dataset(["a", "b"],
+                                                           weights=[1.],
+                                                           **kwargs)
+    with self.assertRaisesRegexp(ValueError, r"weights must be non-negative"):
+      data_lib.read_mixed_batched_sequence_example_dataset(["a", "b"],
+                                                           weights=[0., 0.],
+                                                           **kwargs)
+    with self.assertRaisesRegexp(ValueError, r"weights must be non-negative"):
+      data_lib.read_mixed_batched_sequence_example_dataset(["a", "b"],
+                                                           weights=[2., -1.],
+                                                           **kwargs)
+    with self.assertRaisesRegexp(ValueError,
+                                 r"reader_num_threads must have the same"):
+      data_lib.read_mixed_batched_sequence_example_dataset(
+          ["a", "b"], reader_num_threads=[1, 2, 3], **kwargs)
+
   def test_sequence_example_serving_input_receiver_fn(self):
     serving_input_receiver_fn = (
         data_lib.build_sequence_example_serving_input_receiver_fn(
@@ -317,6 +408,171 @@ class SequenceExampleTest(tf.test.TestCase, parameterized.TestCase):
                           [[[0.], [1.0]], [[0.], [-1.]]])
 
 
+class QueryImportanceSamplingTest(tf.test.TestCase):
+
+  def _write_data_file(self):
+    head_query = tf.train.SequenceExample()
+    head_query.CopyFrom(SEQ_EXAMPLE_PROTO_1)
+    head_query.context.feature["importance"].float_list.value.append(0.25)
+    tail_query = tf.train.SequenceExample()
+    tail_query.CopyFrom(SEQ_EXAMPLE_PROTO_2)
+    tail_query.context.feature["importance"].float_list.value.append(1.)
+    data_file = os.path.join(tf.compat.v1.test.get_temp_dir(),
+                             "test_importance_sampling.tfrecord")
+    with tf.io.TFRecordWriter(data_file) as writer:
+      for _ in range(1000):
+        writer.write(head_query.SerializeToString())
+        writer.write(tail_query.SerializeToString())
+    return data_file
+
+  def _read_weights(self, sampling_fn):
+    batched_dataset = data_lib.read_batched_sequence_example_dataset(
+        file_pattern=self._write_data_file(),
+        batch_size=100,
+        list_size=2,
+        context_feature_spec=CONTEXT_FEATURE_SPEC,
+        example_feature_spec=EXAMPLE_FEATURE_SPEC,
+        num_epochs=1,
+        shuffle=False,
+        sampling_fn=sampling_fn)
+    iterator = tf.compat.v1.data.make_initializable_iterator(batched_dataset)
+    features = iterator.get_next()
+    self.assertAllEqual(
+        sorted(features),
+        ["query_length", "unigrams", "utility", "weights"])
+
+    query_length, weights = [], []
+    with tf.compat.v1.Session() as sess:
+      sess.run(tf.compat.v1.tables_initializer())
+      sess.run(iterator.initializer)
+      while True:
+        try:
+          feature_map = sess.run(features)
+        except tf.errors.OutOfRangeError:
+          break
+        query_length.append(feature_map["query_length"])
+        weights.append(feature_map["weights"])
+    return np.concatenate(query_length), np.concatenate(weights)
+
+  def _assert_unbiased(self, query_length, weights):
+    # Head queries (query_length 3) are kept with probability 0.25 and weighted
+    # by 4. Tail queries (query_length 2) are all kept with weight 1.
+    is_head = query_length[:, 0] == 3
+    self.assertAllEqual(weights[is_head], [[4.]] * np.sum(is_head))
+    self.assertAllEqual(weights[~is_head], [[1.]] * 1000)
+    self.assertNear(np.sum(weights[is_head]), 1000., 200.)
+
+  def test_sample_by_importance_feature(self):
+    sampling_fn = data_lib.make_query_importance_sampling_fn(
+        weights_feature_name="weights",
+        importance_feature_name="importance",
+        seed=1)
+    self._assert_unbiased(*self._read_weights(sampling_fn))
+
+  def test_sample_by_importance_table(self):
+    sampling_fn = data_lib.make_query_importance_sampling_fn(
+        weights_feature_name="weights",
+        query_feature_name="query_length",
+        importance_table={3: 0.5},
+        default_importance=2.,
+        sampling_rate=0.5,
+        seed=1)
+    self._assert_unbiased(*self._read_weights(sampling_fn))
+
+  def test_invalid_args(self):
+    with self.assertRaisesRegexp(ValueError, r"Exactly one of"):
+      data_lib.make_query_importance_sampling_fn("weights")
+    with self.assertRaisesRegexp(ValueError, r"query_feature_name must be"):
+      data_lib.make_query_importance_sampling_fn(
+          "weights", importance_table={3: 0.5})
+
+
+class SequenceExampleWriterTest(tf.test.TestCase, parameterized.TestCase):
+
+  @parameterized.named_parameters(("in_process", 1, 1),
+                                  ("with_process_pool", 3, 2))
+  def test_write_sequence_example_tfrecords(self, num_shards, num_processes):
+    path = os.path.join(tf.compat.v1.test.get_temp_dir(),
+                        "test_writer_{}.tfrecord".format(num_processes))
+    paths = data_lib.write_sequence_example_tfrecords(
+        path,
+        context_features={"query_length": np.array([3, 2, 1])},
+        example_features={
+            "utility": np.array([[0., 1.], [0., 5.], [2., 3.]]),
+            "unigrams": np.array([[["a", "b"], ["c", "d"]],
+                                  [["e", "f"], ["g", "h"]],
+                                  [["i", "j"], ["k", "l"]]]),
+        },
+        list_sizes=[2, 1, 0],
+        num_shards=num_shards,
+        num_processes=num_processes)
+    self.assertLen(paths, num_shards)
+
+    batched_dataset = data_lib.read_batched_sequence_example_dataset(
+        file_pattern=paths,
+        batch_size=3,
+        list_size=2,
+        context_feature_spec=CONTEXT_FEATURE_SPEC,
+        example_feature_spec=EXAMPLE_FEATURE_SPEC,
+        num_epochs=1,
+        shuffle=False,
+        sloppy_ordering=False,
+        reader_num_threads=1)
+    features = tf.compat.v1.data.make_one_shot_iterator(
+        batched_dataset).get_next()
+
+    with tf.compat.v1.Session() as sess:
+      feature_map = sess.run(features)
+      self.assertAllEqual(feature_map["query_length"], [[3], [2], [1]])
+      # Padded frames are trimmed and parsed back as -1.
+      self.assertAllEqual(feature_map["utility"],
+                          [[[0.], [1.]], [[0.], [-1.]], [[-1.], [-1.]]])
+      self.assertAllEqual(feature_map["unigrams"].indices,
+                          [[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1],
+                           [1, 0, 0], [1, 0, 1]])
+      self.assertAllEqual(feature_map["unigrams"].values,
+                          [b"a", b"b", b"c", b"d", b"e", b"f"])
+
+  def test_write_sequence_example_tfrecords_invalid_args(self):
+    path = os.path.join(tf.compat.v1.test.get_temp_dir(), "test_invalid")
+    with self.assertRaisesRegexp(ValueError, r"cannot be None or empty"):
+      data_lib.write_sequence_example_tfrecords(path, {}, {})
+    with self.assertRaisesRegexp(ValueError, r"has 1 lists, but expected 2"):
+      data_lib.write_sequence_example_tfrecords(
+          path, {"query_length": [1]}, {"utility": [[1.], [2.]]})
+    with self.assertRaisesRegexp(ValueError, r"list_sizes must have shape"):
+      data_lib.write_sequence_example_tfrecords(
+          path, {}, {"utility": [[1.], [2.]]}, list_sizes=[1])
+
+
+class IdealDCGTest(tf.test.TestCase):
+
+  def test_compute_ideal_dcg(self):
+    labels = np.array([[1., 4., 1., 0.], [4., 2., -1., 3.], [0., 0., 2., -1.]])
+    with tf.compat.v1.Session() as sess:
+      for topn in [None, 1, 2, 10]:
+        self.assertAllClose(
+            data_lib.compute_ideal_dcg(labels, topn=topn),
+            np.reshape(
+                1. / sess.run(utils.inverse_max_dcg(
+                    np.maximum(labels, 0.).astype(np.float32), topn=topn)),
+                [-1]))
+    self.assertAllClose(data_lib.compute_ideal_dcg([[0., -1.]]), [0.])
+
+  def test_compute_ideal_dcg_with_list_sizes(self):
+    labels = [[1., 4., 1.], [4., 2., 3.]]
+    self.assertAllClose(
+        data_lib.compute_ideal_dcg(labels, list_sizes=[3, 1]),
+        data_lib.compute_ideal_dcg([[1., 4., 1.], [4., -1., -1.]]))
+
+  def test_compute_ideal_dcg_with_gain_fn(self):
+    self.assertAllClose(
+        data_lib.compute_ideal_dcg([[1., 0., 2.]],
+                                   gain_fn=lambda labels: labels,
+                                   rank_discount_fn=lambda rank: 1. / rank),
+        [2. + 1. / 2.])
+
+
 class LibSVMUnitTest(tf.test.TestCase, parameterized.TestCase):
 
   def test_libsvm_parse_line(self):
@@ -330,6 +586,67 @@ class LibSVMUnitTest(tf.test.TestCase, parameterized.TestCase):
         "label": 1.0
     })
 
+  def test_libsvm_parse_line_with_docid(self):
+    data = "1 qid:10 32:0.14 48:0.97 # docid = 123 inc = 0.5"
+    qid, features = data_lib._libsvm_parse_line(data)
+    self.assertEqual(qid, 10)
+    self.assertDictEqual(features, {
+        "32": 0.14,
+        "48": 0.97,
+        "label": 1.0,
+        "docid": 123,
+    })
+
+    _, features = data_lib._libsvm_parse_line(
+        "0 qid:10 32:0.1 #docid=GX001-00-1234")
+    self.assertEqual(features["docid"],
+                     data_lib.docid_to_int64("GX001-00-1234"))
+    self.assertGreaterEqual(features["docid"], 0)
+    self.assertLess(features["docid"], 2**63)
+
+  def test_parse_docid(self):
+    self.assertEqual(data_lib.parse_docid(" docid = 42 inc = 1"), 42)
+    self.assertEqual(data_lib.parse_docid("docid=GX001-00-1234"),
+                     data_lib.docid_to_int64("GX001-00-1234"))
+    self.assertIsNone(data_lib.parse_docid(" inc = 1 prob = 0.5"))
+
+  def test_docid_to_int64(self):
+    self.assertEqual(data_lib.docid_to_int64("42"), 42)
+    # Hashing is stable and distinguishes IDs.
+    self.assertEqual(data_lib.docid_to_int64("clueweb09-en0000-00-00000"),
+                     data_lib.docid_to_int64(u"clueweb09-en0000-00-00000"))
+    self.assertNotEqual(data_lib.docid_to_int64("doc-a"),
+                        data_lib.docid_to_int64("doc-b"))
+    # Non-ASCII digits and large numbers are hashed apart from numeric IDs.
+    for docid in [u"\u00b2", str(2**62), str(2**70), "doc-a"]:
+      self.assertGreaterEqual(data_lib.docid_to_int64(docid), 2**62)
+      self.assertLess(data_lib.docid_to_int64(docid), 2**63)
+
+  def test_libsvm_generate_with_docid(self):
+    doc_list = [
+        {
+            "1": 0.1,
+            "label": 2.0,
+            "docid": 7,
+        },
+        {
+            "1": 0.12,
+            "label": 1.0,
+        },
+    ]
+    np.random.seed(10)
+    features, labels = data_lib._libsvm_generate(
+        num_features=1, list_size=3, doc_list=doc_list, with_docid=True)
+    self.assertAllEqual(labels, [2.0, 1.0, -1.0])
+    self.assertAllClose(features["1"], [[0.1], [0.12], [0.]])
+    self.assertEqual(features["docid"].dtype, np.int64)
+    self.assertAllEqual(features["docid"], [[7], [-1], [-1]])
+
+    # Doc IDs are dropped by default.
+    features, _ = data_lib._libsvm_generate(
+        num_features=1, list_size=3, doc_list=doc_list)
+    self.assertNotIn("docid", features)
+
   def test_libsvm_generate(self):
     doc_list = [
         {
@@ -0,0 +1,396 @@
+# Copyright 2019 The TensorFlow Ranking Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Feature statistics for ranking datasets.
+
+Computes per-feature count, mean, variance, min, max and quantiles in a single
+streaming pass over LibSVM files or TFRecord files of `SequenceExample`. Each
+file is summarized by mergeable sketches in bounded memory, optionally in a
+pool of processes, and the sketches are merged into the final statistics. The
+statistics can be saved to a JSON file and loaded to normalize features, e.g.,
+by `make_normalizer_fn`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import json
+import multiprocessing
+import numpy as np
+import six
+
+import tensorflow as tf
+
+from tensorflow_ranking.python import data
+
+_DEFAULT_QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+# The number of items kept per level of a quantile sketch. The rank error of
+# the quantiles is roughly O(log(n / capacity) / capacity).
+_DEFAULT_SKETCH_CAPACITY = 1024
+
+
+class _QuantileSketch(object):
+  """A mergeable quantile sketch in bounded memory.
+
+  Items are kept in levels, where an item at level h stands for 2^h original
+  values. When a level holds more than `capacity` items, it is sorted and every
+  other item, starting from a random offset, is promoted to the next level.
+  This is the compaction scheme of the KLL sketch with equal level capacities.
+  """
+
+  def __init__(self, capacity=_DEFAULT_SKETCH_CAPACITY, seed=None):
+    self._capacity = capacity
+    self._levels = [np.zeros([0])]
+    self._random = np.random.RandomState(seed)
+
+  def add(self, values):
+    """Adds a 1-D array of values."""
+    self._levels[0] = np.concatenate([self._levels[0], values])
+    self._compact()
+
+  def add_constant(self, value, count):
+    """Adds `count` copies of `value` in O(log(count)) items."""
+    level = 0
+    while count:
+      if count & 1:
+        self._add_to_level(level, np.array([value], dtype=np.float64))
+      count >>= 1
+      level += 1
+    self._compact()
+
+  def merge(self, other):
+    """Merges another `_QuantileSketch` into this one."""
+    for level, items in enumerate(other._levels):  # pylint: disable=protected-access
+      self._add_to_level(level, items)
+    self._compact()
+
+  def quantiles(self, qs):
+    """Returns the approximate quantiles for the fractions in `qs`."""
+    items = np.concatenate(self._levels)
+    if not items.size:
+      return [None] * len(qs)
+    weights = np.concatenate([
+        np.full([level_items.size], 2.**level)
+        for level, level_items in enumerate(self._levels)
+    ])
+    order = np.argsort(items, kind='mergesort')
+    items, cum_weights = items[order], np.cumsum(weights[order])
+    indices = np.searchsorted(cum_weights, np.asarray(qs) * cum_weights[-1])
+    return items[np.minimum(indices, items.size - 1)].tolist()
+
+  def _add_to_level(self, level, items):
+    while len(self._levels) <= level:
+      self._levels.append(np.zeros([0]))
+    self._levels[level] = np.concatenate([self._levels[level], items])
+
+  def _compact(self):
+    level = 0
+    while level < len(self._levels):
+      items = self._levels[level]
+      if items.size > self._capacity:
+        items = np.sort(items)
+        # Keeps the last item of an odd number of items at this level.
+        if items.size % 2:
+          items, kept = items[:-1], items[-1:]
+        else:
+          kept = items[:0]
+        self._levels[level] = kept
+        self._add_to_level(level + 1, items[self._random.randint(2)::2])
+      level += 1
+
+
+class _FeatureSketch(object):
+  """Mergeable moments, extremes and quantiles of a single feature."""
+
+  def __init__(self, sketch_capacity=_DEFAULT_SKETCH_CAPACITY, seed=None):
+    self.count = 0
+    self.mean = 0.
+    # The sum of squared differences from the mean.
+    self.m2 = 0.
+    self.min = np.inf
+    self.max = -np.inf
+    self.quantile_sketch = _QuantileSketch(sketch_capacity, seed=seed)
+
+  def add(self, values):
+    """Adds a 1-D array of values."""
+    values = np.asarray(values, dtype=np.float64)
+    if not values.size:
+      return
+    self._merge_moments(values.size, np.mean(values),
+                        np.sum(np.square(values - np.mean(values))))
+    self.min = min(self.min, np.min(values))
+    self.max = max(self.max, np.max(values))
+    self.quantile_sketch.add(values)
+
+  def add_constant(self, value, count):
+    """Adds `count` copies of `value`."""
+    if not count:
+      return
+    self._merge_moments(count, value, 0.)
+    self.min = min(self.min, value)
+    self.max = max(self.max, value)
+    self.quantile_sketch.add_constant(value, count)
+
+  def merge(self, other):
+    """Merges another `_FeatureSketch` into this one."""
+    if not other.count:
+      return
+    self._merge_moments(other.count, other.mean, other.m2)
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+    self.quantile_sketch.merge(other.quantile_sketch)
+
+  def summary(self, quantiles):
+    """Returns a dict of statistics."""
+    return {
+        'count': self.count,
+        'mean': self.mean,
+        'variance': self.m2 / self.count if self.count else 0.,
+        'min': self.min if self.count else None,
+        'max': self.max if self.count else None,
+        'quantiles': {
+            str(q): v for q, v in zip(
+                quantiles, self.quantile_sketch.quantiles(quantiles))
+        },
+    }
+
+  def _merge_moments(self, count, mean, m2):
+    """Merges moments with the parallel algorithm of Chan et al."""
+    total = self.count + count
+    delta = mean - self.mean
+    self.mean += delta * count / total
+    self.m2 += m2 + delta**2 * self.count * count / total
+    self.count = total
+
+
+def _libsvm_file_sketches(path, sketch_capacity, seed):
+  """Returns a dict of `_FeatureSketch`es and the number of lines of a file.
+
+  The sketches only have the values present in the file. A feature missing from
+  a line counts as a 0, which is how it is fed to the model, so the zeros are
+  added once the sketches of all the files are merged.
+  """
+  sketches = {}
+  num_docs = 0
+  buffers = {}
+
+  def _flush(name):
+    if name not in sketches:
+      sketches[name] = _FeatureSketch(sketch_capacity, seed)
+    sketches[name].add(buffers.pop(name))
+
+  with tf.io.gfile.GFile(path, 'r') as f:
+    for line in f:
+      # Drops the comments, e.g., "# docid = ...".
+      line = line.split('#')[0]
+      if not line.strip():
+        continue
+      num_docs += 1
+      _, features = data._libsvm_parse_line(line)  # pylint: disable=protected-access
+      for name, value in six.iteritems(features):
+        if name == data._LABEL_FEATURE:  # pylint: disable=protected-access
+          continue
+        buffers.setdefault(name, []).append(value)
+        if len(buffers[name]) >= sketch_capacity:
+          _flush(name)
+  for name in list(buffers):
+    _flush(name)
+  return sketches, num_docs
+
+
+def _sequence_example_file_sketches(path, feature_names, sketch_capacity, seed):
+  """Returns a dict of `_FeatureSketch`es for a TFRecord file and None.
+
+  Statistics are over all the values of a feature, either in the context or
+  in the frames of a `feature_list`, so there are no missing values to count.
+  """
+  sketches = {}
+  buffers = {}
+
+  def _flush(name):
+    if name not in sketches:
+      sketches[name] = _FeatureSketch(sketch_capacity, seed)
+    sketches[name].add(buffers.pop(name))
+
+  def _add(name, feature):
+    kind = feature.WhichOneof('kind')
+    if kind not in ('float_list', 'int64_list'):
+      return
+    if feature_names is not None and name not in feature_names:
+      return
+    buffers.setdefault(name, []).extend(getattr(feature, kind).value)
+    if len(buffers[name]) >= sketch_capacity:
+      _flush(name)
+
+  for record in tf.compat.v1.io.tf_record_iterator(path):
+    sequence_example = tf.train.SequenceExample.FromString(record)
+    for name, feature in six.iteritems(sequence_example.context.feature):
+      _add(name, feature)
+    for name, feature_list in six.iteritems(
+        sequence_example.feature_lists.feature_list):
+      for feature in feature_list.feature:
+        _add(name, feature)
+  for name in list(buffers):
+    _flush(name)
+  return sketches, None
+
+
+def _compute_feature_stats(file_sketches_fn, file_pattern, num_processes,
+                           quantiles, sketch_capacity, seed):
+  """Merges per-file sketches into a dict of feature statistics.
+
+  `file_sketches_fn` returns the sketches of a file together with its number of
+  documents, or None if missing values are not counted. A feature missing from
+  a document counts as a 0, including in the files where it never appears.
+  """
+  paths = tf.io.gfile.glob(file_pattern)
+  file_sketches_fn = functools.partial(
+      file_sketches_fn, sketch_capacity=sketch_capacity, seed=seed)
+  merged = {}
+  num_docs = [0]
+
+  def _merge(sketches_and_num_docs):
+    sketches, file_num_docs = sketches_and_num_docs
+    if file_num_docs is None:
+      num_docs[0] = None
+    elif num_docs[0] is not None:
+      num_docs[0] += file_num_docs
+    for name, sketch in six.iteritems(sketches):
+      if name in merged:
+        merged[name].merge(sketch)
+      else:
+        merged[name] = sketch
+
+  if num_processes > 1:
+    pool = multiprocessing.Pool(processes=num_processes)
+    try:
+      # Merging the sketches as they arrive bounds the memory to a few sketches
+      # per process.
+      for sketches_and_num_docs in pool.imap_unordered(file_sketches_fn,
+                                                       paths):
+        _merge(sketches_and_num_docs)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for path in paths:
+      _merge(file_sketches_fn(path))
+  if num_docs[0] is not None:
+    for sketch in six.itervalues(merged):
+      sketch.add_constant(0., num_docs[0] - sketch.count)
+  return {
+      name: sketch.summary(quantiles)
+      for name, sketch in six.iteritems(merged)
+  }
+
+
+def compute_libsvm_feature_stats(file_pattern,
+                                 num_processes=1,
+                                 quantiles=_DEFAULT_QUANTILES,
+                                 sketch_capacity=_DEFAULT_SKETCH_CAPACITY,
+                                 seed=None):
+  """Computes feature statistics over LibSVM files.
+
+  Args:
+    file_pattern: (str | list(str)) List of files or patterns of file paths in
+      the LibSVM format. See `tf.gfile.Glob` for pattern rules.
+    num_processes: (int) The number of processes used to sketch the files. If
+      1, the files are sketched in the current process.
+    quantiles: (list) The fractions for which quantiles are computed.
+    sketch_capacity: (int) The number of values kept per level of the quantile
+      sketches. Larger values give more accurate quantiles with more memory.
+    seed: (int) Randomization seed used by the quantile sketches.
+
+  Returns:
+    A dict mapping feature IDs to dicts of statistics with keys "count",
+    "mean", "variance", "min", "max" and "quantiles". A feature missing from a
+    line counts as a 0.
+  """
+  return _compute_feature_stats(_libsvm_file_sketches, file_pattern,
+                                num_processes, quantiles, sketch_capacity,
+                                seed)
+
+
+def compute_sequence_example_feature_stats(
+    file_pattern,
+    feature_names=None,
+    num_processes=1,
+    quantiles=_DEFAULT_QUANTILES,
+    sketch_capacity=_DEFAULT_SKETCH_CAPACITY,
+    seed=None):
+  """Computes feature statistics over TFRecord files of `SequenceExample`.
+
+  Args:
+    file_pattern: (str | list(str)) List of files or patterns of file paths
+      containing tf.SequenceExample protos. See `tf.gfile.Glob` for pattern
+      rules.
+    feature_names: (list) The names of the context or example features to
+      compute statistics for. If None, all the float and int64 features are
+      used.
+    num_processes: (int) The number of processes used to sketch the files. If
+      1, the files are sketched in the current process.
+    quantiles: (list) The fractions for which quantiles are computed.
+    sketch_capacity: (int) The number of values kept per level of the quantile
+      sketches. Larger values give more accurate quantiles with more memory.
+    seed: (int) Randomization seed used by the quantile sketches.
+
+  Returns:
+    A dict mapping feature names to dicts of statistics. See
+    `compute_libsvm_feature_stats`. Padding frames are not in the files and are
+    not counted.
+  """
+  if feature_names is not None:
+    feature_names = frozenset(feature_names)
+  return _compute_feature_stats(
+      functools.partial(
+          _sequence_example_file_sketches, feature_names=feature_names),
+      file_pattern, num_processes, quantiles, sketch_capacity, seed)
+
+
+def write_feature_stats(feature_stats, path):
+  """Writes feature statistics to a JSON file."""
+  with tf.io.gfile.GFile(path, 'w') as f:
+    f.write(json.dumps(feature_stats, indent=2, sort_keys=True))
+
+
+def load_feature_stats(path):
+  """Loads feature statistics written by `write_feature_stats`."""
+  with tf.io.gfile.GFile(path, 'r') as f:
+    return json.loads(f.read())
+
+
+def make_normalizer_fn(feature_stats, name, epsilon=1e-6):
+  """Returns a function standardizing a feature by its statistics.
+
+  The returned function computes (x - mean) / sqrt(variance + epsilon) and can
+  be used as the `normalizer_fn` of `tf.feature_column.numeric_column`.
+
+  Args:
+    feature_stats: (dict) Feature statistics, e.g., from `load_feature_stats`.
+    name: (str) The name of the feature.
+    epsilon: (float) A small value added to the variance for constant features.
+
+  Returns:
+    A function on a `Tensor`.
+  """
+  mean = feature_stats[name]['mean']
+  stddev = np.sqrt(feature_stats[name]['variance'] + epsilon)
+
+  def _normalizer_fn(x):
+    return (x - mean) / stddev
+
+  return _normalizer_fn
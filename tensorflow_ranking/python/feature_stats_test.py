@@ -0,0 +1,154 @@
+# Copyright 2019 The TensorFlow Ranking Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for feature_stats.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from absl.testing import parameterized
+import numpy as np
+
+import tensorflow as tf
+
+from tensorflow_ranking.python import data as data_lib
+from tensorflow_ranking.python import feature_stats
+
+LIBSVM_DATA = """2 qid:1 1:0.1 3:0.3 4:-0.4 # docid = a
+1 qid:1 1:0.12 4:0.24 5:0.5
+0 qid:1 2:0.13
+"""
+
+
+class QuantileSketchTest(tf.test.TestCase):
+
+  def test_quantiles(self):
+    values = np.random.RandomState(1).uniform(size=100000)
+    sketches = []
+    for shard in np.split(values, 10):
+      sketch = feature_stats._QuantileSketch(capacity=256, seed=1)
+      for chunk in np.split(shard, 100):
+        sketch.add(chunk)
+      sketches.append(sketch)
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+      merged.merge(sketch)
+    # Memory is bounded by the capacity per level.
+    self.assertLessEqual(
+        sum(level.size for level in merged._levels),
+        256 * len(merged._levels))
+    self.assertAllClose(
+        merged.quantiles([0.1, 0.5, 0.9]),
+        np.percentile(values, [10, 50, 90]),
+        atol=0.02)
+
+  def test_add_constant(self):
+    sketch = feature_stats._QuantileSketch(capacity=4, seed=1)
+    sketch.add(np.array([1., 2., 3.]))
+    sketch.add_constant(0., 1000)
+    self.assertAllEqual(sketch.quantiles([0.5, 1.]), [0., 3.])
+
+  def test_empty(self):
+    sketch = feature_stats._QuantileSketch()
+    self.assertEqual(sketch.quantiles([0.5]), [None])
+
+
+class FeatureStatsTest(tf.test.TestCase, parameterized.TestCase):
+
+  def _check_stats(self, stats, values):
+    self.assertEqual(stats["count"], len(values))
+    self.assertAllClose(stats["mean"], np.mean(values))
+    self.assertAllClose(stats["variance"], np.var(values))
+    self.assertAllClose(stats["min"], np.min(values))
+    self.assertAllClose(stats["max"], np.max(values))
+    # Sketch quantiles are observed values, so the median of an even number of
+    # values falls on either side of the interpolated one.
+    self.assertBetween(stats["quantiles"]["0.5"],
+                       np.percentile(values, 50, interpolation="lower"),
+                       np.percentile(values, 50, interpolation="higher"))
+
+  @parameterized.named_parameters(("in_process", 1), ("with_process_pool", 2))
+  def test_compute_libsvm_feature_stats(self, num_processes):
+    data_dir = tf.compat.v1.test.get_temp_dir()
+    paths = [os.path.join(data_dir, "libsvm_{}.txt".format(i)) for i in [0, 1]]
+    for path in paths:
+      with open(path, "wt") as writer:
+        writer.write(LIBSVM_DATA)
+
+    stats = feature_stats.compute_libsvm_feature_stats(
+        os.path.join(data_dir, "libsvm_*.txt"), num_processes=num_processes)
+    self.assertEqual(sorted(stats), ["1", "2", "3", "4", "5"])
+    # Missing features count as 0.
+    self._check_stats(stats["1"], [0.1, 0.12, 0., 0.1, 0.12, 0.])
+    self._check_stats(stats["4"], [-0.4, 0.24, 0., -0.4, 0.24, 0.])
+
+  @parameterized.named_parameters(("in_process", 1), ("with_process_pool", 2))
+  def test_compute_libsvm_feature_stats_with_feature_missing_from_file(
+      self, num_processes):
+    data_dir = tf.compat.v1.test.get_temp_dir()
+    contents = ["1 qid:1 1:0.5 2:2.\n0 qid:1 1:1.5\n", "1 qid:2 1:1.\n"]
+    for i, content in enumerate(contents):
+      with open(os.path.join(data_dir, "missing_{}.txt".format(i)),
+                "wt") as writer:
+        writer.write(content)
+
+    stats = feature_stats.compute_libsvm_feature_stats(
+        os.path.join(data_dir, "missing_*.txt"), num_processes=num_processes)
+    # Feature 2 never appears in the second file, whose line still counts as a
+    # 0 for it.
+    self._check_stats(stats["1"], [0.5, 1.5, 1.])
+    self._check_stats(stats["2"], [2., 0., 0.])
+
+  def test_compute_sequence_example_feature_stats(self):
+    path = os.path.join(tf.compat.v1.test.get_temp_dir(),
+                        "feature_stats.tfrecord")
+    data_lib.write_sequence_example_tfrecords(
+        path,
+        context_features={"query_length": np.array([3, 2])},
+        example_features={
+            "utility": np.array([[0., 1.], [5., -1.]]),
+            "unigrams": np.array([["a", "b"], ["c", "d"]]),
+        },
+        list_sizes=[2, 1])
+
+    stats = feature_stats.compute_sequence_example_feature_stats(path)
+    self.assertEqual(sorted(stats), ["query_length", "utility"])
+    self._check_stats(stats["query_length"], [3, 2])
+    self._check_stats(stats["utility"], [0., 1., 5.])
+
+    stats = feature_stats.compute_sequence_example_feature_stats(
+        path, feature_names=["utility"])
+    self.assertEqual(sorted(stats), ["utility"])
+
+  def test_write_and_load_feature_stats(self):
+    path = os.path.join(tf.compat.v1.test.get_temp_dir(), "stats.json")
+    data_file = os.path.join(tf.compat.v1.test.get_temp_dir(), "libsvm.txt")
+    with open(data_file, "wt") as writer:
+      writer.write(LIBSVM_DATA)
+    stats = feature_stats.compute_libsvm_feature_stats(data_file)
+    feature_stats.write_feature_stats(stats, path)
+    loaded = feature_stats.load_feature_stats(path)
+    self.assertAllClose(loaded["3"]["mean"], 0.1)
+
+    normalizer_fn = feature_stats.make_normalizer_fn(loaded, "3", epsilon=0.)
+    with tf.compat.v1.Session() as sess:
+      self.assertAllClose(
+          sess.run(normalizer_fn(tf.constant([0.3, 0., 0.]))),
+          (np.array([0.3, 0., 0.]) - 0.1) / np.std([0.3, 0., 0.]))
+
+
+if __name__ == "__main__":
+  tf.test.main()
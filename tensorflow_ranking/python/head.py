@@ -27,6 +27,8 @@ import tensorflow as tf
 
 from tensorflow.python.estimator.canned import head as head_lib
 
+from tensorflow_ranking.python import utils
+
 _DEFAULT_SERVING_KEY = tf.saved_model.DEFAULT_SERVING_SIGNATURE_DEF_KEY
 
 # The above default is defined by TF Serving, but these next three are just
@@ -34,12 +36,17 @@ _DEFAULT_SERVING_KEY = tf.saved_model.DEFAULT_SERVING_SIGNATURE_DEF_KEY
 _REGRESS_SERVING_KEY = 'regression'
 _PREDICT_SERVING_KEY = 'predict'
 
+# The key of the logits in predictions when features are passed through.
+_LOGITS_PREDICTION_KEY = 'logits'
+
 
 def create_ranking_head(loss_fn,
                         eval_metric_fns=None,
                         optimizer=None,
                         train_op_fn=None,
-                        name=None):
+                        name=None,
+                        passthrough_feature_names=None,
+                        num_hard_lists=None):
   """A factory method to create `_RankingHead`.
 
   Args:
@@ -69,22 +76,85 @@ def create_ranking_head(loss_fn,
       `train_op`. Used if `optimizer` is `None`.
     name: Name of the head. If provided, will be used as `name_scope` when
       creating ops.
+    passthrough_feature_names: A list of feature names, such as document IDs,
+      that are returned next to the logits in PREDICT mode. These features are
+      not fed to the scoring function. When set, predictions are a dict with
+      the logits under 'logits' and each passthrough feature under its name.
+    num_hard_lists: An optional int. If set, `loss_fn` must return the per-list
+      losses with shape [batch_size], e.g., from `make_loss_fn` with
+      `Reduction.NONE`. In TRAIN mode, only the `num_hard_lists` lists with the
+      largest losses in a batch are trained on: their loss is recomputed on
+      these lists alone and averaged, so the backward pass of the loss skips
+      the other lists. In EVAL mode, the loss is the average over all lists.
 
   Returns:
     An instance of `_RankingHead` for ranking.
 
   Raises:
-    ValueError: If `loss_fn` is not callable.
+    ValueError: If `loss_fn` is not callable or `num_hard_lists` is not
+      positive.
   """
   if not callable(loss_fn):
     raise ValueError('Not callable loss_fn: {}'.format(loss_fn))
+  if num_hard_lists is not None and num_hard_lists <= 0:
+    raise ValueError(
+        'num_hard_lists must be positive: {}'.format(num_hard_lists))
 
   return _RankingHead(
       loss_fn=loss_fn,
       eval_metric_fns=eval_metric_fns,
       optimizer=optimizer,
       train_op_fn=train_op_fn,
-      name=name)
+      name=name,
+      passthrough_feature_names=passthrough_feature_names,
+      num_hard_lists=num_hard_lists)
+
+
+def _gather_lists(name, value, indices):
+  """Gathers the lists at `indices` of a batched feature.
+
+  Args:
+    name: The name of the feature, for the error message.
+    value: A `Tensor`, a value convertible to one, or a `SparseTensor`, with
+      the batch as the first dimension.
+    indices: A 1-D int `Tensor` of distinct list indices.
+
+  Returns:
+    A `Tensor` or `SparseTensor` of the same kind as `value` with the lists at
+    `indices`, in that order.
+
+  Raises:
+    ValueError: If `value` cannot be gathered by list.
+  """
+  if isinstance(value, tf.SparseTensor):
+    # The kept lists are renumbered in the order of `indices`, and the entries
+    # of the other lists are mapped to -1 and dropped.
+    new_rows = tf.scatter_nd(
+        tf.expand_dims(indices, 1),
+        tf.range(tf.size(input=indices)) + 1,
+        [tf.cast(value.dense_shape[0], dtype=tf.int32)]) - 1
+    entry_rows = tf.cast(
+        tf.gather(new_rows, value.indices[:, 0]), dtype=tf.int64)
+    is_kept = tf.greater_equal(entry_rows, 0)
+    dense_shape = tf.concat(
+        [tf.cast(tf.shape(input=indices), tf.int64), value.dense_shape[1:]],
+        axis=0)
+    return tf.sparse.reorder(
+        tf.SparseTensor(
+            indices=tf.boolean_mask(
+                tensor=tf.concat(
+                    [tf.expand_dims(entry_rows, 1), value.indices[:, 1:]],
+                    axis=1),
+                mask=is_kept),
+            values=tf.boolean_mask(tensor=value.values, mask=is_kept),
+            dense_shape=dense_shape))
+  try:
+    value = tf.convert_to_tensor(value=value)
+  except (TypeError, ValueError):
+    raise ValueError(
+        'Feature {} of type {} cannot be gathered for the hard lists.'.format(
+            name, type(value)))
+  return tf.gather(value, indices)
 
 
 class _RankingHead(object):
@@ -95,18 +165,64 @@ class _RankingHead(object):
                eval_metric_fns=None,
                optimizer=None,
                train_op_fn=None,
-               name=None):
+               name=None,
+               passthrough_feature_names=None,
+               num_hard_lists=None):
     """Constructor. See `create_ranking_head`."""
     self._loss_fn = loss_fn
     self._eval_metric_fns = eval_metric_fns or {}
     self._optimizer = optimizer
     self._train_op_fn = train_op_fn
     self._name = name
+    self._passthrough_feature_names = list(passthrough_feature_names or [])
+    self._num_hard_lists = num_hard_lists
 
   @property
   def name(self):
     return self._name
 
+  @property
+  def passthrough_feature_names(self):
+    return self._passthrough_feature_names
+
+  def _predictions(self, features, logits):
+    """Returns the logits and the passthrough features in PREDICT mode."""
+    if not self._passthrough_feature_names:
+      return logits
+    predictions = {_LOGITS_PREDICTION_KEY: logits}
+    for name in self._passthrough_feature_names:
+      if name not in features:
+        raise ValueError(
+            'Passthrough feature {} not found in features.'.format(name))
+      predictions[name] = tf.convert_to_tensor(value=features[name])
+    return predictions
+
+  def _hard_list_loss(self, features, logits, labels, per_list_losses):
+    """Returns the average loss of the lists with the largest losses.
+
+    Args:
+      features: Input `dict` of `Tensor` or `SparseTensor` objects with the
+        batch as the first dimension, which are gathered by list.
+      logits: A `Tensor` with shape [batch_size, list_size].
+      labels: A `Tensor` of the same shape as `logits`.
+      per_list_losses: A `Tensor` with shape [batch_size].
+
+    Returns:
+      A scalar `Tensor`.
+    """
+    num_hard_lists = tf.minimum(self._num_hard_lists,
+                                tf.shape(input=per_list_losses)[0])
+    _, hard_indices = tf.nn.top_k(
+        tf.stop_gradient(per_list_losses), num_hard_lists, sorted=False)
+    hard_features = {
+        name: _gather_lists(name, value, hard_indices)
+        for name, value in six.iteritems(features)
+    }
+    return tf.reduce_mean(
+        input_tensor=self._loss_fn(
+            tf.gather(labels, hard_indices), tf.gather(logits, hard_indices),
+            hard_features))
+
   def _labels_and_logits_metrics(self, labels, logits):
     """Returns metrics for labels and logits."""
     is_label_valid = tf.reshape(tf.greater_equal(labels, 0.), [-1])
@@ -138,16 +254,33 @@ class _RankingHead(object):
       * the `Tensor` representing the example weights
       * possibly processed labels (e.g. vocabulary lookup, shape manipulation,
         etc.)
+
+    Raises:
+      ValueError: If `num_hard_lists` is set and the loss is not per list.
     """
-    del mode  # Unused for this head.
     logits = tf.convert_to_tensor(value=logits)
     labels = tf.cast(labels, dtype=tf.float32)
 
     training_loss = self._loss_fn(labels, logits, features)
+    if self._num_hard_lists is None:
+      return head_lib.LossSpec(
+          training_loss=training_loss,
+          unreduced_loss=None,
+          weights=None,
+          processed_labels=labels)
 
+    per_list_losses = training_loss
+    if per_list_losses.get_shape().ndims != 1:
+      raise ValueError('num_hard_lists requires per-list losses with shape '
+                       '[batch_size], got: {}'.format(per_list_losses))
+    if mode == tf.estimator.ModeKeys.TRAIN:
+      training_loss = self._hard_list_loss(features, logits, labels,
+                                           per_list_losses)
+    else:
+      training_loss = tf.reduce_mean(input_tensor=per_list_losses)
     return head_lib.LossSpec(
         training_loss=training_loss,
-        unreduced_loss=None,
+        unreduced_loss=per_list_losses,
         weights=None,
         processed_labels=labels)
 
@@ -184,20 +317,25 @@ class _RankingHead(object):
     # Predict.
     with tf.compat.v1.name_scope(self._name, 'head'):
       if mode == tf.estimator.ModeKeys.PREDICT:
+        predictions = self._predictions(features, logits)
         return tf.estimator.EstimatorSpec(
             mode=mode,
-            predictions=logits,
+            predictions=predictions,
             export_outputs={
                 _DEFAULT_SERVING_KEY:
                     tf.estimator.export.RegressionOutput(logits),
                 _REGRESS_SERVING_KEY:
                     tf.estimator.export.RegressionOutput(logits),
                 _PREDICT_SERVING_KEY:
-                    tf.estimator.export.PredictOutput(logits),
+                    tf.estimator.export.PredictOutput(predictions),
             })
 
-      training_loss, _, _, _ = self.create_loss(
-          features=features, mode=mode, logits=logits, labels=labels)
+      labels = tf.cast(labels, dtype=tf.float32)
+      # The loss and the metrics share the sorts of the lists.
+      ranking_context = utils.RankingContext(labels, logits)
+      with ranking_context:
+        training_loss, _, _, _ = self.create_loss(
+            features=features, mode=mode, logits=logits, labels=labels)
       if regularization_losses:
         regularization_loss = tf.add_n(regularization_losses)
         regularized_training_loss = tf.add(training_loss, regularization_loss)
@@ -206,11 +344,12 @@ class _RankingHead(object):
 
       # Eval.
       if mode == tf.estimator.ModeKeys.EVAL:
-        eval_metric_ops = {
-            name: metric_fn(
-                labels=labels, predictions=logits, features=features)
-            for name, metric_fn in six.iteritems(self._eval_metric_fns)
-        }
+        with ranking_context:
+          eval_metric_ops = {
+              name: metric_fn(
+                  labels=labels, predictions=logits, features=features)
+              for name, metric_fn in six.iteritems(self._eval_metric_fns)
+          }
         eval_metric_ops.update(self._labels_and_logits_metrics(labels, logits))
         return tf.estimator.EstimatorSpec(
             mode=mode,
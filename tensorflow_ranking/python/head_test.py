@@ -21,6 +21,7 @@ from __future__ import print_function
 import tensorflow as tf
 
 from tensorflow_ranking.python import head as ranking_head
+from tensorflow_ranking.python import losses as losses_lib
 from tensorflow_ranking.python import metrics as metrics_lib
 
 
@@ -103,6 +104,35 @@ class RankingHeadTest(tf.test.TestCase):
       self.assertAllClose(
           logits, sess.run(spec.export_outputs[self._default_signature].value))
 
+  def test_predict_with_passthrough_features(self):
+    head = ranking_head.create_ranking_head(
+        loss_fn=_make_loss_fn(), passthrough_feature_names=['docid'])
+    logits = [[1., 3.], [1., 2.]]
+    docids = [[[10], [11]], [[20], [-1]]]
+    spec = head.create_estimator_spec(
+        features={'docid': tf.constant(docids, dtype=tf.int64)},
+        mode=tf.estimator.ModeKeys.PREDICT,
+        logits=logits)
+
+    with self.cached_session() as sess:
+      _initialize_variables(self, spec.scaffold)
+      predictions = sess.run(spec.predictions)
+      self.assertItemsEqual(['logits', 'docid'], predictions.keys())
+      self.assertAllClose(logits, predictions['logits'])
+      self.assertAllEqual(docids, predictions['docid'])
+      self.assertAllClose(
+          logits, sess.run(spec.export_outputs[self._default_signature].value))
+      self.assertAllEqual(
+          docids, sess.run(spec.export_outputs['predict'].outputs['docid']))
+
+  def test_predict_with_missing_passthrough_features(self):
+    head = ranking_head.create_ranking_head(
+        loss_fn=_make_loss_fn(), passthrough_feature_names=['docid'])
+    logits = [[1., 3.], [1., 2.]]
+    with self.assertRaises(ValueError):
+      head.create_estimator_spec(
+          features={}, mode=tf.estimator.ModeKeys.PREDICT, logits=logits)
+
   def test_eval(self):
     metric_fns = {
         'metric/precision@1':
@@ -140,6 +170,47 @@ class RankingHeadTest(tf.test.TestCase):
       self.assertAllClose(self._default_loss, loss)
       self.assertItemsEqual(expected_metrics, metrics.keys())
 
+  def test_eval_sorts_lists_once(self):
+    metric_fns = {}
+    for topn in [1, 3, 5, 10]:
+      for metric_key in [
+          metrics_lib.RankingMetricKey.NDCG,
+          metrics_lib.RankingMetricKey.PRECISION,
+      ]:
+        metric_fns['metric/{}@{}'.format(metric_key, topn)] = (
+            metrics_lib.make_ranking_metric_fn(metric_key, topn=topn))
+    metric_fns['metric/mrr'] = metrics_lib.make_ranking_metric_fn(
+        metrics_lib.RankingMetricKey.MRR)
+    head = ranking_head.create_ranking_head(
+        loss_fn=losses_lib.make_loss_fn(
+            losses_lib.RankingLossKey.SOFTMAX_LOSS),
+        eval_metric_fns=metric_fns)
+    labels = [[0., 2., 1., -1.], [1., 0., 3., 2.]]
+    logits = [[1., 3., 2., 4.], [1., 2., 4., 3.]]
+
+    spec = head.create_estimator_spec(
+        features=self._default_features_dict,
+        mode=tf.estimator.ModeKeys.EVAL,
+        logits=logits,
+        labels=labels)
+    # One sort by the logits and one by the labels.
+    self.assertLen([
+        op for op in tf.compat.v1.get_default_graph().get_operations()
+        if op.type == 'TopKV2'
+    ], 2)
+    # The same metrics out of the head sort on their own.
+    expected_metric_ops = {
+        name: metric_fn(tf.constant(labels), tf.constant(logits), {})
+        for name, metric_fn in metric_fns.items()
+    }
+
+    with self.cached_session() as sess:
+      _initialize_variables(self, spec.scaffold)
+      metrics, expected_metrics = sess.run(({
+          name: spec.eval_metric_ops[name][1] for name in metric_fns
+      }, {name: ops[1] for name, ops in expected_metric_ops.items()}))
+      self.assertAllClose(expected_metrics, metrics)
+
   def test_train_create_loss(self):
     head = ranking_head.create_ranking_head(loss_fn=_make_loss_fn())
     # Create loss.
@@ -301,5 +372,141 @@ class RankingHeadTest(tf.test.TestCase):
       self.assertItemsEqual(expected_metrics, metrics.keys())
 
 
+class HardListMiningTest(tf.test.TestCase):
+
+  def setUp(self):
+    tf.compat.v1.reset_default_graph()
+    self._logits = [[1., 3., 2.], [1., 2., 3.], [3., 2., 1.]]
+    self._labels = [[0., 0., 1.], [0., 0., 2.], [0., 0., 1.]]
+    self._loss_fn = losses_lib.make_loss_fn(
+        losses_lib.RankingLossKey.SOFTMAX_LOSS,
+        reduction=tf.compat.v1.losses.Reduction.NONE)
+
+  def _per_list_losses(self):
+    with self.cached_session():
+      return self._loss_fn(self._labels, self._logits, {}).eval()
+
+  def test_train_on_hard_lists(self):
+    per_list_losses = self._per_list_losses()
+    head = ranking_head.create_ranking_head(
+        loss_fn=self._loss_fn, num_hard_lists=2)
+    logits = tf.constant(self._logits)
+    loss_spec = head.create_loss(
+        features={},
+        mode=tf.estimator.ModeKeys.TRAIN,
+        logits=logits,
+        labels=self._labels)
+    grad, = tf.gradients(ys=loss_spec.training_loss, xs=[logits])
+    # The gradient is sparse over the hard lists.
+    grad = tf.convert_to_tensor(value=grad)
+    with self.cached_session() as sess:
+      training_loss, unreduced_loss, grad = sess.run(
+          [loss_spec.training_loss, loss_spec.unreduced_loss, grad])
+      self.assertAllClose(unreduced_loss, per_list_losses)
+      # The third list has the largest and the second list the smallest loss.
+      self.assertAllClose(training_loss,
+                          (per_list_losses[0] + per_list_losses[2]) / 2.)
+      self.assertAllEqual(grad[1], [0., 0., 0.])
+      self.assertNotAllClose(grad[0], [0., 0., 0.])
+      self.assertNotAllClose(grad[2], [0., 0., 0.])
+
+  def test_eval_on_all_lists(self):
+    per_list_losses = self._per_list_losses()
+    head = ranking_head.create_ranking_head(
+        loss_fn=self._loss_fn, num_hard_lists=1)
+    spec = head.create_estimator_spec(
+        features={},
+        mode=tf.estimator.ModeKeys.EVAL,
+        logits=self._logits,
+        labels=self._labels)
+    with self.cached_session() as sess:
+      _initialize_variables(self, spec.scaffold)
+      self.assertAllClose(sess.run(spec.loss), per_list_losses.mean())
+
+  def test_more_hard_lists_than_batch_size(self):
+    per_list_losses = self._per_list_losses()
+    head = ranking_head.create_ranking_head(
+        loss_fn=self._loss_fn, num_hard_lists=10)
+    training_loss = head.create_loss(
+        features={},
+        mode=tf.estimator.ModeKeys.TRAIN,
+        logits=self._logits,
+        labels=self._labels).training_loss
+    with self.cached_session():
+      self.assertAllClose(training_loss.eval(), per_list_losses.mean())
+
+  def test_hard_lists_with_weights(self):
+    weights = [[1.], [2.], [3.]]
+    loss_fn = losses_lib.make_loss_fn(
+        losses_lib.RankingLossKey.SOFTMAX_LOSS,
+        weights_feature_name='weights',
+        reduction=tf.compat.v1.losses.Reduction.NONE)
+    with self.cached_session():
+      per_list_losses = loss_fn(self._labels, self._logits, {
+          'weights': tf.constant(weights)
+      }).eval()
+    head = ranking_head.create_ranking_head(loss_fn=loss_fn, num_hard_lists=1)
+    training_loss = head.create_loss(
+        features={'weights': tf.constant(weights)},
+        mode=tf.estimator.ModeKeys.TRAIN,
+        logits=self._logits,
+        labels=self._labels).training_loss
+    with self.cached_session():
+      self.assertAllClose(training_loss.eval(), per_list_losses.max())
+
+  def test_hard_lists_with_sparse_features(self):
+    # The loss only depends on the number of terms of each list.
+    terms = tf.SparseTensor(
+        indices=[[0, 0], [1, 0], [1, 1], [2, 0], [2, 1], [2, 2]],
+        values=['a', 'b', 'c', 'd', 'e', 'f'],
+        dense_shape=[3, 3])
+
+    def _loss_fn(labels, logits, features):
+      num_terms = tf.sparse.reduce_sum(
+          tf.SparseTensor(features['terms'].indices,
+                          tf.ones_like(features['terms'].values, tf.float32),
+                          features['terms'].dense_shape),
+          axis=1)
+      return self._loss_fn(labels, logits, {}) * num_terms
+
+    with self.cached_session():
+      per_list_losses = _loss_fn(self._labels, self._logits, {
+          'terms': terms
+      }).eval()
+    head = ranking_head.create_ranking_head(loss_fn=_loss_fn, num_hard_lists=2)
+    training_loss = head.create_loss(
+        features={'terms': terms},
+        mode=tf.estimator.ModeKeys.TRAIN,
+        logits=self._logits,
+        labels=self._labels).training_loss
+    with self.cached_session():
+      self.assertAllClose(training_loss.eval(),
+                          sum(sorted(per_list_losses)[1:]) / 2.)
+
+  def test_hard_lists_with_invalid_features(self):
+    head = ranking_head.create_ranking_head(
+        loss_fn=self._loss_fn, num_hard_lists=1)
+    with self.assertRaises(ValueError):
+      head.create_loss(
+          features={'invalid': object()},
+          mode=tf.estimator.ModeKeys.TRAIN,
+          logits=self._logits,
+          labels=self._labels)
+
+  def test_invalid_num_hard_lists(self):
+    with self.assertRaises(ValueError):
+      ranking_head.create_ranking_head(loss_fn=self._loss_fn, num_hard_lists=0)
+
+  def test_reduced_loss_fn(self):
+    head = ranking_head.create_ranking_head(
+        loss_fn=_make_loss_fn(), num_hard_lists=1)
+    with self.assertRaises(ValueError):
+      head.create_loss(
+          features={},
+          mode=tf.estimator.ModeKeys.TRAIN,
+          logits=self._logits,
+          labels=self._labels)
+
+
 if __name__ == '__main__':
   tf.test.main()
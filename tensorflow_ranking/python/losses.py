@@ -23,14 +23,22 @@ from __future__ import division
 from __future__ import print_function
 
 import abc
+import copy
+import numpy as np
 import tensorflow as tf
 
+from tensorflow.python.util import function_utils
+
 from tensorflow_ranking.python import utils
 
 # The smallest probability that is used to derive smallest logit for invalid or
 # padding entries.
 _EPSILON = 1e-10
 
+# The largest static list_size for which lambda weights precompute a
+# [list_size, list_size] table of rank discounts (4MB in float32).
+_MAX_RANK_TABLE_LIST_SIZE = 1024
+
 
 class RankingLossKey(object):
   """Ranking loss key strings."""
@@ -39,12 +47,32 @@ class RankingLossKey(object):
   PAIRWISE_LOGISTIC_LOSS = 'pairwise_logistic_loss'
   PAIRWISE_SOFT_ZERO_ONE_LOSS = 'pairwise_soft_zero_one_loss'
   SOFTMAX_LOSS = 'softmax_loss'
+  SAMPLED_SOFTMAX_LOSS = 'sampled_softmax_loss'
   SIGMOID_CROSS_ENTROPY_LOSS = 'sigmoid_cross_entropy_loss'
   MEAN_SQUARED_LOSS = 'mean_squared_loss'
   LIST_MLE_LOSS = 'list_mle_loss'
   APPROX_NDCG_LOSS = 'approx_ndcg_loss'
 
 
+class PairSamplingKey(object):
+  """Pair sampling strategies for the sampled pairwise losses."""
+  # Pairs (i, j) with l_i > l_j are drawn uniformly.
+  UNIFORM = 'uniform'
+  # A label grade pair (l_i, l_j) is drawn uniformly and then an item pair
+  # uniformly within it, so that pairs with rare label differences are not
+  # crowded out by the most frequent ones.
+  STRATIFIED = 'stratified'
+
+
+class NegativeSamplingKey(object):
+  """Negative sampling strategies for the sampled softmax loss."""
+  # Negatives are drawn uniformly.
+  UNIFORM = 'uniform'
+  # Negatives are drawn with probabilities proportional to exp(logit), so that
+  # the negatives ranked high by the model are drawn more often.
+  LOGIT = 'logit'
+
+
 def make_loss_fn(loss_keys,
                  loss_weights=None,
                  weights_feature_name=None,
@@ -52,9 +80,23 @@ def make_loss_fn(loss_keys,
                  reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
                  name=None,
                  seed=None,
-                 extra_args=None):
+                 extra_args=None,
+                 ideal_dcg_feature_name=None):
   """Makes a loss function using a single loss or multiple losses.
 
+  The losses keep static shapes: invalid items and lists without any relevant
+  item are masked out by zero weights instead of being removed, with the same
+  results. So the loss functions can be compiled with XLA, except for the
+  `sparse_pairs` and `num_sampled_pairs` options of the pairwise losses and the
+  sampled softmax loss.
+
+  The pairwise and ApproxNDCG losses compare all the pairs of items, which takes
+  O(list_size^2) memory per list. On lists with thousands of items,
+  `extra_args={'block_size': block_size}` computes them over tiles of
+  `block_size` rows of pairs instead, so that every loss key takes
+  O(block_size * list_size) memory or less per list. The same holds for
+  `metrics.make_ranking_metric_fn` with `block_size`.
+
   Args:
     loss_keys: A string or list of strings representing loss keys defined in
       `RankingLossKey`. Listed loss functions will be combined in a weighted
@@ -67,13 +109,24 @@ def make_loss_fn(loss_keys,
       `features` dict.
     lambda_weight: A `_LambdaWeight` object created by factory methods like
       `create_ndcg_lambda_weight()`.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the loss function returns the per-list
+      losses with shape [batch_size], i.e., the weighted sums of the losses in
+      each list, which sum up to the loss with `SUM`.
     name: A string used as the name for this loss.
     seed: A randomization seed used in computation of some loss functions such
-      as ListMLE and pListMLE.
+      as ListMLE, pListMLE and the sampled pairwise losses.
     extra_args: A string-keyed dictionary that contains any other loss-specific
-      arguments.
+      arguments, e.g., `block_size`, `lambda_gradients`, `sparse_pairs`,
+      `unsorted_pairs` or `num_sampled_pairs` and `pair_sampling` for the
+      pairwise losses, `num_sampled_negatives` and `negative_sampling` for the
+      sampled softmax loss, or `topn` for the ListMLE and ApproxNDCG losses.
+      Each argument is only passed to the losses that accept it.
+    ideal_dcg_feature_name: A string specifying the name of the context feature
+      in `features` with the precomputed max DCG of each list, e.g., from
+      `data.compute_ideal_dcg`. When the feature is present, the ApproxNDCG
+      loss and a normalized `DCGLambdaWeight` use it instead of sorting the
+      labels. It must match their gain, discount and topn.
 
   Returns:
     A function _loss_fn(). See `_loss_fn()` for its signature.
@@ -83,8 +136,7 @@ def make_loss_fn(loss_keys,
     ValueError: If `loss_keys` is None or empty.
     ValueError: If `loss_keys` and `loss_weights` have different sizes.
   """
-  if (reduction not in tf.compat.v1.losses.Reduction.all() or
-      reduction == tf.compat.v1.losses.Reduction.NONE):
+  if reduction not in tf.compat.v1.losses.Reduction.all():
     raise ValueError('Invalid reduction: {}'.format(reduction))
 
   if not loss_keys:
@@ -115,38 +167,52 @@ def make_loss_fn(loss_keys,
       ValueError: If `loss_keys` is invalid.
     """
     weights = features[weights_feature_name] if weights_feature_name else None
+    ideal_dcg = (
+        features.get(ideal_dcg_feature_name)
+        if ideal_dcg_feature_name else None)
+    labels, logits, weights = _to_float32(labels, logits, weights)
     loss_kwargs = {
         'labels': labels,
         'logits': logits,
         'weights': weights,
         'reduction': reduction,
         'name': name,
+        # The sorting and the masks are computed once for all the losses.
+        'context': _LossContext(labels, logits, weights),
     }
-    if extra_args is not None:
-      loss_kwargs.update(extra_args)
 
     loss_kwargs_with_lambda_weight = loss_kwargs.copy()
     loss_kwargs_with_lambda_weight['lambda_weight'] = lambda_weight
+    if ideal_dcg is not None and isinstance(lambda_weight, DCGLambdaWeight):
+      loss_kwargs_with_lambda_weight['lambda_weight'] = (
+          lambda_weight.with_ideal_dcg(ideal_dcg))
 
     loss_kwargs_with_lambda_weight_and_seed = (
         loss_kwargs_with_lambda_weight.copy())
     loss_kwargs_with_lambda_weight_and_seed['seed'] = seed
 
+    loss_kwargs_with_ideal_dcg = loss_kwargs.copy()
+    loss_kwargs_with_ideal_dcg['ideal_dcg'] = ideal_dcg
+
     key_to_fn = {
-        RankingLossKey.PAIRWISE_HINGE_LOSS: (_pairwise_hinge_loss,
-                                             loss_kwargs_with_lambda_weight),
-        RankingLossKey.PAIRWISE_LOGISTIC_LOSS: (_pairwise_logistic_loss,
-                                                loss_kwargs_with_lambda_weight),
+        RankingLossKey.PAIRWISE_HINGE_LOSS: (
+            _pairwise_hinge_loss, loss_kwargs_with_lambda_weight_and_seed),
+        RankingLossKey.PAIRWISE_LOGISTIC_LOSS: (
+            _pairwise_logistic_loss, loss_kwargs_with_lambda_weight_and_seed),
         RankingLossKey.PAIRWISE_SOFT_ZERO_ONE_LOSS: (
-            _pairwise_soft_zero_one_loss, loss_kwargs_with_lambda_weight),
+            _pairwise_soft_zero_one_loss,
+            loss_kwargs_with_lambda_weight_and_seed),
         RankingLossKey.SOFTMAX_LOSS: (_softmax_loss,
                                       loss_kwargs_with_lambda_weight),
+        RankingLossKey.SAMPLED_SOFTMAX_LOSS: (
+            _sampled_softmax_loss, loss_kwargs_with_lambda_weight_and_seed),
         RankingLossKey.SIGMOID_CROSS_ENTROPY_LOSS: (_sigmoid_cross_entropy_loss,
                                                     loss_kwargs),
         RankingLossKey.MEAN_SQUARED_LOSS: (_mean_squared_loss, loss_kwargs),
         RankingLossKey.LIST_MLE_LOSS: (_list_mle_loss,
                                        loss_kwargs_with_lambda_weight_and_seed),
-        RankingLossKey.APPROX_NDCG_LOSS: (_approx_ndcg_loss, loss_kwargs),
+        RankingLossKey.APPROX_NDCG_LOSS: (_approx_ndcg_loss,
+                                          loss_kwargs_with_ideal_dcg),
     }
 
     # Obtain the list of loss ops.
@@ -155,6 +221,14 @@ def make_loss_fn(loss_keys,
       if loss_key not in key_to_fn:
         raise ValueError('Invalid loss_key: {}.'.format(loss_key))
       loss_fn, kwargs = key_to_fn[loss_key]
+      if extra_args is not None:
+        loss_fn_args = function_utils.fn_args(loss_fn)
+        kwargs = kwargs.copy()
+        kwargs.update({
+            arg: value
+            for arg, value in extra_args.items()
+            if arg in loss_fn_args
+        })
       loss_ops.append(loss_fn(**kwargs))
 
     # Compute weighted combination of losses.
@@ -170,12 +244,28 @@ def make_loss_fn(loss_keys,
   return _loss_fn
 
 
+def _inverse_rank_discount(rank):
+  """Returns 1 / rank for a NumPy array or a `Tensor` of ranks."""
+  return 1. / rank
+
+
+def _log1p_rank_discount(rank):
+  """Returns 1 / log(1 + rank) for a NumPy array or a `Tensor` of ranks."""
+  if isinstance(rank, np.ndarray):
+    return 1. / np.log1p(rank)
+  return 1. / tf.math.log1p(rank)
+
+
+# The rank discount functions that also take NumPy arrays of ranks.
+_NUMPY_RANK_DISCOUNT_FNS = (_inverse_rank_discount, _log1p_rank_discount)
+
+
 def create_ndcg_lambda_weight(topn=None, smooth_fraction=0.):
   """Creates _LambdaWeight for NDCG metric."""
   return DCGLambdaWeight(
       topn,
       gain_fn=lambda labels: tf.pow(2.0, labels) - 1.,
-      rank_discount_fn=lambda rank: 1. / tf.math.log1p(rank),
+      rank_discount_fn=_log1p_rank_discount,
       normalized=True,
       smooth_fraction=smooth_fraction)
 
@@ -185,7 +275,7 @@ def create_reciprocal_rank_lambda_weight(topn=None, smooth_fraction=0.):
   return DCGLambdaWeight(
       topn,
       gain_fn=lambda labels: labels,
-      rank_discount_fn=lambda rank: 1. / rank,
+      rank_discount_fn=_inverse_rank_discount,
       normalized=True,
       smooth_fraction=smooth_fraction)
 
@@ -207,6 +297,68 @@ def create_p_list_mle_lambda_weight(list_size):
       rank_discount_fn=lambda rank: tf.pow(2., list_size - rank) - 1.)
 
 
+def _gather_per_list(values, indices):
+  """Gathers the entries of each list at the given positions.
+
+  Args:
+    values: A `Tensor` with shape [batch_size, list_size].
+    indices: An int `Tensor` of positions in [0, list_size) with shape
+      [batch_size, ...] or [1, ...] to use the same positions for all lists.
+
+  Returns:
+    A `Tensor` with the shape of `indices` broadcast to batch_size, where the
+    entry [b, ...] is values[b, indices[b, ...]].
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=values))
+  indices_rank = indices.get_shape().ndims
+  list_offsets = tf.reshape(
+      tf.range(batch_size) * list_size, [-1] + [1] * (indices_rank - 1))
+  return tf.gather(tf.reshape(values, [-1]), indices + list_offsets)
+
+
+def _num_greater_in_sorted(sorted_values):
+  """Counts the values greater than each value of lists in descending order.
+
+  The tied values of a list are consecutive and share the position of the first
+  of them, which is the number of greater values.
+
+  Args:
+    sorted_values: A `Tensor` with shape [batch_size, list_size] sorted in
+      descending order along the lists.
+
+  Returns:
+    A float `Tensor` with the shape of `sorted_values`.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=sorted_values))
+  positions = tf.range(list_size)
+  previous_values = tf.gather(
+      sorted_values, tf.maximum(positions - 1, 0), axis=1)
+  is_first = tf.logical_or(
+      tf.equal(tf.expand_dims(positions, 0), 0),
+      tf.less(sorted_values, previous_values))
+  # The ties of all lists are numbered from 0 in list order.
+  ties = tf.cumsum(tf.cast(tf.reshape(is_first, [-1]), dtype=tf.int32)) - 1
+  first_positions = tf.math.unsorted_segment_min(
+      tf.tile(positions, [batch_size]), ties, batch_size * list_size)
+  return tf.cast(
+      tf.reshape(tf.gather(first_positions, ties), [batch_size, list_size]),
+      dtype=tf.float32)
+
+
+def _all_pairs(sorted_labels):
+  """Returns the (rows, cols) positions of all pairs in a list.
+
+  Args:
+    sorted_labels: A `Tensor` with shape [batch_size, list_size].
+
+  Returns:
+    A tuple of int `Tensor`s with shape [1, list_size, 1] and [1, 1, list_size]
+    that broadcast to all [list_size, list_size] pairs.
+  """
+  positions = tf.range(tf.shape(input=sorted_labels)[1])
+  return tf.reshape(positions, [1, -1, 1]), tf.reshape(positions, [1, 1, -1])
+
+
 class _LambdaWeight(object):
   """Interface for ranking metric optimization.
 
@@ -218,13 +370,36 @@ class _LambdaWeight(object):
 
   __metaclass__ = abc.ABCMeta
 
-  def _get_valid_pairs_and_clean_labels(self, sorted_labels):
-    """Returns a boolean Tensor for valid pairs and cleaned labels."""
-    sorted_labels = tf.convert_to_tensor(value=sorted_labels)
+  def __init__(self):
+    """Constructor."""
+    # The precomputed rank discount tables keyed by list_size, or None for the
+    # list sizes that have no table.
+    self._rank_pair_tables = {}
+
+  def _get_valid_pairs_and_clean_labels(self, sorted_labels, rows=None,
+                                        cols=None):
+    """Returns a boolean Tensor for valid pairs and cleaned labels.
+
+    Args:
+      sorted_labels: A dense `Tensor` of labels with shape [batch_size,
+        list_size] that are sorted by logits.
+      rows: An optional int `Tensor` of positions, see `_pair_weights_at`.
+      cols: An optional int `Tensor` of positions, see `_pair_weights_at`.
+
+    Returns:
+      A tuple of the pair validity for all pairs, or for the pairs (rows, cols)
+      if given, and the labels with invalid ones set to 0.
+    """
+    sorted_labels = tf.cast(sorted_labels, dtype=tf.float32)
     sorted_labels.get_shape().assert_has_rank(2)
     is_label_valid = utils.is_label_valid(sorted_labels)
-    valid_pairs = tf.logical_and(
-        tf.expand_dims(is_label_valid, 2), tf.expand_dims(is_label_valid, 1))
+    if rows is None:
+      valid_pairs = tf.logical_and(
+          tf.expand_dims(is_label_valid, 2), tf.expand_dims(is_label_valid, 1))
+    else:
+      valid_pairs = tf.logical_and(
+          utils.is_label_valid(_gather_per_list(sorted_labels, rows)),
+          utils.is_label_valid(_gather_per_list(sorted_labels, cols)))
     sorted_labels = tf.where(is_label_valid, sorted_labels,
                              tf.zeros_like(sorted_labels))
     return valid_pairs, sorted_labels
@@ -242,6 +417,105 @@ class _LambdaWeight(object):
     """
     raise NotImplementedError('Calling an abstract method.')
 
+  def _pair_weights_at(self, sorted_labels, rows, cols):
+    """Returns the pair weights of the pairs (rows, cols) only.
+
+    This allows the pairwise losses to work on a subset of the pairs, e.g., a
+    tile of rows of the [list_size, list_size] pair matrix, without creating
+    the pair weights for all pairs. Subclasses should override this to avoid
+    the default, which gathers from the full `pair_weights`.
+
+    Args:
+      sorted_labels: A dense `Tensor` of labels with shape [batch_size,
+        list_size] that are sorted by logits.
+      rows: An int `Tensor` of 0-based positions of the first item of the
+        pairs, with shape [batch_size, ...] or [1, ...].
+      cols: An int `Tensor` of 0-based positions of the second item of the
+        pairs, broadcastable with `rows`.
+
+    Returns:
+      A `Tensor` with the broadcast shape of `rows` and `cols` (with the
+      batch_size as the first dimension) for the weights of the pairs.
+    """
+    pair_weights = self.pair_weights(sorted_labels)
+    list_size = tf.shape(input=sorted_labels)[1]
+    return _gather_per_list(
+        tf.reshape(pair_weights, [tf.shape(input=sorted_labels)[0], -1]),
+        rows * list_size + cols)
+
+  def _with_list_constants(self, sorted_labels):
+    """Returns a lambda weight with the per-list constants of the labels bound.
+
+    The blocked losses call `_pair_weights_at` once per tile. Constants that
+    depend on a whole list, e.g., the max DCG, are computed here once instead.
+
+    Args:
+      sorted_labels: A dense `Tensor` of labels with shape [batch_size,
+        list_size] that are sorted by logits.
+
+    Returns:
+      A `_LambdaWeight` with the same pair weights for `sorted_labels`.
+    """
+    del sorted_labels  # Unused.
+    return self
+
+  def _rank_pair_discount(self, row_rank, col_rank, list_size):
+    """Returns the part of the pair weights that only depends on the ranks.
+
+    Args:
+      row_rank: An int `Tensor` of 1-based ranks of the first items of pairs.
+      col_rank: An int `Tensor` of 1-based ranks of the second items of pairs,
+        broadcastable with `row_rank`.
+      list_size: A scalar int (`Tensor`) for the list size.
+
+    Returns:
+      A float `Tensor` with the broadcast shape of `row_rank` and `col_rank`.
+    """
+    raise NotImplementedError('Calling an abstract method.')
+
+  def _rank_pair_table(self, list_size):
+    """Returns `_rank_pair_discount` of all pairs as a NumPy array.
+
+    Args:
+      list_size: (int) The static list size.
+
+    Returns:
+      A float32 NumPy array with shape [list_size, list_size] for the 0-based
+      positions of the pairs, or None when it cannot be computed outside of the
+      graph, e.g., when a rank discount function uses the caller's `Tensor`s.
+    """
+    del list_size  # Unused.
+    return None
+
+  def _rank_pair_discount_at(self, sorted_labels, rows, cols):
+    """Returns `_rank_pair_discount` for the pairs (rows, cols).
+
+    The rank discounts only depend on the list size and the lambda weight
+    parameters. When the list size is static, they are computed once in NumPy
+    into a [list_size, list_size] table cached by list size, so that a step
+    only gathers from the table instead of rebuilding the discounts from the
+    ranks. Unknown or large list sizes compute them in the graph.
+
+    Args:
+      sorted_labels: A dense `Tensor` of labels with shape [batch_size,
+        list_size] that are sorted by logits.
+      rows: An int `Tensor` of positions, see `_pair_weights_at`.
+      cols: An int `Tensor` of positions, see `_pair_weights_at`.
+
+    Returns:
+      A float `Tensor` with the broadcast shape of `rows` and `cols`.
+    """
+    list_size = tf.compat.dimension_value(sorted_labels.get_shape()[1])
+    if list_size is not None and list_size <= _MAX_RANK_TABLE_LIST_SIZE:
+      if list_size not in self._rank_pair_tables:
+        self._rank_pair_tables[list_size] = self._rank_pair_table(list_size)
+      table = self._rank_pair_tables[list_size]
+      if table is not None:
+        return tf.gather(
+            tf.constant(table.reshape([-1])), rows * list_size + cols)
+    return self._rank_pair_discount(rows + 1, cols + 1,
+                                    tf.shape(input=sorted_labels)[1])
+
   def individual_weights(self, sorted_labels):
     """Returns the weight `Tensor` for individual examples.
 
@@ -261,7 +535,7 @@ class DCGLambdaWeight(_LambdaWeight):
   def __init__(self,
                topn=None,
                gain_fn=lambda label: label,
-               rank_discount_fn=lambda rank: 1. / rank,
+               rank_discount_fn=_inverse_rank_discount,
                normalized=False,
                smooth_fraction=0.):
     """Constructor.
@@ -284,6 +558,7 @@ class DCGLambdaWeight(_LambdaWeight):
       smooth_fraction: (float) parameter to control the contribution from
         LambdaMART.
     """
+    super(DCGLambdaWeight, self).__init__()
     self._topn = topn
     self._gain_fn = gain_fn
     self._rank_discount_fn = rank_discount_fn
@@ -291,86 +566,184 @@ class DCGLambdaWeight(_LambdaWeight):
     assert 0. <= smooth_fraction and smooth_fraction <= 1., (
         'smooth_fraction %s should be in range [0, 1].' % smooth_fraction)
     self._smooth_fraction = smooth_fraction
+    self._ideal_dcg = None
+
+  def with_ideal_dcg(self, ideal_dcg):
+    """Returns a copy that normalizes by a precomputed max DCG.
+
+    Args:
+      ideal_dcg: A `Tensor` with shape [batch_size] or [batch_size, 1] for the
+        max DCG of each list, computed with the same gain, discount and topn.
+
+    Returns:
+      A `DCGLambdaWeight` that does not sort the labels for the max DCG.
+    """
+    lambda_weight = copy.copy(self)
+    lambda_weight._ideal_dcg = ideal_dcg  # pylint: disable=protected-access
+    return lambda_weight
 
   def pair_weights(self, sorted_labels):
+    """See `_LambdaWeight`."""
+    return self._pair_weights_at(sorted_labels, *_all_pairs(sorted_labels))
+
+  def _with_list_constants(self, sorted_labels):
+    """See `_LambdaWeight`."""
+    if not self._normalized or self._ideal_dcg is not None:
+      return self
+    with tf.name_scope(name='dcg_lambda_weight'):
+      labels = tf.cast(sorted_labels, dtype=tf.float32)
+      labels = tf.where(
+          utils.is_label_valid(labels), labels, tf.zeros_like(labels))
+      inverse_max_dcg = utils.inverse_max_dcg(
+          labels, gain_fn=self._gain_fn,
+          rank_discount_fn=self._rank_discount_fn, topn=self._topn)
+      return self.with_ideal_dcg(
+          tf.where(
+              tf.greater(inverse_max_dcg, 0.), 1. / inverse_max_dcg,
+              tf.zeros_like(inverse_max_dcg)))
+
+  def _pair_weights_at(self, sorted_labels, rows, cols):
     """See `_LambdaWeight`."""
     with tf.name_scope(name='dcg_lambda_weight'):
       valid_pair, sorted_labels = self._get_valid_pairs_and_clean_labels(
-          sorted_labels)
+          sorted_labels, rows, cols)
       gain = self._gain_fn(sorted_labels)
       if self._normalized:
         gain *= utils.inverse_max_dcg(
             sorted_labels, gain_fn=self._gain_fn,
-            rank_discount_fn=self._rank_discount_fn, topn=self._topn)
-      pair_gain = tf.expand_dims(gain, 2) - tf.expand_dims(gain, 1)
+            rank_discount_fn=self._rank_discount_fn, topn=self._topn,
+            ideal_dcg=self._ideal_dcg)
+      pair_gain = _gather_per_list(gain, rows) - _gather_per_list(gain, cols)
       pair_gain *= tf.cast(valid_pair, dtype=tf.float32)
+      return tf.abs(pair_gain) * self._rank_pair_discount_at(
+          sorted_labels, rows, cols)
 
-      list_size = tf.shape(input=sorted_labels)[1]
-      topn = self._topn or list_size
-      rank = tf.range(list_size) + 1
-
-      def _discount_for_relative_rank_diff():
-        """Rank-based discount in the LambdaLoss paper."""
-        # The LambdaLoss is not well defined when topn is active and topn <
-        # list_size. We cap the rank of examples to topn + 1 so that the rank
-        # differene is capped to topn. This is just a convenient upperbound
-        # when topn is active. We need to revisit this.
-        capped_rank = tf.where(
+  def _rank_pair_discount(self, row_rank, col_rank, list_size):
+    """See `_LambdaWeight`."""
+    topn = self._topn or list_size
+
+    def _discount_for_relative_rank_diff():
+      """Rank-based discount in the LambdaLoss paper."""
+      # The LambdaLoss is not well defined when topn is active and topn <
+      # list_size. We cap the rank of examples to topn + 1 so that the rank
+      # differene is capped to topn. This is just a convenient upperbound
+      # when topn is active. We need to revisit this.
+      def _capped_rank(rank):
+        return tf.where(
             tf.greater(rank, topn),
             tf.ones_like(rank) * (topn + 1), rank)
-        rank_diff = tf.cast(
-            tf.abs(
-                tf.expand_dims(capped_rank, 1) -
-                tf.expand_dims(capped_rank, 0)),
-            dtype=tf.float32)
-        pair_discount = tf.where(
-            tf.greater(rank_diff, 0),
-            tf.abs(
-                self._rank_discount_fn(rank_diff) -
-                self._rank_discount_fn(rank_diff + 1)),
-            tf.zeros_like(rank_diff))
-        return pair_discount
-
-      def _discount_for_absolute_rank():
-        """Standard discount in the LambdaMART paper."""
-        # When the rank discount is (1 / rank) for example, the discount is
-        # |1 / r_i - 1 / r_j|. When i or j > topn, the discount becomes 0.
-        rank_discount = tf.where(
+
+      rank_diff = tf.cast(
+          tf.abs(_capped_rank(row_rank) - _capped_rank(col_rank)),
+          dtype=tf.float32)
+      pair_discount = tf.where(
+          tf.greater(rank_diff, 0),
+          tf.abs(
+              self._rank_discount_fn(rank_diff) -
+              self._rank_discount_fn(rank_diff + 1)),
+          tf.zeros_like(rank_diff))
+      return pair_discount
+
+    def _discount_for_absolute_rank():
+      """Standard discount in the LambdaMART paper."""
+      # When the rank discount is (1 / rank) for example, the discount is
+      # |1 / r_i - 1 / r_j|. When i or j > topn, the discount becomes 0.
+      def _rank_discount(rank):
+        return tf.where(
             tf.greater(rank, topn),
             tf.zeros_like(tf.cast(rank, dtype=tf.float32)),
             self._rank_discount_fn(tf.cast(rank, dtype=tf.float32)))
-        pair_discount = tf.abs(
-            tf.expand_dims(rank_discount, 1) - tf.expand_dims(rank_discount, 0))
-        return pair_discount
-
-      u = _discount_for_relative_rank_diff()
-      v = _discount_for_absolute_rank()
-      pair_discount = (
-          1. - self._smooth_fraction) * u + self._smooth_fraction * v
-      pair_weight = tf.abs(pair_gain) * pair_discount
-      if self._topn is None:
-        return pair_weight
-      pair_mask = tf.logical_or(
-          tf.expand_dims(tf.less_equal(rank, self._topn), 1),
-          tf.expand_dims(tf.less_equal(rank, self._topn), 0))
-      return pair_weight * tf.cast(pair_mask, dtype=tf.float32)
+
+      pair_discount = tf.abs(
+          _rank_discount(row_rank) - _rank_discount(col_rank))
+      return pair_discount
+
+    u = _discount_for_relative_rank_diff()
+    v = _discount_for_absolute_rank()
+    pair_discount = (1. - self._smooth_fraction) * u + self._smooth_fraction * v
+    if self._topn is None:
+      return pair_discount
+    pair_mask = tf.logical_or(
+        tf.less_equal(row_rank, self._topn), tf.less_equal(col_rank,
+                                                           self._topn))
+    return pair_discount * tf.cast(pair_mask, dtype=tf.float32)
+
+  def _rank_pair_table(self, list_size):
+    """See `_LambdaWeight`."""
+    # The rank discounts at the ranks 1, ..., list_size + 1.
+    discounts = self._numpy_rank_discounts(
+        np.arange(1, list_size + 2, dtype=np.float32))
+    if discounts is None:
+      return None
+    ranks = np.arange(1, list_size + 1)
+    topn = self._topn or list_size
+    # See `_rank_pair_discount` for the two discounts.
+    capped_ranks = np.minimum(ranks, topn + 1)
+    rank_diff = np.abs(capped_ranks[:, None] - capped_ranks[None, :])
+    u = np.where(rank_diff > 0,
+                 np.abs(discounts[rank_diff - 1] - discounts[rank_diff]), 0.)
+    rank_discount = np.where(ranks > topn, 0., discounts[ranks - 1])
+    v = np.abs(rank_discount[:, None] - rank_discount[None, :])
+    table = (1. - self._smooth_fraction) * u + self._smooth_fraction * v
+    if self._topn is not None:
+      in_topn = ranks <= self._topn
+      table *= np.logical_or(in_topn[:, None], in_topn[None, :])
+    return table.astype(np.float32)
+
+  def _numpy_rank_discounts(self, ranks):
+    """Returns `rank_discount_fn` of the ranks as a NumPy array.
+
+    The known NumPy rank discount functions are called on the ranks directly.
+    Other functions are evaluated in a separate graph, so that the caller's
+    graph does not get extra ops.
+
+    Args:
+      ranks: A float32 NumPy array of 1-based ranks.
+
+    Returns:
+      A float32 NumPy array of the shape of `ranks`, or None if the function
+      cannot be evaluated outside of the caller's graph, e.g., when it uses the
+      caller's `Tensor`s.
+    """
+    if self._rank_discount_fn in _NUMPY_RANK_DISCOUNT_FNS:
+      return np.asarray(self._rank_discount_fn(ranks), dtype=np.float32)
+    try:
+      with tf.Graph().as_default():
+        discounts = self._rank_discount_fn(tf.constant(ranks))
+        with tf.compat.v1.Session() as sess:
+          return np.asarray(sess.run(discounts), dtype=np.float32)
+    except (TypeError, ValueError):
+      return None
 
   def individual_weights(self, sorted_labels):
     """See `_LambdaWeight`."""
+    ranks = tf.cast(
+        tf.range(tf.shape(input=sorted_labels)[1]) + 1, dtype=tf.float32)
+    return self._individual_weights_at(sorted_labels, ranks)
+
+  def _individual_weights_at(self, labels, ranks):
+    """Returns the individual weights of items at the given ranks.
+
+    Args:
+      labels: A dense `Tensor` of labels with shape [batch_size, num_items], in
+        any order. When normalized, every item with a nonzero gain in a list
+        must be included for the max DCG.
+      ranks: A float `Tensor` of 1-based ranks broadcastable with `labels`.
+
+    Returns:
+      A `Tensor` of the same shape as `labels`.
+    """
     with tf.name_scope(name='dcg_lambda_weight'):
-      sorted_labels = tf.convert_to_tensor(value=sorted_labels)
-      sorted_labels = tf.where(
-          utils.is_label_valid(sorted_labels), sorted_labels,
-          tf.zeros_like(sorted_labels))
-      gain = self._gain_fn(sorted_labels)
+      labels = tf.cast(labels, dtype=tf.float32)
+      labels = tf.where(
+          utils.is_label_valid(labels), labels, tf.zeros_like(labels))
+      gain = self._gain_fn(labels)
       if self._normalized:
         gain *= utils.inverse_max_dcg(
-            sorted_labels, gain_fn=self._gain_fn,
-            rank_discount_fn=self._rank_discount_fn, topn=self._topn)
-      rank_discount = self._rank_discount_fn(
-          tf.cast(
-              tf.range(tf.shape(input=sorted_labels)[1]) + 1, dtype=tf.float32))
-      return gain * rank_discount
+            labels, gain_fn=self._gain_fn,
+            rank_discount_fn=self._rank_discount_fn, topn=self._topn,
+            ideal_dcg=self._ideal_dcg)
+      return gain * self._rank_discount_fn(ranks)
 
 
 class PrecisionLambdaWeight(_LambdaWeight):
@@ -386,6 +759,7 @@ class PrecisionLambdaWeight(_LambdaWeight):
       positive_fn: (function): A function on `Tensor` that output boolean True
         for positive examples. The rest are negative examples.
     """
+    super(PrecisionLambdaWeight, self).__init__()
     self._topn = topn
     self._positive_fn = positive_fn
 
@@ -406,22 +780,37 @@ class PrecisionLambdaWeight(_LambdaWeight):
     Returns:
       A `Tensor` that can weight example pairs.
     """
+    return self._pair_weights_at(sorted_labels, *_all_pairs(sorted_labels))
+
+  def _pair_weights_at(self, sorted_labels, rows, cols):
+    """See `_LambdaWeight`."""
     with tf.name_scope(name='precision_lambda_weight'):
       valid_pair, sorted_labels = self._get_valid_pairs_and_clean_labels(
-          sorted_labels)
+          sorted_labels, rows, cols)
       binary_labels = tf.cast(
           self._positive_fn(sorted_labels), dtype=tf.float32)
       label_diff = tf.abs(
-          tf.expand_dims(binary_labels, 2) - tf.expand_dims(binary_labels, 1))
+          _gather_per_list(binary_labels, rows) -
+          _gather_per_list(binary_labels, cols))
       label_diff *= tf.cast(valid_pair, dtype=tf.float32)
-      # i <= topn and j > topn or i > topn and j <= topn, i.e., xor(i <= topn, j
-      # <= topn).
-      list_size = tf.shape(input=sorted_labels)[1]
-      rank = tf.range(list_size) + 1
-      rank_mask = tf.math.logical_xor(
-          tf.expand_dims(tf.less_equal(rank, self._topn), 1),
-          tf.expand_dims(tf.less_equal(rank, self._topn), 0))
-      return label_diff * tf.cast(rank_mask, dtype=tf.float32)
+      return label_diff * self._rank_pair_discount_at(sorted_labels, rows,
+                                                      cols)
+
+  def _rank_pair_discount(self, row_rank, col_rank, list_size):
+    """See `_LambdaWeight`."""
+    del list_size  # Unused.
+    # i <= topn and j > topn or i > topn and j <= topn, i.e., xor(i <= topn, j
+    # <= topn).
+    rank_mask = tf.math.logical_xor(
+        tf.less_equal(row_rank, self._topn),
+        tf.less_equal(col_rank, self._topn))
+    return tf.cast(rank_mask, dtype=tf.float32)
+
+  def _rank_pair_table(self, list_size):
+    """See `_LambdaWeight`."""
+    in_topn = np.arange(1, list_size + 1) <= self._topn
+    return np.logical_xor(in_topn[:, None],
+                          in_topn[None, :]).astype(np.float32)
 
 
 class ListMLELambdaWeight(_LambdaWeight):
@@ -435,6 +824,7 @@ class ListMLELambdaWeight(_LambdaWeight):
     Args:
       rank_discount_fn: (function) The rank discount function.
     """
+    super(ListMLELambdaWeight, self).__init__()
     self._rank_discount_fn = rank_discount_fn
 
   def pair_weights(self, sorted_labels):
@@ -444,14 +834,119 @@ class ListMLELambdaWeight(_LambdaWeight):
   def individual_weights(self, sorted_labels):
     """See `_LambdaWeight`."""
     with tf.name_scope(name='p_list_mle_lambda_weight'):
-      sorted_labels = tf.convert_to_tensor(value=sorted_labels)
+      sorted_labels = tf.cast(sorted_labels, dtype=tf.float32)
       rank_discount = self._rank_discount_fn(
           tf.cast(
               tf.range(tf.shape(input=sorted_labels)[1]) + 1, dtype=tf.float32))
       return tf.ones_like(sorted_labels) * rank_discount
 
 
-def _sort_and_normalize(labels, logits, weights=None):
+def _to_float32(labels, logits, weights=None):
+  """Casts the inputs of a loss to float32.
+
+  The losses take low-precision logits, e.g., float16 or bfloat16 from a mixed
+  precision network, but compute in float32: the exponentials, sigmoids and
+  cumulative sums as well as the constants such as log(_EPSILON) do not fit
+  half precision. The gradients are cast back to the dtype of `logits`.
+
+  Args:
+    labels: A `Tensor` or a value convertible to one.
+    logits: A `Tensor` or a value convertible to one.
+    weights: An optional `Tensor` or a value convertible to one.
+
+  Returns:
+    A tuple of (labels, logits, weights) in float32, with weights None if it was
+    None.
+  """
+  labels = tf.cast(labels, dtype=tf.float32)
+  logits = tf.cast(logits, dtype=tf.float32)
+  if weights is not None:
+    weights = tf.cast(weights, dtype=tf.float32)
+  return labels, logits, weights
+
+
+class _LossContext(object):
+  """Preprocessing of `labels`, `logits` and `weights` shared by losses.
+
+  Each of the preprocessed `Tensor`s is created on first use and then reused,
+  so that the losses combined by `make_loss_fn` sort the lists and build the
+  label masks only once. A loss that is called without a context creates its
+  own.
+  """
+
+  def __init__(self, labels, logits, weights=None):
+    """Constructor.
+
+    Args:
+      labels: A `Tensor` of the same shape as `logits` representing graded
+        relevance.
+      logits: A `Tensor` with shape [batch_size, list_size]. Each value is the
+        ranking score of the corresponding item.
+      weights: A scalar, a `Tensor` with shape [batch_size, 1], or a `Tensor`
+        with the same shape as `labels`.
+    """
+    self._labels = labels
+    self._logits = logits
+    self._weights = weights
+    self._cache = {}
+
+  def _get(self, key, fn):
+    """Returns the cached `fn()` for `key`."""
+    if key not in self._cache:
+      self._cache[key] = fn()
+    return self._cache[key]
+
+  def _ranking_context(self):
+    """Returns the entered `utils.RankingContext` for `labels` and `logits`.
+
+    Its mask and sort are reused instead of computing them for the losses.
+    """
+    return utils.RankingContext.get(self._labels, self._logits)
+
+  def is_label_valid(self):
+    """Returns the boolean mask of the valid `labels`."""
+
+    def _is_label_valid():
+      ranking_context = self._ranking_context()
+      if ranking_context is not None:
+        return ranking_context.is_label_valid()
+      return utils.is_label_valid(self._labels)
+
+    return self._get('is_label_valid', _is_label_valid)
+
+  def sort_indices(self):
+    """Returns the output of `_sort_indices`."""
+
+    def _sort_indices_or_context():
+      ranking_context = self._ranking_context()
+      if ranking_context is not None:
+        return ranking_context.sort_indices()
+      return _sort_indices(self._labels, self._logits)
+
+    return self._get('sort_indices', _sort_indices_or_context)
+
+  def sort_and_normalize(self):
+    """Returns the output of `_sort_and_normalize`."""
+    return self._get(
+        'sort_and_normalize',
+        lambda: _sort_and_normalize(self._labels, self._logits, self._weights,
+                                    self.sort_indices()))
+
+  def sorted_is_label_valid(self):
+    """Returns the boolean mask of the valid sorted labels."""
+    return self._get(
+        'sorted_is_label_valid',
+        lambda: utils.is_label_valid(self.sort_and_normalize()[0]))
+
+  def sorted_positions(self):
+    """Returns the output of `_sorted_positions`."""
+    return self._get(
+        'sorted_positions',
+        lambda: _sorted_positions(self._labels, self._logits,
+                                  self.sort_indices()))
+
+
+def _sort_and_normalize(labels, logits, weights=None, indices=None):
   """Sorts `labels` and `logits` and normalize `weights`.
 
   Args:
@@ -461,6 +956,7 @@ def _sort_and_normalize(labels, logits, weights=None):
       ranking score of the corresponding item.
     weights: A scalar, a `Tensor` with shape [batch_size, 1], or a `Tensor` with
       the same shape as `labels`.
+    indices: An optional output of `_sort_indices` to reuse.
 
   Returns:
     A tuple of (sorted_labels, sorted_logits, sorted_weights).
@@ -471,15 +967,69 @@ def _sort_and_normalize(labels, logits, weights=None):
   logits.get_shape().assert_is_compatible_with(labels.get_shape())
   weights = 1.0 if weights is None else tf.convert_to_tensor(value=weights)
   weights = tf.ones_like(labels) * weights
-  topn = tf.shape(input=logits)[1]
+  if indices is None:
+    indices = _sort_indices(labels, logits)
+  return tuple(
+      _gather_per_list(tensor, indices) for tensor in [labels, logits, weights])
+
+
+def _sort_indices(labels, logits):
+  """Returns the indices that sort the lists by `logits`.
 
+  Args:
+    labels: A `Tensor` of the same shape as `logits` representing graded
+      relevance.
+    logits: A `Tensor` with shape [batch_size, list_size]. Each value is the
+      ranking score of the corresponding item.
+
+  Returns:
+    An int `Tensor` with shape [batch_size, list_size], where the entry [b, k]
+    is the index of the item at 0-based position k of the sorted list b. The
+    items with invalid labels are placed last.
+  """
+  labels = tf.convert_to_tensor(value=labels)
+  logits = tf.convert_to_tensor(value=logits)
   # Only sort entries with valid labels that are >= 0.
   scores = tf.where(
       tf.greater_equal(labels, 0.), logits, -1e-6 * tf.ones_like(logits) +
       tf.reduce_min(input_tensor=logits, axis=1, keepdims=True))
-  sorted_labels, sorted_logits, sorted_weights = utils.sort_by_scores(
-      scores, [labels, logits, weights], topn=topn)
-  return sorted_labels, sorted_logits, sorted_weights
+  _, indices = tf.nn.top_k(scores, tf.shape(input=logits)[1], sorted=True)
+  return indices
+
+
+def _sorted_positions(labels, logits, indices=None):
+  """Returns the sorted labels and the position of each item once sorted.
+
+  The lists are ordered as in `_sort_and_normalize`, but only the labels are
+  reordered. The positions are the inverse permutation of the sort, so that
+  quantities of the sorted lists, e.g., lambda weights, can be looked up for
+  the items in their original order. Nothing here is differentiable.
+
+  Args:
+    labels: A `Tensor` of the same shape as `logits` representing graded
+      relevance.
+    logits: A `Tensor` with shape [batch_size, list_size]. Each value is the
+      ranking score of the corresponding item.
+    indices: An optional output of `_sort_indices` to reuse.
+
+  Returns:
+    A tuple of (sorted_labels, positions), where positions is an int `Tensor`
+    with shape [batch_size, list_size] and sorted_labels[b, positions[b, i]] is
+    labels[b, i].
+  """
+  labels = tf.convert_to_tensor(value=labels)
+  logits = tf.convert_to_tensor(value=logits)
+  logits.get_shape().assert_has_rank(2)
+  logits.get_shape().assert_is_compatible_with(labels.get_shape())
+  if indices is None:
+    indices = _sort_indices(labels, logits)
+  batch_size, list_size = tf.unstack(tf.shape(input=indices))
+  batch_ids = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, list_size])
+  positions = tf.scatter_nd(
+      tf.stack([batch_ids, indices], axis=2),
+      tf.tile(tf.expand_dims(tf.range(list_size), 0), [batch_size, 1]),
+      tf.shape(input=indices))
+  return _gather_per_list(labels, indices), positions
 
 
 def _pairwise_comparison(sorted_labels,
@@ -526,21 +1076,109 @@ def _pairwise_comparison(sorted_labels,
   # Compute the difference for all pairs in a list. The output is a Tensor with
   # shape [batch_size, list_size, list_size] where the entry [-1, i, j] stores
   # the information for pair (i, j).
-  pairwise_label_diff = tf.expand_dims(sorted_labels, 2) - tf.expand_dims(
-      sorted_labels, 1)
-  pairwise_logits = tf.expand_dims(sorted_logits, 2) - tf.expand_dims(
-      sorted_logits, 1)
+  return _pairwise_comparison_at(sorted_labels, sorted_logits, sorted_weights,
+                                 *_all_pairs(sorted_labels),
+                                 lambda_weight=lambda_weight)
+
+
+def _pairwise_comparison_at(sorted_labels,
+                            sorted_logits,
+                            sorted_weights,
+                            rows,
+                            cols,
+                            lambda_weight=None):
+  """Returns pairwise comparison `Tensor`s for the pairs (rows, cols) only.
+
+  See `_pairwise_comparison` for the definitions. The pairs are given by the
+  0-based positions `rows` and `cols` in the sorted lists, which broadcast to
+  the shape of the outputs. For example, rows with shape [1, n, 1] and cols with
+  shape [1, 1, list_size] give a tile of n rows of the pair matrix.
+
+  Args:
+    sorted_labels: A `Tensor` with shape [batch_size, list_size] of labels
+      sorted.
+    sorted_logits: A `Tensor` with shape [batch_size, list_size] of logits
+      sorted.
+    sorted_weights: A `Tensor` with shape [batch_size, list_size] of item-wise
+      weights sorted.
+    rows: An int `Tensor` with shape [batch_size, ...] or [1, ...] for the
+      positions of item i in the pairs.
+    cols: An int `Tensor` broadcastable with `rows` for the positions of item j
+      in the pairs.
+    lambda_weight: A `_LambdaWeight` object.
+
+  Returns:
+    A tuple of (pairwise_labels, pairwise_logits, pairwise_weights) with each
+    having the broadcast shape of `rows` and `cols`.
+  """
+  row_labels = _gather_per_list(sorted_labels, rows)
+  col_labels = _gather_per_list(sorted_labels, cols)
+  pairwise_label_diff = row_labels - col_labels
+  pairwise_logits = (
+      _gather_per_list(sorted_logits, rows) -
+      _gather_per_list(sorted_logits, cols))
   pairwise_labels = tf.cast(
       tf.greater(pairwise_label_diff, 0), dtype=tf.float32)
-  is_label_valid = utils.is_label_valid(sorted_labels)
+  valid_pair = tf.logical_and(
+      utils.is_label_valid(row_labels), utils.is_label_valid(col_labels))
+  # Only keep the case when l_i > l_j.
+  pairwise_weights = pairwise_labels * tf.cast(valid_pair, dtype=tf.float32)
+  # Apply the item-wise weights along l_i.
+  pairwise_weights *= _gather_per_list(sorted_weights, rows)
+  if lambda_weight is not None:
+    pairwise_weights *= lambda_weight._pair_weights_at(  # pylint: disable=protected-access
+        sorted_labels, rows, cols)
+  else:
+    pairwise_weights *= tf.abs(pairwise_label_diff)
+  pairwise_weights = tf.stop_gradient(
+      pairwise_weights, name='weights_stop_gradient')
+  return pairwise_labels, pairwise_logits, pairwise_weights
+
+
+def _unsorted_pairwise_comparison(labels,
+                                  logits,
+                                  weights,
+                                  lambda_weight=None,
+                                  context=None):
+  """Returns pairwise comparison `Tensor`s for the items in their input order.
+
+  This is `_pairwise_comparison` without sorting the logits. The pair [b, i, j]
+  is for the items i and j of the input lists, and the lambda weights, which
+  depend on the sorted positions of the items, come from `_sorted_positions`
+  with no gradient. So the only differentiable ops are the pairwise logit
+  differences, and the backward pass has no gathers or scatters. As the
+  pairwise losses sum over all the pairs, the loss is the same as with sorted
+  inputs.
+
+  Args:
+    labels: A `Tensor` with shape [batch_size, list_size] of labels.
+    logits: A `Tensor` with shape [batch_size, list_size] of logits.
+    weights: A `Tensor` with shape [batch_size, list_size] of item-wise weights.
+    lambda_weight: A `_LambdaWeight` object.
+    context: An optional `_LossContext` for `labels` and `logits`.
+
+  Returns:
+    A tuple of (pairwise_labels, pairwise_logits, pairwise_weights) with each
+    having the shape [batch_size, list_size, list_size].
+  """
+  pairwise_label_diff = tf.expand_dims(labels, 2) - tf.expand_dims(labels, 1)
+  pairwise_logits = tf.expand_dims(logits, 2) - tf.expand_dims(logits, 1)
+  pairwise_labels = tf.cast(
+      tf.greater(pairwise_label_diff, 0), dtype=tf.float32)
+  is_label_valid = utils.is_label_valid(labels)
   valid_pair = tf.logical_and(
       tf.expand_dims(is_label_valid, 2), tf.expand_dims(is_label_valid, 1))
   # Only keep the case when l_i > l_j.
   pairwise_weights = pairwise_labels * tf.cast(valid_pair, dtype=tf.float32)
   # Apply the item-wise weights along l_i.
-  pairwise_weights *= tf.expand_dims(sorted_weights, 2)
+  pairwise_weights *= tf.expand_dims(weights, 2)
   if lambda_weight is not None:
-    pairwise_weights *= lambda_weight.pair_weights(sorted_labels)
+    if context is None:
+      context = _LossContext(labels, logits)
+    sorted_labels, positions = context.sorted_positions()
+    pairwise_weights *= lambda_weight._pair_weights_at(  # pylint: disable=protected-access
+        sorted_labels, tf.expand_dims(positions, 2),
+        tf.expand_dims(positions, 1))
   else:
     pairwise_weights *= tf.abs(pairwise_label_diff)
   pairwise_weights = tf.stop_gradient(
@@ -548,13 +1186,576 @@ def _pairwise_comparison(sorted_labels,
   return pairwise_labels, pairwise_logits, pairwise_weights
 
 
+def _reduction_denominator(weight_sum, num_nonzero_weights, num_elements,
+                           reduction):
+  """Returns what `compute_weighted_loss` divides the weighted loss sum by.
+
+  Args:
+    weight_sum: A scalar `Tensor` for the sum of the weights.
+    num_nonzero_weights: A scalar `Tensor` for the number of nonzero weights.
+    num_elements: A scalar `Tensor` for the number of losses.
+    reduction: One of `tf.losses.Reduction` except `NONE`.
+
+  Returns:
+    A scalar float `Tensor`.
+
+  Raises:
+    ValueError: If `reduction` is invalid.
+  """
+  if reduction == tf.compat.v1.losses.Reduction.SUM:
+    return tf.constant(1.)
+  elif reduction == tf.compat.v1.losses.Reduction.MEAN:
+    return weight_sum
+  elif reduction == tf.compat.v1.losses.Reduction.SUM_OVER_BATCH_SIZE:
+    return num_elements
+  elif reduction == tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS:
+    return num_nonzero_weights
+  raise ValueError('Invalid reduction: {}'.format(reduction))
+
+
+def _reduce_weighted_loss(weighted_losses, weight_sum, num_nonzero_weights,
+                          num_elements, reduction):
+  """Reduces the weighted losses like `compute_weighted_loss`.
+
+  Args:
+    weighted_losses: A `Tensor` with shape [batch_size, ...] of the losses
+      multiplied by their weights.
+    weight_sum: A scalar `Tensor` for the sum of the weights.
+    num_nonzero_weights: A scalar `Tensor` for the number of nonzero weights.
+    num_elements: A scalar `Tensor` for the number of losses.
+    reduction: One of `tf.losses.Reduction`.
+
+  Returns:
+    A scalar loss `Tensor`, or the per-list sums of `weighted_losses` with shape
+    [batch_size] for `NONE`.
+  """
+  if reduction == tf.compat.v1.losses.Reduction.NONE:
+    loss = tf.reduce_sum(
+        input_tensor=weighted_losses,
+        axis=list(range(1, weighted_losses.get_shape().ndims)))
+  else:
+    loss = tf.math.divide_no_nan(
+        tf.reduce_sum(input_tensor=weighted_losses),
+        _reduction_denominator(weight_sum, num_nonzero_weights, num_elements,
+                               reduction))
+  tf.compat.v1.losses.add_loss(loss)
+  return loss
+
+
+def _masked_weighted_loss(losses, weights, mask, reduction):
+  """Computes `compute_weighted_loss` over the entries of `losses` in `mask`.
+
+  The result is the same as `tf.losses.compute_weighted_loss` over
+  `tf.boolean_mask(losses, mask)` and the matching weights, but the entries out
+  of `mask` are zeroed out instead of removed. So all the shapes stay static,
+  e.g., for XLA compilation.
+
+  Args:
+    losses: A float `Tensor` of per-entry losses.
+    weights: A `Tensor` broadcastable to `losses`.
+    mask: A boolean `Tensor` of the same shape as `losses`.
+    reduction: One of `tf.losses.Reduction`.
+
+  Returns:
+    A scalar loss `Tensor`, or the per-list losses with shape [batch_size] for
+    `NONE`.
+  """
+  losses = tf.where(mask, losses, tf.zeros_like(losses))
+  weights = tf.ones_like(losses) * tf.cast(weights, dtype=losses.dtype)
+  weights = tf.where(mask, weights, tf.zeros_like(weights))
+  return _reduce_weighted_loss(
+      losses * weights, tf.reduce_sum(input_tensor=weights),
+      tf.reduce_sum(
+          input_tensor=tf.cast(tf.not_equal(weights, 0.), dtype=tf.float32)),
+      tf.reduce_sum(input_tensor=tf.cast(mask, dtype=tf.float32)), reduction)
+
+
+def _pairwise_loss_sums(loss_fn, loss_grad_fn, pairwise_logits,
+                        pairwise_weights):
+  """Returns the sums and the per-item gradients of a set of pairs.
+
+  Args:
+    loss_fn: A function that computes loss from the pairwise logits.
+    loss_grad_fn: The derivative of `loss_fn` w.r.t. the pairwise logits.
+    pairwise_logits: A `Tensor` with shape [batch_size, n, list_size] of s_i -
+      s_j for n rows i and all the columns j.
+    pairwise_weights: A `Tensor` of the same shape as `pairwise_logits`.
+
+  Returns:
+    A tuple of (weighted_sums, weight_sums, num_nonzero_weights, row_grads,
+    col_grads). The first three have shape [batch_size] and are the per-list
+    sums. row_grads with shape [batch_size, n] and col_grads with shape
+    [batch_size, list_size] are the sums of w_ij * loss'(s_i - s_j) over the
+    columns and over the rows respectively. As d(s_i - s_j)/ds_i = 1 and
+    d(s_i - s_j)/ds_j = -1, the gradient of the weighted sum w.r.t. the logits
+    is row_grads for the rows minus col_grads.
+  """
+  weighted_sums = tf.reduce_sum(
+      input_tensor=loss_fn(pairwise_logits) * pairwise_weights, axis=[1, 2])
+  weight_sums = tf.reduce_sum(input_tensor=pairwise_weights, axis=[1, 2])
+  num_nonzero_weights = tf.reduce_sum(
+      input_tensor=tf.cast(
+          tf.not_equal(pairwise_weights, 0.), dtype=tf.float32),
+      axis=[1, 2])
+  pair_grads = pairwise_weights * loss_grad_fn(pairwise_logits)
+  return (weighted_sums, weight_sums, num_nonzero_weights,
+          tf.reduce_sum(input_tensor=pair_grads, axis=2),
+          tf.reduce_sum(input_tensor=pair_grads, axis=1))
+
+
+def _reduce_pairwise_loss_sums(weighted_sums, weight_sums, num_nonzero_weights,
+                               lambdas, num_elements, reduction):
+  """Returns the reduced loss and its gradient function from per-list sums.
+
+  Args:
+    weighted_sums: A `Tensor` with shape [batch_size] of the weighted loss sums.
+    weight_sums: A `Tensor` with shape [batch_size] of the weight sums.
+    num_nonzero_weights: A `Tensor` with shape [batch_size] of the numbers of
+      nonzero weights.
+    lambdas: A `Tensor` with shape [batch_size, list_size] of the gradients of
+      the weighted loss sums w.r.t. the logits.
+    num_elements: A scalar `Tensor` for the number of losses.
+    reduction: One of `tf.losses.Reduction`.
+
+  Returns:
+    A tuple of the loss and its gradient function for `tf.custom_gradient`.
+  """
+  if reduction == tf.compat.v1.losses.Reduction.NONE:
+    return weighted_sums, lambda dy: tf.expand_dims(dy, 1) * lambdas
+  denominator = _reduction_denominator(
+      tf.reduce_sum(input_tensor=weight_sums),
+      tf.reduce_sum(input_tensor=num_nonzero_weights), num_elements, reduction)
+  lambdas = tf.math.divide_no_nan(lambdas, denominator)
+  return (tf.math.divide_no_nan(
+      tf.reduce_sum(input_tensor=weighted_sums), denominator),
+          lambda dy: dy * lambdas)
+
+
+def _lambda_pairwise_loss(loss_fn, loss_grad_fn, sorted_labels, sorted_logits,
+                          sorted_weights, lambda_weight, reduction):
+  """Computes the pairwise loss with the per-item gradients in the forward pass.
+
+  The gradient of the loss w.r.t. an item's logit is its lambda, i.e.,
+  sum_j w_ij * loss'(s_i - s_j) - sum_j w_ji * loss'(s_j - s_i), which is
+  computed next to the loss. The backward pass only uses these [batch_size,
+  list_size] lambdas instead of differentiating through the [batch_size,
+  list_size, list_size] pair tensors, so none of them are kept for the
+  gradient. The loss and the gradients are the same as in `_pairwise_loss`.
+
+  Args:
+    loss_fn: A function that computes loss from the pairwise logits.
+    loss_grad_fn: The derivative of `loss_fn` w.r.t. the pairwise logits.
+    sorted_labels: A `Tensor` with shape [batch_size, list_size] of labels
+      sorted.
+    sorted_logits: A `Tensor` with shape [batch_size, list_size] of logits
+      sorted.
+    sorted_weights: A `Tensor` with shape [batch_size, list_size] of item-wise
+      weights sorted.
+    lambda_weight: A `_LambdaWeight` object.
+    reduction: One of `tf.losses.Reduction`.
+
+  Returns:
+    A scalar loss `Tensor`, or the per-list losses with shape [batch_size] for
+    `NONE`.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=sorted_labels))
+
+  @tf.custom_gradient
+  def _loss(sorted_logits):
+    """Returns the reduced loss and its gradient function."""
+    _, pairwise_logits, pairwise_weights = _pairwise_comparison(
+        sorted_labels, sorted_logits, sorted_weights, lambda_weight)
+    if lambda_weight is not None:
+      # See `_pairwise_loss`.
+      pairwise_weights *= tf.cast(list_size, dtype=tf.float32)
+    (weighted_sums, weight_sums, num_nonzero_weights, row_grads,
+     col_grads) = _pairwise_loss_sums(loss_fn, loss_grad_fn, pairwise_logits,
+                                      pairwise_weights)
+    return _reduce_pairwise_loss_sums(
+        weighted_sums, weight_sums, num_nonzero_weights, row_grads - col_grads,
+        tf.cast(batch_size * list_size * list_size, tf.float32), reduction)
+
+  loss = _loss(sorted_logits)
+  tf.compat.v1.losses.add_loss(loss)
+  return loss
+
+
+def _blocked_pairwise_loss(loss_fn, loss_grad_fn, sorted_labels, sorted_logits,
+                           sorted_weights, lambda_weight, reduction,
+                           block_size):
+  """Computes the pairwise loss over tiles of `block_size` rows of pairs.
+
+  Only one [batch_size, block_size, list_size] tile of the pair matrix is alive
+  at a time. The loop accumulates the weighted loss sum, the weight sum and the
+  number of nonzero weights in the forward pass, together with the per-item
+  gradients sum_j w_ij * loss'(s_i - s_j) - sum_j w_ji * loss'(s_j - s_i).
+  The backward pass only uses these [batch_size, list_size] gradients, so it
+  does not keep the tiles either. The loss is the same as the dense
+  computation in `_pairwise_loss` up to the floating point summation order.
+
+  Args:
+    loss_fn: A function that computes loss from the pairwise logits.
+    loss_grad_fn: The derivative of `loss_fn` w.r.t. the pairwise logits.
+    sorted_labels: A `Tensor` with shape [batch_size, list_size] of labels
+      sorted.
+    sorted_logits: A `Tensor` with shape [batch_size, list_size] of logits
+      sorted.
+    sorted_weights: A `Tensor` with shape [batch_size, list_size] of item-wise
+      weights sorted.
+    lambda_weight: A `_LambdaWeight` object.
+    reduction: One of `tf.losses.Reduction`.
+    block_size: An int for the number of rows of pairs per tile.
+
+  Returns:
+    A scalar loss `Tensor`, or the per-list losses with shape [batch_size] for
+    `NONE`.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=sorted_labels))
+  cols = tf.reshape(tf.range(list_size), [1, 1, -1])
+  if lambda_weight is not None:
+    # The per-list constants are computed once instead of once per tile.
+    lambda_weight = lambda_weight._with_list_constants(sorted_labels)  # pylint: disable=protected-access
+    # See `_pairwise_loss`.
+    weight_scale = tf.cast(list_size, dtype=tf.float32)
+  else:
+    weight_scale = 1.
+
+  @tf.custom_gradient
+  def _loss(sorted_logits):
+    """Returns the reduced loss and its gradient function."""
+
+    def _cond(start, *unused_sums):
+      return tf.less(start, list_size)
+
+    def _body(start, weighted_sums, weight_sums, num_nonzero_weights,
+              lambdas):
+      """Accumulates the sums over a tile of rows [start, end)."""
+      end = tf.minimum(start + block_size, list_size)
+      rows = tf.reshape(tf.range(start, end), [1, -1, 1])
+      _, pairwise_logits, pairwise_weights = _pairwise_comparison_at(
+          sorted_labels, sorted_logits, sorted_weights, rows, cols,
+          lambda_weight)
+      pairwise_weights *= weight_scale
+      sums = _pairwise_loss_sums(loss_fn, loss_grad_fn, pairwise_logits,
+                                 pairwise_weights)
+      # The rows of the tile are [start, end) and the columns are all items.
+      lambdas += tf.pad(
+          tensor=sums[3], paddings=[[0, 0], [start, list_size - end]])
+      lambdas -= sums[4]
+      return (end, weighted_sums + sums[0], weight_sums + sums[1],
+              num_nonzero_weights + sums[2], lambdas)
+
+    per_list_zeros = tf.zeros_like(sorted_logits[:, 0])
+    # One tile at a time, see `utils.sum_over_row_blocks`.
+    _, weighted_sums, weight_sums, num_nonzero_weights, lambdas = (
+        tf.compat.v1.while_loop(
+            _cond,
+            _body, [
+                tf.constant(0), per_list_zeros, per_list_zeros,
+                per_list_zeros,
+                tf.zeros_like(sorted_logits)
+            ],
+            back_prop=False,
+            parallel_iterations=1))
+    return _reduce_pairwise_loss_sums(
+        weighted_sums, weight_sums, num_nonzero_weights, lambdas,
+        tf.cast(batch_size * list_size * list_size, tf.float32), reduction)
+
+  loss = _loss(sorted_logits)
+  tf.compat.v1.losses.add_loss(loss)
+  return loss
+
+
+def _ascending_label_order(sorted_labels):
+  """Orders the items of each list by label in ascending order.
+
+  In this order, the items with a lower label than an item i are the first
+  num_lower[i] ones, which is how the pairs (i, j) with l_i > l_j are found
+  without forming all pairs.
+
+  Args:
+    sorted_labels: A `Tensor` with shape [batch_size, list_size] of labels.
+
+  Returns:
+    A tuple of (ascending_labels, ascending_positions, num_lower), each with
+    shape [batch_size, list_size]. `ascending_labels` are the labels in
+    ascending order with invalid ones set to +inf at the end and
+    `ascending_positions` their positions in `sorted_labels`. `num_lower` is
+    the number of valid items with a lower label than each item in
+    `sorted_labels` (0 for invalid items).
+  """
+  list_size = tf.shape(input=sorted_labels)[1]
+  is_label_valid = utils.is_label_valid(sorted_labels)
+  # Invalid items are ordered last and never have a lower label.
+  sort_keys = tf.where(is_label_valid, sorted_labels,
+                       float('inf') * tf.ones_like(sorted_labels))
+  negative_keys, ascending_positions = tf.nn.top_k(-sort_keys, k=list_size)
+  ascending_labels = -negative_keys
+  num_lower = tf.searchsorted(ascending_labels, sort_keys, side='left')
+  num_lower = tf.where(is_label_valid, num_lower, tf.zeros_like(num_lower))
+  return ascending_labels, ascending_positions, num_lower
+
+
+def _contributing_pairs(sorted_labels):
+  """Enumerates the pairs (i, j) with l_i > l_j in each list.
+
+  Only these pairs have nonzero pairwise weights. They are enumerated across
+  the batch as flat index tensors with one entry per pair, and then padded per
+  list to the largest number of pairs in the batch. The padding is the pair
+  (0, 0), whose pairwise weight is 0 as its labels are equal.
+
+  Args:
+    sorted_labels: A `Tensor` with shape [batch_size, list_size] of labels.
+
+  Returns:
+    A tuple of int `Tensor`s (rows, cols) with shape [batch_size,
+    max_num_pairs] for the positions of i and j in `sorted_labels`.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=sorted_labels))
+  _, ascending_positions, num_lower = _ascending_label_order(sorted_labels)
+  # One entry per pair: the flat item id b * list_size + i, and the offset of
+  # j in the ascending order of list b.
+  lower_offsets = tf.ragged.range(tf.reshape(num_lower, [-1]))
+  items = tf.cast(lower_offsets.value_rowids(), dtype=tf.int32)
+  batch_ids = items // list_size
+  rows = items - batch_ids * list_size
+  cols = tf.gather(
+      tf.reshape(ascending_positions, [-1]),
+      batch_ids * list_size + lower_offsets.values)
+  batch_ids = tf.cast(batch_ids, dtype=tf.int64)
+  nrows = tf.cast(batch_size, dtype=tf.int64)
+  return tuple(
+      tf.RaggedTensor.from_value_rowids(x, batch_ids, nrows=nrows).to_tensor()
+      for x in (rows, cols))
+
+
+def _sparse_pairwise_loss(loss_fn, sorted_labels, sorted_logits,
+                          sorted_weights, lambda_weight, reduction):
+  """Computes the pairwise loss on the contributing pairs only.
+
+  The same as the dense computation in `_pairwise_loss`, but the logits, the
+  weights and the lambda weights are only gathered for the P pairs with l_i >
+  l_j found by `_contributing_pairs`, instead of all list_size^2 pairs. With
+  binary or sparse graded labels, P is often much smaller than list_size^2.
+
+  Args:
+    loss_fn: A function that computes loss from the pairwise logits.
+    sorted_labels: A `Tensor` with shape [batch_size, list_size] of labels
+      sorted.
+    sorted_logits: A `Tensor` with shape [batch_size, list_size] of logits
+      sorted.
+    sorted_weights: A `Tensor` with shape [batch_size, list_size] of item-wise
+      weights sorted.
+    lambda_weight: A `_LambdaWeight` object.
+    reduction: One of `tf.losses.Reduction`.
+
+  Returns:
+    A scalar loss `Tensor`, or the per-list losses with shape [batch_size] for
+    `NONE`.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=sorted_labels))
+  rows, cols = _contributing_pairs(sorted_labels)
+  _, pairwise_logits, pairwise_weights = _pairwise_comparison_at(
+      sorted_labels, sorted_logits, sorted_weights, rows, cols, lambda_weight)
+  if lambda_weight is not None:
+    # See `_pairwise_loss`.
+    pairwise_weights *= tf.cast(list_size, dtype=tf.float32)
+  num_nonzero_weights = tf.reduce_sum(
+      input_tensor=tf.cast(
+          tf.not_equal(pairwise_weights, 0.), dtype=tf.float32))
+  num_elements = tf.cast(batch_size * list_size * list_size, tf.float32)
+  return _reduce_weighted_loss(
+      loss_fn(pairwise_logits) * pairwise_weights,
+      tf.reduce_sum(input_tensor=pairwise_weights), num_nonzero_weights,
+      num_elements, reduction)
+
+
+def _uniform_index(uniform, size):
+  """Maps uniform samples in [0, 1) to int indices uniform in [0, size)."""
+  index = tf.cast(
+      tf.floor(uniform * tf.cast(size, dtype=tf.float32)), dtype=tf.int32)
+  return tf.clip_by_value(index, 0, tf.maximum(size - 1, 0))
+
+
+def _sample_pairs(sorted_labels, num_pairs, pair_sampling, seed=None):
+  """Samples `num_pairs` pairs (i, j) with l_i > l_j per list with replacement.
+
+  Items are ordered by label in ascending order once, so that the items with a
+  lower label than l_i, or the items with a given label grade, are a range of
+  that order found by `tf.searchsorted`. The cost is O(list_size *
+  log(list_size) + num_pairs) per list.
+
+  Args:
+    sorted_labels: A `Tensor` with shape [batch_size, list_size] of labels.
+    num_pairs: An int for the number of pairs per list.
+    pair_sampling: A `PairSamplingKey`.
+    seed: A randomization seed.
+
+  Returns:
+    A tuple of (rows, cols, importance_weights), each with shape [batch_size,
+    num_pairs]. `rows` and `cols` are the positions of items i and j in
+    `sorted_labels`. Weighting each sampled pair by its importance weight makes
+    the weighted sum over the sampled pairs an unbiased estimate of the sum over
+    all pairs with l_i > l_j. Lists without such pairs get 0 importance weights.
+
+  Raises:
+    ValueError: If `pair_sampling` is invalid.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=sorted_labels))
+  is_label_valid = utils.is_label_valid(sorted_labels)
+  ascending_labels, ascending_positions, num_lower = _ascending_label_order(
+      sorted_labels)
+  uniform = tf.random.uniform([batch_size, num_pairs, 3], seed=seed)
+  categorical_seed = None if seed is None else seed + 1
+  num_pairs_float = tf.cast(num_pairs, dtype=tf.float32)
+
+  if pair_sampling == PairSamplingKey.UNIFORM:
+    num_lower_float = tf.cast(num_lower, dtype=tf.float32)
+    num_list_pairs = tf.reduce_sum(
+        input_tensor=num_lower_float, axis=1, keepdims=True)
+    # Item i is drawn proportionally to its number of pairs, then j uniformly.
+    has_pairs = tf.logical_and(
+        tf.greater(num_list_pairs, 0.), tf.ones_like(is_label_valid))
+    rows = tf.random.categorical(
+        tf.where(has_pairs, tf.math.log(num_lower_float),
+                 tf.zeros_like(num_lower_float)),
+        num_pairs,
+        dtype=tf.int32,
+        seed=categorical_seed)
+    lower_index = _uniform_index(uniform[:, :, 0],
+                                 _gather_per_list(num_lower, rows))
+    cols = _gather_per_list(ascending_positions, lower_index)
+    importance_weights = num_list_pairs / num_pairs_float * tf.ones_like(
+        uniform[:, :, 0])
+  elif pair_sampling == PairSamplingKey.STRATIFIED:
+    # The 0-based grade of each item in the ascending order. Invalid items get
+    # a grade above all valid grades.
+    is_new_grade = tf.concat([
+        tf.ones([batch_size, 1], dtype=tf.int32),
+        tf.cast(
+            tf.greater(ascending_labels[:, 1:], ascending_labels[:, :-1]),
+            dtype=tf.int32)
+    ],
+                             axis=1)
+    ascending_grades = tf.cumsum(is_new_grade, axis=1) - 1
+    num_grades = tf.reduce_max(
+        input_tensor=tf.where(
+            tf.math.is_finite(ascending_labels), ascending_grades + 1,
+            tf.zeros_like(ascending_grades)),
+        axis=1,
+        keepdims=True)
+    num_strata = tf.cast(num_grades * (num_grades - 1) // 2, dtype=tf.float32)
+    # The grade pair (u, v) with u > v is drawn uniformly: u proportionally to
+    # its number of lower grades u, then v uniformly in [0, u).
+    grades = tf.ones_like(ascending_grades) * tf.expand_dims(
+        tf.range(list_size), 0)
+    grades_float = tf.cast(grades, dtype=tf.float32)
+    is_upper_grade = tf.logical_and(
+        tf.greater(grades, 0), tf.less(grades, num_grades))
+    has_pairs = tf.logical_and(
+        tf.greater(num_strata, 0.), tf.ones_like(is_label_valid))
+    upper_grades = tf.random.categorical(
+        tf.where(
+            has_pairs,
+            tf.where(is_upper_grade, tf.math.log(grades_float),
+                     -float('inf') * tf.ones_like(grades_float)),
+            tf.zeros_like(grades_float)),
+        num_pairs,
+        dtype=tf.int32,
+        seed=categorical_seed)
+    lower_grades = _uniform_index(uniform[:, :, 0], upper_grades)
+
+    def _grade_range(grade):
+      """Returns the start and the size of a grade in the ascending order."""
+      start = tf.searchsorted(ascending_grades, grade, side='left')
+      end = tf.searchsorted(ascending_grades, grade, side='right')
+      return start, end - start
+
+    upper_start, upper_size = _grade_range(upper_grades)
+    lower_start, lower_size = _grade_range(lower_grades)
+    # Lists without pairs may draw grades that are not present.
+    row_index = tf.minimum(
+        upper_start + _uniform_index(uniform[:, :, 1], upper_size),
+        list_size - 1)
+    lower_index = tf.minimum(
+        lower_start + _uniform_index(uniform[:, :, 2], lower_size),
+        list_size - 1)
+    rows = _gather_per_list(ascending_positions, row_index)
+    cols = _gather_per_list(ascending_positions, lower_index)
+    importance_weights = (
+        tf.cast(upper_size * lower_size, dtype=tf.float32) * num_strata /
+        num_pairs_float)
+  else:
+    raise ValueError('Invalid pair_sampling: {}'.format(pair_sampling))
+  importance_weights *= tf.cast(has_pairs[:, :1], dtype=tf.float32)
+  return rows, cols, tf.stop_gradient(importance_weights)
+
+
+def _sampled_pairwise_loss(loss_fn, sorted_labels, sorted_logits,
+                           sorted_weights, lambda_weight, reduction,
+                           num_sampled_pairs, pair_sampling, seed):
+  """Computes the pairwise loss on `num_sampled_pairs` sampled pairs per list.
+
+  The pairs are drawn by `_sample_pairs` and weighted by their importance
+  weights, so the weighted loss sum is an unbiased estimate of the one over all
+  pairs. The weight sum and the number of nonzero weights that some reductions
+  divide by are estimated from the same samples. The cost is linear in
+  `num_sampled_pairs` instead of quadratic in list_size.
+
+  Args:
+    loss_fn: A function that computes loss from the pairwise logits.
+    sorted_labels: A `Tensor` with shape [batch_size, list_size] of labels
+      sorted.
+    sorted_logits: A `Tensor` with shape [batch_size, list_size] of logits
+      sorted.
+    sorted_weights: A `Tensor` with shape [batch_size, list_size] of item-wise
+      weights sorted.
+    lambda_weight: A `_LambdaWeight` object.
+    reduction: One of `tf.losses.Reduction`.
+    num_sampled_pairs: An int for the number of pairs per list.
+    pair_sampling: A `PairSamplingKey`.
+    seed: A randomization seed.
+
+  Returns:
+    A scalar loss `Tensor`, or the per-list losses with shape [batch_size] for
+    `NONE`.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=sorted_labels))
+  rows, cols, importance_weights = _sample_pairs(sorted_labels,
+                                                 num_sampled_pairs,
+                                                 pair_sampling, seed)
+  _, pairwise_logits, pairwise_weights = _pairwise_comparison_at(
+      sorted_labels, sorted_logits, sorted_weights, rows, cols, lambda_weight)
+  if lambda_weight is not None:
+    # See `_pairwise_loss`.
+    pairwise_weights *= tf.cast(list_size, dtype=tf.float32)
+  pairwise_weights *= importance_weights
+  num_nonzero_weights = tf.reduce_sum(
+      input_tensor=importance_weights *
+      tf.cast(tf.not_equal(pairwise_weights, 0.), dtype=tf.float32))
+  num_elements = tf.cast(batch_size * list_size * list_size, tf.float32)
+  return _reduce_weighted_loss(
+      loss_fn(pairwise_logits) * pairwise_weights,
+      tf.reduce_sum(input_tensor=pairwise_weights), num_nonzero_weights,
+      num_elements, reduction)
+
+
 def _pairwise_loss(
     loss_fn,
     labels,
     logits,
     weights=None,
     lambda_weight=None,
-    reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS):
+    reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
+    loss_grad_fn=None,
+    block_size=None,
+    num_sampled_pairs=None,
+    pair_sampling=PairSamplingKey.UNIFORM,
+    seed=None,
+    sparse_pairs=False,
+    lambda_gradients=False,
+    unsorted_pairs=False,
+    context=None):
   """Template to compute pairwise loss.
 
   Args:
@@ -568,23 +1769,131 @@ def _pairwise_loss(
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights.
     lambda_weight: A `_LambdaWeight` object.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
+    loss_grad_fn: The derivative of `loss_fn` w.r.t. the pairwise logits.
+      Required when `block_size` or `lambda_gradients` is set.
+    block_size: An optional int. If set, the loss is computed over tiles of
+      `block_size` rows of the [list_size, list_size] pair matrix to bound the
+      memory, see `_blocked_pairwise_loss`.
+    num_sampled_pairs: An optional int. If set, the loss is estimated from this
+      number of sampled pairs per list, see `_sampled_pairwise_loss`.
+    pair_sampling: A `PairSamplingKey` used with `num_sampled_pairs`.
+    seed: A randomization seed used with `num_sampled_pairs`.
+    sparse_pairs: If True, the loss is computed on the pairs with l_i > l_j
+      only, see `_sparse_pairwise_loss`.
+    lambda_gradients: If True, the per-item gradients are computed in the
+      forward pass, see `_lambda_pairwise_loss`. The blocked loss always does
+      so.
+    unsorted_pairs: If True, the loss is computed on the unsorted lists also
+      with a `lambda_weight`, see `_unsorted_pairwise_loss`.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
 
   Returns:
     An op for the pairwise loss.
+
+  Raises:
+    ValueError: If `block_size` or `num_sampled_pairs` is not positive or if
+      more than one of `block_size`, `num_sampled_pairs`, `sparse_pairs`,
+      `lambda_gradients` and `unsorted_pairs` is set.
   """
-  sorted_labels, sorted_logits, sorted_weights = _sort_and_normalize(
-      labels, logits, weights)
+  num_options = ((block_size is not None) + (num_sampled_pairs is not None) +
+                 bool(sparse_pairs) + bool(lambda_gradients) +
+                 bool(unsorted_pairs))
+  if num_options > 1:
+    raise ValueError('Only one of block_size, num_sampled_pairs, sparse_pairs, '
+                     'lambda_gradients and unsorted_pairs can be set.')
+  labels, logits, weights = _to_float32(labels, logits, weights)
+  if context is None:
+    context = _LossContext(labels, logits, weights)
+  # The lists only need to be sorted for the lambda weights. The unsorted pairs
+  # look the lambda weights up by the sorted positions instead, which is slower
+  # than sorting the logits on CPU, so it is only done when requested.
+  if unsorted_pairs or (num_options == 0 and lambda_weight is None):
+    return _unsorted_pairwise_loss(loss_fn, labels, logits, weights,
+                                   lambda_weight, reduction, context)
+  sorted_labels, sorted_logits, sorted_weights = context.sort_and_normalize()
+  if sparse_pairs:
+    return _sparse_pairwise_loss(loss_fn, sorted_labels, sorted_logits,
+                                 sorted_weights, lambda_weight, reduction)
+  if num_sampled_pairs is not None:
+    if num_sampled_pairs <= 0:
+      raise ValueError(
+          'num_sampled_pairs must be positive: {}'.format(num_sampled_pairs))
+    return _sampled_pairwise_loss(loss_fn, sorted_labels, sorted_logits,
+                                  sorted_weights, lambda_weight, reduction,
+                                  num_sampled_pairs, pair_sampling, seed)
+  if block_size is not None:
+    if block_size <= 0:
+      raise ValueError('block_size must be positive: {}'.format(block_size))
+    return _blocked_pairwise_loss(loss_fn, loss_grad_fn, sorted_labels,
+                                  sorted_logits, sorted_weights, lambda_weight,
+                                  reduction, block_size)
+  if lambda_gradients:
+    return _lambda_pairwise_loss(loss_fn, loss_grad_fn, sorted_labels,
+                                 sorted_logits, sorted_weights, lambda_weight,
+                                 reduction)
   _, pairwise_logits, pairwise_weights = _pairwise_comparison(
       sorted_labels, sorted_logits, sorted_weights, lambda_weight)
+  return _reduce_pairwise_loss(loss_fn, pairwise_logits, pairwise_weights,
+                               lambda_weight, reduction)
+
+
+def _unsorted_pairwise_loss(loss_fn, labels, logits, weights, lambda_weight,
+                            reduction, context):
+  """Computes the pairwise loss over all the pairs of the unsorted lists.
+
+  See `_unsorted_pairwise_comparison`. The lists are not sorted by the logits,
+  so the gradient flows into `logits` without going through a gather.
+
+  Args:
+    loss_fn: A function that computes loss from the pairwise logits with l_i >
+      l_j.
+    labels: A `Tensor` with shape [batch_size, list_size] of labels.
+    logits: A `Tensor` with shape [batch_size, list_size] of logits.
+    weights: A scalar, a `Tensor` with shape [batch_size, 1] or a `Tensor` with
+      shape [batch_size, list_size] of weights, or None.
+    lambda_weight: A `_LambdaWeight` object.
+    reduction: One of `tf.losses.Reduction`.
+    context: A `_LossContext` for `labels` and `logits`.
+
+  Returns:
+    An op for the pairwise loss.
+  """
+  weights = 1.0 if weights is None else tf.convert_to_tensor(value=weights)
+  weights = tf.ones_like(labels) * weights
+  _, pairwise_logits, pairwise_weights = _unsorted_pairwise_comparison(
+      labels, logits, weights, lambda_weight, context)
+  return _reduce_pairwise_loss(loss_fn, pairwise_logits, pairwise_weights,
+                               lambda_weight, reduction)
+
+
+def _reduce_pairwise_loss(loss_fn, pairwise_logits, pairwise_weights,
+                          lambda_weight, reduction):
+  """Reduces the losses of all the pairs of the lists.
+
+  Args:
+    loss_fn: A function that computes loss from the pairwise logits with l_i >
+      l_j.
+    pairwise_logits: A `Tensor` with shape [batch_size, list_size, list_size].
+    pairwise_weights: A `Tensor` of the same shape as `pairwise_logits`.
+    lambda_weight: A `_LambdaWeight` object used for `pairwise_weights`.
+    reduction: One of `tf.losses.Reduction`.
+
+  Returns:
+    An op for the pairwise loss.
+  """
   if lambda_weight is not None:
     # For LambdaLoss with relative rank difference, the scale of loss becomes
     # much smaller when applying LambdaWeight. This affects the training can
     # make the optimal learning rate become much larger. We use a heuristic to
     # scale it up to the same magnitude as standard pairwise loss.
     pairwise_weights *= tf.cast(
-        tf.shape(input=sorted_labels)[1], dtype=tf.float32)
+        tf.shape(input=pairwise_logits)[1], dtype=tf.float32)
+  if reduction == tf.compat.v1.losses.Reduction.NONE:
+    return _reduce_weighted_loss(loss_fn(pairwise_logits) * pairwise_weights,
+                                 None, None, None, reduction)
   return tf.compat.v1.losses.compute_weighted_loss(
       loss_fn(pairwise_logits), weights=pairwise_weights, reduction=reduction)
 
@@ -595,7 +1904,15 @@ def _pairwise_hinge_loss(
     weights=None,
     lambda_weight=None,
     reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
-    name=None):
+    name=None,
+    block_size=None,
+    num_sampled_pairs=None,
+    pair_sampling=PairSamplingKey.UNIFORM,
+    seed=None,
+    sparse_pairs=False,
+    lambda_gradients=False,
+    unsorted_pairs=False,
+    context=None):
   """Computes the pairwise hinge loss for a list.
 
   The hinge loss is defined as Hinge(l_i > l_j) = max(0, 1 - (s_i - s_j)). So a
@@ -612,9 +1929,34 @@ def _pairwise_hinge_loss(
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights.
     lambda_weight: A `_LambdaWeight` object.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
     name: A string used as the name for this loss.
+    block_size: An optional int. If set, the loss is computed over tiles of
+      `block_size` rows of the pair matrix so that the peak memory is
+      O(batch_size * block_size * list_size) instead of O(batch_size *
+      list_size^2).
+    num_sampled_pairs: An optional int. If set, the loss is estimated from this
+      number of sampled pairs (i, j) with l_i > l_j per list, reweighted so that
+      the expected loss matches the loss over all pairs.
+    pair_sampling: A `PairSamplingKey` for how pairs are sampled.
+    seed: A randomization seed used when sampling pairs.
+    sparse_pairs: If True, only the pairs with l_i > l_j are enumerated and the
+      loss is computed on them instead of on all list_size^2 pairs. This is
+      cheaper when most pairs have equal labels, e.g., with binary labels.
+    lambda_gradients: If True, the gradient w.r.t. each logit is computed in the
+      forward pass as the sum of the pair gradients, LambdaMART-style, so the
+      backward pass does not keep the [batch_size, list_size, list_size] pair
+      tensors. The loss and its gradients are unchanged.
+    unsorted_pairs: If True, the pairs are formed from the lists in their input
+      order also with a `lambda_weight`, whose pair weights are looked up by the
+      sorted positions of the items with no gradient. So the logits are not
+      sorted and the backward pass has no gathers or scatters, at the cost of
+      looking up the rank discounts of all the pairs per list. Without a
+      `lambda_weight`, the lists are never sorted. The loss and its gradients
+      are unchanged.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
 
   Returns:
     An op for the pairwise hinge loss.
@@ -626,10 +1968,28 @@ def _pairwise_hinge_loss(
     # put a margin here.
     return tf.nn.relu(1. - logits)
 
+  def _loss_grad(logits):
+    """The derivative of `_loss` w.r.t. the pairwise logits."""
+    return -tf.cast(tf.less(logits, 1.), dtype=tf.float32)
+
   with tf.compat.v1.name_scope(name, 'pairwise_hinge_loss',
                                (labels, logits, weights)):
     return _pairwise_loss(
-        _loss, labels, logits, weights, lambda_weight, reduction=reduction)
+        _loss,
+        labels,
+        logits,
+        weights,
+        lambda_weight,
+        reduction=reduction,
+        loss_grad_fn=_loss_grad,
+        block_size=block_size,
+        num_sampled_pairs=num_sampled_pairs,
+        pair_sampling=pair_sampling,
+        seed=seed,
+        sparse_pairs=sparse_pairs,
+        lambda_gradients=lambda_gradients,
+        unsorted_pairs=unsorted_pairs,
+        context=context)
 
 
 def _pairwise_logistic_loss(
@@ -638,7 +1998,15 @@ def _pairwise_logistic_loss(
     weights=None,
     lambda_weight=None,
     reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
-    name=None):
+    name=None,
+    block_size=None,
+    num_sampled_pairs=None,
+    pair_sampling=PairSamplingKey.UNIFORM,
+    seed=None,
+    sparse_pairs=False,
+    lambda_gradients=False,
+    unsorted_pairs=False,
+    context=None):
   """Computes the pairwise logistic loss for a list.
 
   The preference probability of each pair is computed as the sigmoid function:
@@ -654,9 +2022,34 @@ def _pairwise_logistic_loss(
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights.
     lambda_weight: A `_LambdaWeight` object.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
     name: A string used as the name for this loss.
+    block_size: An optional int. If set, the loss is computed over tiles of
+      `block_size` rows of the pair matrix so that the peak memory is
+      O(batch_size * block_size * list_size) instead of O(batch_size *
+      list_size^2).
+    num_sampled_pairs: An optional int. If set, the loss is estimated from this
+      number of sampled pairs (i, j) with l_i > l_j per list, reweighted so that
+      the expected loss matches the loss over all pairs.
+    pair_sampling: A `PairSamplingKey` for how pairs are sampled.
+    seed: A randomization seed used when sampling pairs.
+    sparse_pairs: If True, only the pairs with l_i > l_j are enumerated and the
+      loss is computed on them instead of on all list_size^2 pairs. This is
+      cheaper when most pairs have equal labels, e.g., with binary labels.
+    lambda_gradients: If True, the gradient w.r.t. each logit is computed in the
+      forward pass as the sum of the pair gradients, LambdaMART-style, so the
+      backward pass does not keep the [batch_size, list_size, list_size] pair
+      tensors. The loss and its gradients are unchanged.
+    unsorted_pairs: If True, the pairs are formed from the lists in their input
+      order also with a `lambda_weight`, whose pair weights are looked up by the
+      sorted positions of the items with no gradient. So the logits are not
+      sorted and the backward pass has no gathers or scatters, at the cost of
+      looking up the rank discounts of all the pairs per list. Without a
+      `lambda_weight`, the lists are never sorted. The loss and its gradients
+      are unchanged.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
 
   Returns:
     An op for the pairwise logistic loss.
@@ -667,10 +2060,28 @@ def _pairwise_logistic_loss(
     # The following is the same as log(1 + exp(-pairwise_logits)).
     return tf.nn.relu(-logits) + tf.math.log1p(tf.exp(-tf.abs(logits)))
 
+  def _loss_grad(logits):
+    """The derivative of `_loss` w.r.t. the pairwise logits."""
+    return -tf.sigmoid(-logits)
+
   with tf.compat.v1.name_scope(name, 'pairwise_logistic_loss',
                                (labels, logits, weights)):
     return _pairwise_loss(
-        _loss, labels, logits, weights, lambda_weight, reduction=reduction)
+        _loss,
+        labels,
+        logits,
+        weights,
+        lambda_weight,
+        reduction=reduction,
+        loss_grad_fn=_loss_grad,
+        block_size=block_size,
+        num_sampled_pairs=num_sampled_pairs,
+        pair_sampling=pair_sampling,
+        seed=seed,
+        sparse_pairs=sparse_pairs,
+        lambda_gradients=lambda_gradients,
+        unsorted_pairs=unsorted_pairs,
+        context=context)
 
 
 def _pairwise_soft_zero_one_loss(
@@ -679,7 +2090,15 @@ def _pairwise_soft_zero_one_loss(
     weights=None,
     lambda_weight=None,
     reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
-    name=None):
+    name=None,
+    block_size=None,
+    num_sampled_pairs=None,
+    pair_sampling=PairSamplingKey.UNIFORM,
+    seed=None,
+    sparse_pairs=False,
+    lambda_gradients=False,
+    unsorted_pairs=False,
+    context=None):
   """Computes the pairwise soft zero-one loss.
 
   Note this is different from sigmoid cross entropy in that soft zero-one loss
@@ -698,9 +2117,34 @@ def _pairwise_soft_zero_one_loss(
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights.
     lambda_weight: A `_LambdaWeight` object.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
     name: A string used as the name for this loss.
+    block_size: An optional int. If set, the loss is computed over tiles of
+      `block_size` rows of the pair matrix so that the peak memory is
+      O(batch_size * block_size * list_size) instead of O(batch_size *
+      list_size^2).
+    num_sampled_pairs: An optional int. If set, the loss is estimated from this
+      number of sampled pairs (i, j) with l_i > l_j per list, reweighted so that
+      the expected loss matches the loss over all pairs.
+    pair_sampling: A `PairSamplingKey` for how pairs are sampled.
+    seed: A randomization seed used when sampling pairs.
+    sparse_pairs: If True, only the pairs with l_i > l_j are enumerated and the
+      loss is computed on them instead of on all list_size^2 pairs. This is
+      cheaper when most pairs have equal labels, e.g., with binary labels.
+    lambda_gradients: If True, the gradient w.r.t. each logit is computed in the
+      forward pass as the sum of the pair gradients, LambdaMART-style, so the
+      backward pass does not keep the [batch_size, list_size, list_size] pair
+      tensors. The loss and its gradients are unchanged.
+    unsorted_pairs: If True, the pairs are formed from the lists in their input
+      order also with a `lambda_weight`, whose pair weights are looked up by the
+      sorted positions of the items with no gradient. So the logits are not
+      sorted and the backward pass has no gathers or scatters, at the cost of
+      looking up the rank discounts of all the pairs per list. Without a
+      `lambda_weight`, the lists are never sorted. The loss and its gradients
+      are unchanged.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
 
   Returns:
     An op for the pairwise soft zero one loss.
@@ -711,10 +2155,28 @@ def _pairwise_soft_zero_one_loss(
     return tf.where(
         tf.greater(logits, 0), 1. - tf.sigmoid(logits), tf.sigmoid(-logits))
 
+  def _loss_grad(logits):
+    """The derivative of `_loss` w.r.t. the pairwise logits."""
+    return -tf.sigmoid(logits) * tf.sigmoid(-logits)
+
   with tf.compat.v1.name_scope(name, 'pairwise_soft_zero_one_loss',
                                (labels, logits, weights)):
     return _pairwise_loss(
-        _loss, labels, logits, weights, lambda_weight, reduction=reduction)
+        _loss,
+        labels,
+        logits,
+        weights,
+        lambda_weight,
+        reduction=reduction,
+        loss_grad_fn=_loss_grad,
+        block_size=block_size,
+        num_sampled_pairs=num_sampled_pairs,
+        pair_sampling=pair_sampling,
+        seed=seed,
+        sparse_pairs=sparse_pairs,
+        lambda_gradients=lambda_gradients,
+        unsorted_pairs=unsorted_pairs,
+        context=context)
 
 
 def _softmax_loss(
@@ -723,7 +2185,8 @@ def _softmax_loss(
     weights=None,
     lambda_weight=None,
     reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
-    name=None):
+    name=None,
+    context=None):
   """Computes the softmax cross entropy for a list.
 
   Given the labels l_i and the logits s_i, we sort the examples and obtain ranks
@@ -742,17 +2205,21 @@ def _softmax_loss(
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights.
     lambda_weight: A `DCGLambdaWeight` instance.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
     name: A string used as the name for this loss.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
 
   Returns:
     An op for the softmax cross entropy as a loss.
   """
   with tf.compat.v1.name_scope(name, 'softmax_loss', (labels, logits, weights)):
-    sorted_labels, sorted_logits, sorted_weights = _sort_and_normalize(
-        labels, logits, weights)
-    is_label_valid = utils.is_label_valid(sorted_labels)
+    labels, logits, weights = _to_float32(labels, logits, weights)
+    if context is None:
+      context = _LossContext(labels, logits, weights)
+    sorted_labels, sorted_logits, sorted_weights = context.sort_and_normalize()
+    is_label_valid = context.sorted_is_label_valid()
     # Reset the invalid labels to 0 and reset the invalid logits to a logit with
     # ~= 0 contribution in softmax.
     sorted_labels = tf.where(is_label_valid, sorted_labels,
@@ -764,16 +2231,175 @@ def _softmax_loss(
       sorted_labels = lambda_weight.individual_weights(sorted_labels)
     sorted_labels *= sorted_weights
     label_sum = tf.reduce_sum(input_tensor=sorted_labels, axis=1, keepdims=True)
+    # The lists without any positive label are masked out.
+    nonzero_mask = tf.greater(tf.reshape(label_sum, [-1]), 0.0)
+    losses = tf.nn.softmax_cross_entropy_with_logits(
+        labels=tf.stop_gradient(
+            tf.math.divide_no_nan(sorted_labels, label_sum)),
+        logits=sorted_logits)
+    return _masked_weighted_loss(losses, tf.reshape(label_sum, [-1]),
+                                 nonzero_mask, reduction)
+
+
+def _sampled_softmax_loss(
+    labels,
+    logits,
+    weights=None,
+    lambda_weight=None,
+    reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
+    name=None,
+    seed=None,
+    num_sampled_negatives=100,
+    negative_sampling=NegativeSamplingKey.UNIFORM,
+    context=None):
+  r"""Computes the sampled softmax cross entropy for a list.
+
+  The softmax loss normalizes over all the items of a list. Here, all the items
+  with a positive label are kept and K = `num_sampled_negatives` of the other
+  valid items are drawn with replacement from a distribution Q. The logit of a
+  sampled negative j is corrected by -log(K * Q(j)), so that the sampled
+  normalizer estimates the one of the whole list (the log-Q correction):
+
+    -sum_i l_i * log(exp(s_i) / (sum_p exp(s_p) +
+                                 sum_k exp(s_{j_k}) / (K * Q(j_k)))),
+
+  where p runs over the positives and j_k over the samples. With
+  `NegativeSamplingKey.LOGIT`, Q is the softmax of the logits over the
+  negatives and the normalizer is exact, while its gradient is sampled. Apart
+  from a pass over the list to find the positives and to sample, the cost is
+  proportional to the number of positives plus samples.
+
+  The `lambda_weight` re-weights the positives as in `_softmax_loss`, with the
+  ranks estimated from the positives and the sampled negatives.
+
+  Args:
+    labels: A `Tensor` of the same shape as `logits` representing graded
+      relevance.
+    logits: A `Tensor` with shape [batch_size, list_size]. Each value is the
+      ranking score of the corresponding item.
+    weights: A scalar, a `Tensor` with shape [batch_size, 1] for list-wise
+      weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
+      weights.
+    lambda_weight: A `DCGLambdaWeight` instance.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
+    name: A string used as the name for this loss.
+    seed: A randomization seed used when sampling negatives.
+    num_sampled_negatives: An int for the number of negatives sampled per list.
+    negative_sampling: A `NegativeSamplingKey` for the distribution the
+      negatives are sampled from.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
+
+  Returns:
+    An op for the sampled softmax cross entropy as a loss.
+
+  Raises:
+    ValueError: If `num_sampled_negatives` is not positive or
+      `negative_sampling` is invalid.
+  """
+  if num_sampled_negatives <= 0:
+    raise ValueError('num_sampled_negatives must be positive: {}'.format(
+        num_sampled_negatives))
+  if negative_sampling not in (NegativeSamplingKey.UNIFORM,
+                               NegativeSamplingKey.LOGIT):
+    raise ValueError('Invalid negative_sampling: {}'.format(negative_sampling))
+  with tf.compat.v1.name_scope(name, 'sampled_softmax_loss',
+                               (labels, logits, weights)):
+    labels, logits, weights = _to_float32(labels, logits, weights)
+    if context is None:
+      context = _LossContext(labels, logits, weights)
+    is_label_valid = context.is_label_valid()
+    weights = 1.0 if weights is None else weights
+    weights = tf.ones_like(labels) * weights
+    is_positive = tf.logical_and(is_label_valid, tf.greater(labels, 0.))
+    is_negative = tf.logical_and(is_label_valid, tf.logical_not(is_positive))
+    padding_logits = tf.math.log(_EPSILON)
+
+    # All the positives are kept, padded to the largest number of positives of
+    # a list in the batch.
+    num_positives = tf.reduce_max(
+        input_tensor=tf.reduce_sum(
+            input_tensor=tf.cast(is_positive, dtype=tf.int32), axis=1))
+    use_ranks = (
+        lambda_weight is not None and
+        isinstance(lambda_weight, DCGLambdaWeight))
+    if use_ranks:
+      # The positives are sorted by logits, so that the positives above each
+      # one are counted without comparing all the pairs of positives.
+      _, positive_indices = tf.nn.top_k(
+          tf.where(is_positive, tf.stop_gradient(logits),
+                   float('-inf') * tf.ones_like(logits)), num_positives)
+    else:
+      _, positive_indices = tf.nn.top_k(
+          tf.cast(is_positive, dtype=tf.float32), num_positives, sorted=False)
+    positive_mask = _gather_per_list(is_positive, positive_indices)
+    positive_labels = tf.where(positive_mask,
+                               _gather_per_list(labels, positive_indices),
+                               tf.zeros_like(positive_mask, dtype=tf.float32))
+    positive_logits = tf.where(
+        positive_mask, _gather_per_list(logits, positive_indices),
+        padding_logits * tf.ones_like(positive_labels))
+
+    # The negatives are sampled with replacement. A list without negatives
+    # samples from all its items, which are then masked out.
+    if negative_sampling == NegativeSamplingKey.LOGIT:
+      sampling_logits = tf.stop_gradient(logits)
+    else:
+      sampling_logits = tf.zeros_like(logits)
+    has_negatives = tf.reduce_any(
+        input_tensor=is_negative, axis=1, keepdims=True)
+    sampling_logits = tf.where(
+        tf.logical_or(is_negative, tf.logical_not(has_negatives)),
+        sampling_logits, float('-inf') * tf.ones_like(logits))
+    negative_indices = tf.cast(
+        tf.random.categorical(sampling_logits, num_sampled_negatives,
+                              seed=seed),
+        dtype=tf.int32)
+    negative_mask = _gather_per_list(is_negative, negative_indices)
+    negative_log_q = _gather_per_list(
+        tf.nn.log_softmax(sampling_logits), negative_indices) + tf.math.log(
+            float(num_sampled_negatives))
+    negative_logits = tf.where(
+        negative_mask,
+        _gather_per_list(logits, negative_indices) - negative_log_q,
+        padding_logits * tf.ones_like(negative_log_q))
+
+    if use_ranks:
+      # The rank of a positive counts the positives above it and estimates the
+      # number of negatives above it from the samples.
+      positive_scores = tf.stop_gradient(positive_logits)
+      positives_above = _num_greater_in_sorted(
+          tf.where(positive_mask, positive_scores,
+                   float('-inf') * tf.ones_like(positive_scores)))
+      sample_weights = tf.where(negative_mask, tf.exp(-negative_log_q),
+                                tf.zeros_like(negative_log_q))
+      negatives_above = tf.reduce_sum(
+          input_tensor=tf.expand_dims(sample_weights, 1) * tf.cast(
+              tf.greater(
+                  tf.expand_dims(
+                      _gather_per_list(
+                          tf.stop_gradient(logits), negative_indices), 1),
+                  tf.expand_dims(positive_scores, 2)),
+              dtype=tf.float32),
+          axis=2)
+      positive_labels = lambda_weight._individual_weights_at(  # pylint: disable=protected-access
+          positive_labels, 1. + positives_above + negatives_above)
+    positive_labels *= _gather_per_list(weights, positive_indices)
+    label_sum = tf.reduce_sum(
+        input_tensor=positive_labels, axis=1, keepdims=True)
+    # The lists without any positive label are masked out.
     nonzero_mask = tf.greater(tf.reshape(label_sum, [-1]), 0.0)
-    label_sum, sorted_labels, sorted_logits = [
-        tf.boolean_mask(tensor=x, mask=nonzero_mask)
-        for x in [label_sum, sorted_labels, sorted_logits]
-    ]
-    return tf.compat.v1.losses.softmax_cross_entropy(
-        sorted_labels / label_sum,
-        sorted_logits,
-        weights=tf.reshape(label_sum, [-1]),
-        reduction=reduction)
+    losses = tf.nn.softmax_cross_entropy_with_logits(
+        labels=tf.stop_gradient(
+            tf.concat([
+                tf.math.divide_no_nan(positive_labels, label_sum),
+                tf.zeros_like(negative_logits)
+            ],
+                      axis=1)),
+        logits=tf.concat([positive_logits, negative_logits], axis=1))
+    return _masked_weighted_loss(losses, tf.reshape(label_sum, [-1]),
+                                 nonzero_mask, reduction)
 
 
 def _sigmoid_cross_entropy_loss(
@@ -781,7 +2407,8 @@ def _sigmoid_cross_entropy_loss(
     logits,
     weights=None,
     reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
-    name=None):
+    name=None,
+    context=None):
   """Computes the sigmoid_cross_entropy loss for a list.
 
   Given the labels of graded relevance l_i and the logits s_i, we calculate
@@ -796,24 +2423,26 @@ def _sigmoid_cross_entropy_loss(
     weights: A scalar, a `Tensor` with shape [batch_size, 1] for list-wise
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
     name: A string used as the name for this loss.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
 
   Returns:
     An op for the sigmoid cross entropy as a loss.
   """
   with tf.compat.v1.name_scope(name, 'sigmoid_cross_entropy_loss',
                                (labels, logits, weights)):
-    is_label_valid = tf.reshape(utils.is_label_valid(labels), [-1])
-    weights = 1.0 if weights is None else tf.convert_to_tensor(value=weights)
-    weights = tf.ones_like(labels) * weights
-    label_vector, logit_vector, weight_vector = [
-        tf.boolean_mask(tensor=tf.reshape(x, [-1]), mask=is_label_valid)
-        for x in [labels, logits, weights]
-    ]
-    return tf.compat.v1.losses.sigmoid_cross_entropy(
-        label_vector, logit_vector, weights=weight_vector, reduction=reduction)
+    labels, logits, weights = _to_float32(labels, logits, weights)
+    if context is None:
+      context = _LossContext(labels, logits, weights)
+    is_label_valid = context.is_label_valid()
+    weights = 1.0 if weights is None else weights
+    losses = tf.nn.sigmoid_cross_entropy_with_logits(
+        labels=tf.where(is_label_valid, labels, tf.zeros_like(labels)),
+        logits=logits)
+    return _masked_weighted_loss(losses, weights, is_label_valid, reduction)
 
 
 def _mean_squared_loss(
@@ -821,7 +2450,8 @@ def _mean_squared_loss(
     logits,
     weights=None,
     reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
-    name=None):
+    name=None,
+    context=None):
   """Computes the mean squared loss for a list.
 
   Given the labels of graded relevance l_i and the logits s_i, we calculate
@@ -836,24 +2466,102 @@ def _mean_squared_loss(
     weights: A scalar, a `Tensor` with shape [batch_size, 1] for list-wise
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
     name: A string used as the name for this loss.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
 
   Returns:
     An op for the mean squared error as a loss.
   """
   with tf.compat.v1.name_scope(name, 'mean_squared_loss',
                                (labels, logits, weights)):
-    is_label_valid = tf.reshape(utils.is_label_valid(labels), [-1])
-    weights = 1.0 if weights is None else tf.convert_to_tensor(value=weights)
-    weights = tf.ones_like(labels) * weights
-    label_vector, logit_vector, weight_vector = [
-        tf.boolean_mask(tensor=tf.reshape(x, [-1]), mask=is_label_valid)
-        for x in [labels, logits, weights]
-    ]
-    return tf.compat.v1.losses.mean_squared_error(
-        label_vector, logit_vector, weights=weight_vector, reduction=reduction)
+    labels, logits, weights = _to_float32(labels, logits, weights)
+    if context is None:
+      context = _LossContext(labels, logits, weights)
+    is_label_valid = context.is_label_valid()
+    weights = 1.0 if weights is None else weights
+    losses = tf.math.squared_difference(logits, labels)
+    return _masked_weighted_loss(losses, weights, is_label_valid, reduction)
+
+
+def _top_k_list_mle_sums(labels, logits, is_label_valid, topn, seed=None):
+  r"""Computes the terms of the top-k ListMLE loss [Xia et al. 2009].
+
+  Only the first topn positions of a ground truth permutation are modeled:
+
+    loss = \sum_{i=1}^{topn} (log \sum_{j >= i} exp(s_{\pi_j}) - s_{\pi_i}),
+
+  where the sums over j >= i cover all the remaining items, not only the topn
+  ones. The topn items are found by a partial sort of the labels, and the
+  log-sum-exp of the items beyond them is computed once, which costs
+  O(list_size * log(topn)) instead of a full sort. Ties are broken randomly,
+  as in `_list_mle_loss`.
+
+  Args:
+    labels: A `Tensor` with shape [batch_size, list_size], with the invalid
+      labels reset to 0.
+    logits: A `Tensor` of the same shape as `labels`.
+    is_label_valid: A boolean `Tensor` of the same shape as `labels`.
+    topn: An int for the number of modeled positions.
+    seed: A randomization seed used when breaking the ties.
+
+  Returns:
+    A tuple of the sorted labels and the per-position terms of the loss, both
+    with shape [batch_size, min(topn, list_size)]. The terms of the invalid
+    items are 0.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=labels))
+  topn = tf.minimum(topn, list_size)
+  ones = tf.ones_like(labels)
+  # The invalid items are only selected when there are fewer than topn valid
+  # items in a list.
+  selection_labels = tf.where(is_label_valid, labels, -ones)
+  top_labels, _ = tf.nn.top_k(selection_labels, topn, sorted=False)
+  threshold = tf.reduce_min(input_tensor=top_labels, axis=1, keepdims=True)
+  # All the items above the threshold label are selected and the ones at the
+  # threshold are drawn randomly.
+  keys = tf.where(
+      tf.greater(selection_labels, threshold), 2. * ones,
+      tf.where(
+          tf.equal(selection_labels, threshold),
+          tf.random.uniform(tf.shape(input=labels), seed=seed), -ones))
+  _, top_indices = tf.nn.top_k(keys, topn, sorted=False)
+
+  # Sorts the selected items by label, with ties shuffled.
+  shuffled_indices = tf.gather_nd(
+      top_indices,
+      utils.shuffle_valid_indices(
+          _gather_per_list(is_label_valid, top_indices), seed))
+  sorted_indices, = utils.sort_by_scores(
+      _gather_per_list(labels, shuffled_indices), [shuffled_indices])
+  sorted_labels = _gather_per_list(labels, sorted_indices)
+  sorted_logits = _gather_per_list(logits, sorted_indices)
+  sorted_is_valid = _gather_per_list(is_label_valid, sorted_indices)
+
+  # The shift for a stable log-sum-exp is the largest valid logit.
+  min_logits = tf.reduce_min(input_tensor=logits, axis=1, keepdims=True)
+  shift = tf.stop_gradient(
+      tf.reduce_max(
+          input_tensor=tf.where(is_label_valid, logits,
+                                min_logits * tf.ones_like(logits)),
+          axis=1,
+          keepdims=True))
+  exp_logits = tf.where(is_label_valid, tf.exp(logits - shift),
+                        tf.zeros_like(logits))
+  batch_indices = tf.ones_like(sorted_indices) * tf.expand_dims(
+      tf.range(batch_size), 1)
+  is_selected = tf.scatter_nd(
+      tf.stack([batch_indices, sorted_indices], axis=2),
+      tf.ones_like(sorted_logits), tf.shape(input=logits))
+  rest_sums = tf.reduce_sum(
+      input_tensor=exp_logits * (1. - is_selected), axis=1, keepdims=True)
+  sums = rest_sums + tf.cumsum(
+      _gather_per_list(exp_logits, sorted_indices), axis=1, reverse=True)
+  sums = tf.where(sorted_is_valid, sums, tf.ones_like(sums))
+  sums = tf.math.log(sums) - (sorted_logits - shift)
+  return sorted_labels, tf.where(sorted_is_valid, sums, tf.zeros_like(sums))
 
 
 def _list_mle_loss(
@@ -863,7 +2571,9 @@ def _list_mle_loss(
     lambda_weight=None,
     reduction=tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
     name=None,
-    seed=None):
+    seed=None,
+    topn=None,
+    context=None):
   """Computes the ListMLE loss [Xia et al. 2008] for a list.
 
   Given the labels of graded relevance l_i and the logits s_i, we calculate
@@ -874,6 +2584,10 @@ def _list_mle_loss(
   "Position-Aware ListMLE" paper (Lan et al.) and available using
   create_p_list_mle_lambda_weight() factory function above.
 
+  With `topn`, the top-k ListMLE loss [Xia et al. 2009] models only the first
+  topn positions of the ground truth permutation, see `_top_k_list_mle_sums`.
+  It avoids sorting the whole list and the invalid items do not contribute.
+
   Args:
     labels: A `Tensor` of the same shape as `logits` representing graded
       relevance.
@@ -883,17 +2597,28 @@ def _list_mle_loss(
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights.
     lambda_weight: A `DCGLambdaWeight` instance.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
     name: A string used as the name for this loss.
     seed: A randomization seed used when shuffling ground truth permutations.
+    topn: An optional int for the number of modeled positions.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
 
   Returns:
     An op for the ListMLE loss.
+
+  Raises:
+    ValueError: If `topn` is not positive.
   """
+  if topn is not None and topn <= 0:
+    raise ValueError('topn must be positive: {}'.format(topn))
   with tf.compat.v1.name_scope(name, 'list_mle_loss',
                                (labels, logits, weights)):
-    is_label_valid = utils.is_label_valid(labels)
+    labels, logits, weights = _to_float32(labels, logits, weights)
+    if context is None:
+      context = _LossContext(labels, logits, weights)
+    is_label_valid = context.is_label_valid()
     # Reset the invalid labels to 0 and reset the invalid logits to a logit with
     # ~= 0 contribution.
     labels = tf.where(is_label_valid, labels, tf.zeros_like(labels))
@@ -902,18 +2627,22 @@ def _list_mle_loss(
     weights = 1.0 if weights is None else tf.convert_to_tensor(value=weights)
     weights = tf.squeeze(weights)
 
-    # Shuffle labels and logits to add randomness to sort.
-    shuffled_indices = utils.shuffle_valid_indices(is_label_valid, seed)
-    shuffled_labels = tf.gather_nd(labels, shuffled_indices)
-    shuffled_logits = tf.gather_nd(logits, shuffled_indices)
+    if topn is None:
+      # Shuffle labels and logits to add randomness to sort.
+      shuffled_indices = utils.shuffle_valid_indices(is_label_valid, seed)
+      shuffled_labels = tf.gather_nd(labels, shuffled_indices)
+      shuffled_logits = tf.gather_nd(logits, shuffled_indices)
 
-    sorted_labels, sorted_logits = utils.sort_by_scores(
-        shuffled_labels, [shuffled_labels, shuffled_logits])
+      sorted_labels, sorted_logits = utils.sort_by_scores(
+          shuffled_labels, [shuffled_labels, shuffled_logits])
 
-    raw_max = tf.reduce_max(input_tensor=sorted_logits, axis=1, keepdims=True)
-    sorted_logits = sorted_logits - raw_max
-    sums = tf.cumsum(tf.exp(sorted_logits), axis=1, reverse=True)
-    sums = tf.math.log(sums) - sorted_logits
+      raw_max = tf.reduce_max(input_tensor=sorted_logits, axis=1, keepdims=True)
+      sorted_logits = sorted_logits - raw_max
+      sums = tf.cumsum(tf.exp(sorted_logits), axis=1, reverse=True)
+      sums = tf.math.log(sums) - sorted_logits
+    else:
+      sorted_labels, sums = _top_k_list_mle_sums(labels, logits,
+                                                 is_label_valid, topn, seed)
 
     if lambda_weight is not None and isinstance(lambda_weight,
                                                 ListMLELambdaWeight):
@@ -925,18 +2654,70 @@ def _list_mle_loss(
         negative_log_likelihood, weights=weights, reduction=reduction)
 
 
+def _candidate_approx_ranks(logits, alpha, num_candidates):
+  r"""Approximates the ranks of all items against the top candidates by logit.
+
+  The rank of item i is approximated as in `utils.approx_ranks`, but only the
+  `num_candidates` items with the largest logits of each list take part in the
+  comparisons:
+
+    rank_i = 1 + \sum_{j \in C, j \neq i} 1/(1 + exp(-alpha * (s_j - s_i))),
+
+  where C is the candidate set. The items outside C have smaller logits than
+  all the candidates, so they barely change the ranks of the items within the
+  top ranks. The ranks beyond num_candidates are underestimated. The cost is
+  O(list_size * num_candidates) per list.
+
+  Args:
+    logits: A `Tensor` with shape [batch_size, list_size].
+    alpha: Exponent of the generalized sigmoid function.
+    num_candidates: An int for the number of candidates per list.
+
+  Returns:
+    A `Tensor` of ranks with the same shape as logits.
+  """
+  batch_size, list_size = tf.unstack(tf.shape(input=logits))
+  candidate_logits, candidate_indices = tf.nn.top_k(
+      logits, tf.minimum(num_candidates, list_size), sorted=False)
+  pairs = tf.sigmoid(alpha * (tf.expand_dims(candidate_logits, 1) -
+                              tf.expand_dims(logits, 2)))
+  # A candidate is compared with itself, which adds sigmoid(0) = 0.5.
+  batch_ids = tf.tile(
+      tf.expand_dims(tf.range(batch_size), 1),
+      [1, tf.shape(input=candidate_indices)[1]])
+  is_candidate = tf.scatter_nd(
+      tf.stack([batch_ids, candidate_indices], axis=2),
+      tf.ones_like(candidate_logits), [batch_size, list_size])
+  return tf.reduce_sum(input_tensor=pairs, axis=-1) + 1. - .5 * is_candidate
+
+
 def _approx_ndcg_loss(labels,
                       logits,
                       weights=None,
                       reduction=tf.compat.v1.losses.Reduction.SUM,
                       name=None,
-                      alpha=10.):
+                      alpha=10.,
+                      context=None,
+                      block_size=None,
+                      topn=None,
+                      num_candidates=None,
+                      ideal_dcg=None):
   """Computes ApproxNDCG loss.
 
   ApproxNDCG ["A general approximation framework for direct optimization of
   information retrieval measures" by Qin et al.] is a smooth approximation
   to NDCG.
 
+  With `topn`, it approximates NDCG@topn: the discounts are smoothly cut off
+  by a generalized sigmoid of the approximate ranks around topn + 0.5, so that
+  an item ranked just below topn still has a gradient toward the top, and the
+  ideal DCG is the one of the topn items. With `num_candidates` in addition,
+  the ranks of all the items, including every relevant one, are only computed
+  against the `num_candidates` items with the largest logits, see
+  `_candidate_approx_ranks`. This costs O(list_size * num_candidates) instead
+  of O(list_size^2) and stays accurate at the cutoff when num_candidates is a
+  few times topn.
+
   Args:
     labels: A `Tensor` of the same shape as `logits` representing graded
       relevance.
@@ -946,17 +2727,40 @@ def _approx_ndcg_loss(labels,
       weights, or a `Tensor` with shape [batch_size, list_size] for item-wise
       weights. If None, the weight of a list in the mini-batch is set to
       the sum of the labels of the items in that list.
-    reduction: One of `tf.losses.Reduction` except `NONE`. Describes how to
-      reduce training loss over batch.
+    reduction: One of `tf.losses.Reduction`. Describes how to reduce training
+      loss over batch. With `NONE`, the per-list losses with shape
+      [batch_size] are returned.
     name: A string used as the name for this loss.
     alpha: The exponent in the generalized sigmoid function.
+    context: An optional `_LossContext` for `labels`, `logits` and `weights`.
+    block_size: An optional int. If set, the approximate ranks are computed over
+      tiles of `block_size` items, see `utils.approx_ranks`.
+    topn: An optional int for the cutoff of the approximated NDCG.
+    num_candidates: An optional int for the number of items with the largest
+      logits that the ranks are computed against. Requires `topn`.
+    ideal_dcg: An optional `Tensor` with shape [batch_size] or [batch_size, 1]
+      for the precomputed max DCG of each list at `topn`. If set, the labels
+      are not sorted, see `utils.inverse_max_dcg`.
 
   Returns:
     An op for the ApproxNDCG loss.
+
+  Raises:
+    ValueError: If `num_candidates` is set without `topn` or is smaller than
+      `topn`, or if it is set with `block_size`.
   """
+  if num_candidates is not None:
+    if topn is None or num_candidates < topn:
+      raise ValueError('num_candidates must be set with a topn that is not '
+                       'larger: {} vs {}'.format(num_candidates, topn))
+    if block_size is not None:
+      raise ValueError('Only one of block_size and num_candidates can be set.')
   with tf.compat.v1.name_scope(name, 'approx_ndcg_loss',
                                (labels, logits, weights)):
-    is_label_valid = utils.is_label_valid(labels)
+    labels, logits, weights = _to_float32(labels, logits, weights)
+    if context is None:
+      context = _LossContext(labels, logits, weights)
+    is_label_valid = context.is_label_valid()
     labels = tf.where(is_label_valid, labels, tf.zeros_like(labels))
     logits = tf.where(
         is_label_valid, logits, -1e3 * tf.ones_like(logits) +
@@ -965,19 +2769,20 @@ def _approx_ndcg_loss(labels,
     label_sum = tf.reduce_sum(input_tensor=labels, axis=1, keepdims=True)
     if weights is None:
       weights = tf.ones_like(label_sum)
-    weights = tf.squeeze(weights)
-
+    weights = tf.reshape(weights * tf.ones_like(label_sum), [-1])
+    # The lists without any positive label are masked out.
     nonzero_mask = tf.greater(tf.reshape(label_sum, [-1]), 0.0)
-    labels, logits, weights = [
-        tf.boolean_mask(tensor=x, mask=nonzero_mask)
-        for x in [labels, logits, weights]
-    ]
 
     gains = tf.pow(2., tf.cast(labels, dtype=tf.float32)) - 1.
-    ranks = utils.approx_ranks(logits, alpha=alpha)
+    if num_candidates is not None:
+      ranks = _candidate_approx_ranks(logits, alpha, num_candidates)
+    else:
+      ranks = utils.approx_ranks(logits, alpha=alpha, block_size=block_size)
     discounts = 1. / tf.math.log1p(ranks)
+    if topn is not None:
+      # A hard cutoff would give no gradient to the items below it.
+      discounts *= tf.sigmoid(alpha * (topn + .5 - ranks))
     dcg = tf.reduce_sum(input_tensor=gains * discounts, axis=-1)
-    cost = -dcg * tf.squeeze(utils.inverse_max_dcg(labels))
-
-    return tf.compat.v1.losses.compute_weighted_loss(
-        cost, weights=weights, reduction=reduction)
+    cost = -dcg * tf.reshape(
+        utils.inverse_max_dcg(labels, topn=topn, ideal_dcg=ideal_dcg), [-1])
+    return _masked_weighted_loss(cost, weights, nonzero_mask, reduction)
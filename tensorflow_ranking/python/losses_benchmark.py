@@ -0,0 +1,417 @@
+# Copyright 2019 The TensorFlow Ranking Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmarks for losses.py.
+
+Run with:
+
+  python -m tensorflow_ranking.python.losses_benchmark --benchmarks=.
+
+or with `--benchmark_filter=.` on TensorFlow 2.x.
+
+`LossesBenchmark` covers every `RankingLossKey` with and without each
+applicable lambda weight over a grid of list sizes and batch sizes, e.g.:
+
+  python -m tensorflow_ranking.python.losses_benchmark \
+    --benchmarks=LossesBenchmark --list_sizes=10,50,200,1000 \
+    --batch_sizes=1,8,32 --output_file=/tmp/losses_benchmark.json
+
+For each configuration it reports the wall time of the forward pass and of
+the forward and backward pass, the peak allocator memory of the latter and the
+number of ops in the graph. With `--output_file`, the results are also written
+as JSON, sorted by configuration, to compare runs across commits. The dense
+pairwise losses hold several [batch_size, list_size, list_size] tensors, so
+large batches of long lists need several GB of memory.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+from absl import flags
+import numpy as np
+import six
+import tensorflow as tf
+
+from tensorflow_ranking.python import head as head_lib
+from tensorflow_ranking.python import losses as losses_lib
+
+_BATCH_SIZE = 32
+_LIST_SIZE = 200
+_NUM_FEATURES = 256
+_HIDDEN_UNITS = 512
+
+flags.DEFINE_list('list_sizes', ['10', '50', '200', '1000'],
+                  'The list sizes of LossesBenchmark.')
+flags.DEFINE_list('batch_sizes', ['1', '8', '32'],
+                  'The batch sizes of LossesBenchmark.')
+flags.DEFINE_string('output_file', None,
+                    'If set, the JSON file to write LossesBenchmark results.')
+
+FLAGS = flags.FLAGS
+
+# The fraction of padding items in the lists of LossesBenchmark.
+_PADDING_FRACTION = 0.1
+
+# The lambda weights of LossesBenchmark by name and the losses they apply to.
+_LAMBDA_WEIGHT_FNS = {
+    'ndcg': lambda list_size: losses_lib.create_ndcg_lambda_weight(),
+    'reciprocal_rank':
+        lambda list_size: losses_lib.create_reciprocal_rank_lambda_weight(),
+    'precision': lambda list_size: losses_lib.PrecisionLambdaWeight(topn=10),
+    'p_list_mle': losses_lib.create_p_list_mle_lambda_weight,
+}
+_DCG_LAMBDA_WEIGHTS = ['ndcg', 'reciprocal_rank', 'precision']
+_LOSS_LAMBDA_WEIGHTS = {
+    losses_lib.RankingLossKey.PAIRWISE_HINGE_LOSS: _DCG_LAMBDA_WEIGHTS,
+    losses_lib.RankingLossKey.PAIRWISE_LOGISTIC_LOSS: _DCG_LAMBDA_WEIGHTS,
+    losses_lib.RankingLossKey.PAIRWISE_SOFT_ZERO_ONE_LOSS: _DCG_LAMBDA_WEIGHTS,
+    losses_lib.RankingLossKey.SOFTMAX_LOSS: _DCG_LAMBDA_WEIGHTS,
+    losses_lib.RankingLossKey.SAMPLED_SOFTMAX_LOSS: _DCG_LAMBDA_WEIGHTS,
+    losses_lib.RankingLossKey.LIST_MLE_LOSS: ['p_list_mle'],
+}
+
+
+def _scoring_network(random_state, dtype=tf.float32):
+  """Returns the labels, the logits and the variables of a scoring network."""
+  features = tf.constant(
+      random_state.normal(
+          size=[_BATCH_SIZE, _LIST_SIZE, _NUM_FEATURES]).astype(np.float32))
+  labels = tf.constant(
+      random_state.randint(0, 3, size=[_BATCH_SIZE,
+                                       _LIST_SIZE]).astype(np.float32))
+  hidden_weights = tf.Variable(
+      random_state.normal(size=[_NUM_FEATURES, _HIDDEN_UNITS]).astype(
+          np.float32) / np.sqrt(_NUM_FEATURES))
+  output_weights = tf.Variable(
+      random_state.normal(size=[_HIDDEN_UNITS, 1]).astype(np.float32) /
+      np.sqrt(_HIDDEN_UNITS))
+  hidden = tf.nn.relu(
+      tf.tensordot(tf.cast(features, dtype), tf.cast(hidden_weights, dtype), 1))
+  logits = tf.squeeze(
+      tf.tensordot(hidden, tf.cast(output_weights, dtype), 1), axis=2)
+  return labels, logits, [hidden_weights, output_weights]
+
+
+class MixedPrecisionBenchmark(tf.test.Benchmark):
+  """Benchmarks a training step with a scoring network in low precision.
+
+  The network computes in the benchmarked dtype and the losses compute in
+  float32. The step is the forward and backward pass of the network and the
+  losses. Half precision pays off on accelerators; CPUs may not support it
+  natively.
+  """
+
+  def _run(self, dtype):
+    with tf.Graph().as_default():
+      labels, logits, variables = _scoring_network(
+          np.random.RandomState(1), dtype)
+      loss = losses_lib.make_loss_fn([
+          losses_lib.RankingLossKey.SOFTMAX_LOSS,
+          losses_lib.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,
+      ])(labels, logits, {})
+      grads = tf.gradients(ys=loss, xs=variables)
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        self.run_op_benchmark(
+            sess, [loss] + grads,
+            min_iters=10,
+            name='mixed_precision_{}'.format(dtype.name),
+            extras={'dtype': dtype.name})
+
+  def benchmark_float32(self):
+    self._run(tf.float32)
+
+  def benchmark_float16(self):
+    self._run(tf.float16)
+
+  def benchmark_bfloat16(self):
+    self._run(tf.bfloat16)
+
+
+class HardListMiningBenchmark(tf.test.Benchmark):
+  """Benchmarks a training step that backpropagates only the hardest lists.
+
+  The step is the forward pass of the network and the losses on all lists and
+  the backward pass of the loss on the hard lists only. The backward pass of
+  the network still covers the whole batch, with zero gradients for the other
+  lists.
+  """
+
+  def _run(self, num_hard_lists):
+    with tf.Graph().as_default():
+      labels, logits, variables = _scoring_network(np.random.RandomState(1))
+      head = head_lib.create_ranking_head(
+          loss_fn=losses_lib.make_loss_fn(
+              losses_lib.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,
+              reduction=tf.compat.v1.losses.Reduction.NONE),
+          num_hard_lists=num_hard_lists)
+      loss = head.create_loss(
+          features={},
+          mode=tf.estimator.ModeKeys.TRAIN,
+          logits=logits,
+          labels=labels).training_loss
+      grads = tf.gradients(ys=loss, xs=variables)
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        self.run_op_benchmark(
+            sess, [loss] + grads,
+            min_iters=10,
+            name='hard_lists_{}_of_{}'.format(num_hard_lists or _BATCH_SIZE,
+                                              _BATCH_SIZE),
+            extras={'num_hard_lists': num_hard_lists or _BATCH_SIZE})
+
+  def benchmark_all_lists(self):
+    self._run(None)
+
+  def benchmark_half_of_lists(self):
+    self._run(_BATCH_SIZE // 2)
+
+  def benchmark_quarter_of_lists(self):
+    self._run(_BATCH_SIZE // 4)
+
+
+class ListMLEBenchmark(tf.test.Benchmark):
+  """Benchmarks the ListMLE loss against the top-k ListMLE loss."""
+
+  def _run(self, list_size, topn):
+    random_state = np.random.RandomState(1)
+    with tf.Graph().as_default():
+      logits = tf.Variable(
+          random_state.normal(size=[_BATCH_SIZE, list_size]).astype(np.float32))
+      labels = tf.constant(
+          random_state.randint(0, 5, size=[_BATCH_SIZE,
+                                           list_size]).astype(np.float32))
+      loss = losses_lib.make_loss_fn(
+          losses_lib.RankingLossKey.LIST_MLE_LOSS,
+          extra_args={'topn': topn})(labels, logits, {})
+      grad, = tf.gradients(ys=loss, xs=[logits])
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        self.run_op_benchmark(
+            sess, [loss, grad],
+            min_iters=10,
+            name='list_mle_list_size_{}_topn_{}'.format(list_size, topn),
+            extras={
+                'list_size': list_size,
+                'topn': topn or list_size
+            })
+
+  def benchmark_full_list(self):
+    for list_size in [1000, 10000]:
+      self._run(list_size, None)
+
+  def benchmark_top_10(self):
+    for list_size in [1000, 10000]:
+      self._run(list_size, 10)
+
+
+class LossesBenchmark(tf.test.Benchmark):
+  """Benchmarks every loss key and lambda weight across list and batch sizes.
+
+  Each benchmark method covers one loss key. The results of all the methods
+  that ran are accumulated and written to `--output_file`.
+  """
+
+  # The results of the benchmark methods by configuration.
+  _results = {}
+
+  def _run_config(self, loss_key, lambda_weight_name, list_size, batch_size):
+    """Benchmarks a loss configuration and returns its results."""
+    random_state = np.random.RandomState(1)
+    labels = random_state.randint(0, 5, size=[batch_size,
+                                              list_size]).astype(np.float32)
+    labels[random_state.uniform(size=labels.shape) < _PADDING_FRACTION] = -1.
+    name = '{}_{}_list_size_{}_batch_size_{}'.format(
+        loss_key, lambda_weight_name or 'no_lambda_weight', list_size,
+        batch_size)
+    with tf.Graph().as_default() as graph:
+      logits = tf.Variable(
+          random_state.normal(size=[batch_size, list_size]).astype(np.float32))
+      num_init_ops = len(graph.get_operations())
+      lambda_weight = (
+          _LAMBDA_WEIGHT_FNS[lambda_weight_name](list_size)
+          if lambda_weight_name else None)
+      loss = losses_lib.make_loss_fn(
+          loss_key, lambda_weight=lambda_weight, seed=1)(tf.constant(labels),
+                                                         logits, {})
+      num_forward_ops = len(graph.get_operations()) - num_init_ops
+      grad, = tf.gradients(ys=loss, xs=[logits])
+      num_ops = len(graph.get_operations()) - num_init_ops
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        forward = self.run_op_benchmark(
+            sess,
+            loss,
+            min_iters=5,
+            store_memory_usage=False,
+            name=name + '_forward')
+        backward = self.run_op_benchmark(
+            sess, [loss, grad], min_iters=5, name=name + '_backward')
+    peak_memory = max([
+        value for key, value in six.iteritems(backward['extras'])
+        if key.startswith('allocator_maximum_num_bytes')
+    ] or [-1])
+    return {
+        'loss_key': loss_key,
+        'lambda_weight': lambda_weight_name,
+        'list_size': list_size,
+        'batch_size': batch_size,
+        'forward_wall_time': forward['wall_time'],
+        'forward_backward_wall_time': backward['wall_time'],
+        'peak_memory_bytes': peak_memory,
+        'num_forward_ops': num_forward_ops,
+        'num_ops': num_ops,
+    }
+
+  def _run(self, loss_key):
+    for lambda_weight_name in [None] + _LOSS_LAMBDA_WEIGHTS.get(loss_key, []):
+      for list_size in [int(size) for size in FLAGS.list_sizes]:
+        for batch_size in [int(size) for size in FLAGS.batch_sizes]:
+          self._results[(loss_key, lambda_weight_name or '', list_size,
+                         batch_size)] = self._run_config(
+                             loss_key, lambda_weight_name, list_size,
+                             batch_size)
+    if FLAGS.output_file:
+      output = {
+          'tensorflow_version': tf.__version__,
+          'results': [self._results[key] for key in sorted(self._results)],
+      }
+      with tf.io.gfile.GFile(FLAGS.output_file, 'w') as f:
+        f.write(json.dumps(output, indent=2, sort_keys=True))
+
+  def benchmark_pairwise_hinge_loss(self):
+    self._run(losses_lib.RankingLossKey.PAIRWISE_HINGE_LOSS)
+
+  def benchmark_pairwise_logistic_loss(self):
+    self._run(losses_lib.RankingLossKey.PAIRWISE_LOGISTIC_LOSS)
+
+  def benchmark_pairwise_soft_zero_one_loss(self):
+    self._run(losses_lib.RankingLossKey.PAIRWISE_SOFT_ZERO_ONE_LOSS)
+
+  def benchmark_softmax_loss(self):
+    self._run(losses_lib.RankingLossKey.SOFTMAX_LOSS)
+
+  def benchmark_sampled_softmax_loss(self):
+    self._run(losses_lib.RankingLossKey.SAMPLED_SOFTMAX_LOSS)
+
+  def benchmark_sigmoid_cross_entropy_loss(self):
+    self._run(losses_lib.RankingLossKey.SIGMOID_CROSS_ENTROPY_LOSS)
+
+  def benchmark_mean_squared_loss(self):
+    self._run(losses_lib.RankingLossKey.MEAN_SQUARED_LOSS)
+
+  def benchmark_list_mle_loss(self):
+    self._run(losses_lib.RankingLossKey.LIST_MLE_LOSS)
+
+  def benchmark_approx_ndcg_loss(self):
+    self._run(losses_lib.RankingLossKey.APPROX_NDCG_LOSS)
+
+
+class SampledSoftmaxBenchmark(tf.test.Benchmark):
+  """Benchmarks the softmax loss against the sampled softmax loss.
+
+  The lists are long and have few positives, where the full softmax and its
+  sort dominate the step.
+  """
+
+  _LIST_SIZE = 5000
+  _NUM_POSITIVES = 5
+  _NUM_SAMPLED_NEGATIVES = 100
+
+  def _run(self, name, loss_key, extra_args=None):
+    random_state = np.random.RandomState(1)
+    labels = np.zeros([_BATCH_SIZE, self._LIST_SIZE], dtype=np.float32)
+    for labels_of_list in labels:
+      labels_of_list[random_state.choice(
+          self._LIST_SIZE, self._NUM_POSITIVES, replace=False)] = 1.
+    with tf.Graph().as_default():
+      logits = tf.Variable(
+          random_state.normal(size=[_BATCH_SIZE, self._LIST_SIZE]).astype(
+              np.float32))
+      loss = losses_lib.make_loss_fn(
+          loss_key,
+          lambda_weight=losses_lib.create_ndcg_lambda_weight(),
+          seed=1,
+          extra_args=extra_args)(tf.constant(labels), logits, {})
+      grad, = tf.gradients(ys=loss, xs=[logits])
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        self.run_op_benchmark(
+            sess, [loss, grad],
+            min_iters=10,
+            name=name,
+            extras={'list_size': self._LIST_SIZE})
+
+  def benchmark_softmax(self):
+    self._run('softmax', losses_lib.RankingLossKey.SOFTMAX_LOSS)
+
+  def benchmark_sampled_softmax_uniform(self):
+    self._run(
+        'sampled_softmax_uniform',
+        losses_lib.RankingLossKey.SAMPLED_SOFTMAX_LOSS,
+        extra_args={'num_sampled_negatives': self._NUM_SAMPLED_NEGATIVES})
+
+  def benchmark_sampled_softmax_logit(self):
+    self._run(
+        'sampled_softmax_logit',
+        losses_lib.RankingLossKey.SAMPLED_SOFTMAX_LOSS,
+        extra_args={
+            'num_sampled_negatives': self._NUM_SAMPLED_NEGATIVES,
+            'negative_sampling': losses_lib.NegativeSamplingKey.LOGIT
+        })
+
+
+class UnsortedPairsBenchmark(tf.test.Benchmark):
+  """Benchmarks the pairwise logistic loss on sorted and unsorted pairs."""
+
+  _LIST_SIZE = 1000
+  _BATCH_SIZE = 8
+
+  def _run(self, name, lambda_weight, unsorted_pairs):
+    random_state = np.random.RandomState(1)
+    shape = [self._BATCH_SIZE, self._LIST_SIZE]
+    with tf.Graph().as_default():
+      logits = tf.Variable(random_state.normal(size=shape).astype(np.float32))
+      loss = losses_lib._pairwise_logistic_loss(  # pylint: disable=protected-access
+          tf.constant(random_state.randint(0, 3, size=shape).astype(
+              np.float32)),
+          logits,
+          lambda_weight=lambda_weight,
+          unsorted_pairs=unsorted_pairs)
+      grad, = tf.gradients(ys=loss, xs=[logits])
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        self.run_op_benchmark(
+            sess, [loss, grad],
+            min_iters=10,
+            name=name,
+            extras={'list_size': self._LIST_SIZE})
+
+  def benchmark_without_lambda_weight(self):
+    self._run('without_lambda_weight', None, False)
+
+  def benchmark_sorted_lambda_weight(self):
+    self._run('sorted_lambda_weight', losses_lib.create_ndcg_lambda_weight(),
+              False)
+
+  def benchmark_unsorted_lambda_weight(self):
+    self._run('unsorted_lambda_weight',
+              losses_lib.create_ndcg_lambda_weight(), True)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -19,6 +19,8 @@ from __future__ import division
 from __future__ import print_function
 
 import math
+from absl.testing import parameterized
+import numpy as np
 import tensorflow as tf
 
 from tensorflow_ranking.python import losses as ranking_losses
@@ -125,6 +127,65 @@ class DCGLambdaWeightTest(tf.test.TestCase):
           lambda_weight.pair_weights(sorted_labels).eval(),
           [[[0., 1. / 2. / max_dcg], [1. / 2. / max_dcg, 0.]]])
 
+  def test_rank_pair_table(self):
+    labels = [[2.0, 1.0, 0.0, 1.0], [0.0, 3.0, -1.0, 1.0]]
+    lambda_weight = ranking_losses.create_ndcg_lambda_weight(
+        topn=3, smooth_fraction=0.5)
+    # The static list size uses a cached table of the rank discounts.
+    static_weights = lambda_weight.pair_weights(tf.constant(labels))
+    self.assertEqual(list(lambda_weight._rank_pair_tables), [4])
+    table = lambda_weight._rank_pair_tables[4]
+    self.assertEqual(table.shape, (4, 4))
+    lambda_weight.pair_weights(tf.constant(labels))
+    self.assertIs(lambda_weight._rank_pair_tables[4], table)
+    # A subset of the pairs, as in the blocked and sparse losses, gathers from
+    # the same table.
+    rows = tf.constant([[0, 2, 3, 1]])
+    cols = tf.constant([[1, 0, 2, 3]])
+    subset_weights = lambda_weight._pair_weights_at(
+        tf.constant(labels), rows, cols)
+    # The unknown list size computes the rank discounts in the graph.
+    placeholder = tf.compat.v1.placeholder(tf.float32, shape=[None, None])
+    dynamic_weights = lambda_weight.pair_weights(placeholder)
+    dynamic_subset_weights = lambda_weight._pair_weights_at(
+        placeholder, rows, cols)
+    with self.cached_session() as sess:
+      (static_weights, subset_weights, dynamic_weights,
+       dynamic_subset_weights) = sess.run(
+           [static_weights, subset_weights, dynamic_weights,
+            dynamic_subset_weights],
+           feed_dict={placeholder: labels})
+      self.assertAllClose(static_weights, dynamic_weights)
+      self.assertAllClose(subset_weights, dynamic_subset_weights)
+      self.assertAllClose(subset_weights,
+                          static_weights[:, [0, 2, 3, 1], [1, 0, 2, 3]])
+
+  def test_rank_pair_table_with_tensor_discount(self):
+    labels = [[2.0, 1.0, 0.0], [0.0, 3.0, 1.0]]
+    lambda_weight = ranking_losses.DCGLambdaWeight(
+        rank_discount_fn=lambda rank: tf.math.rsqrt(rank))
+    static_weights = lambda_weight.pair_weights(tf.constant(labels))
+    # A `Tensor` rank discount is evaluated in a separate graph for the table.
+    self.assertEqual(lambda_weight._rank_pair_tables[3].shape, (3, 3))
+    self.assertEmpty([
+        op for op in tf.compat.v1.get_default_graph().get_operations()
+        if op.type == 'Rsqrt'
+    ])
+    # A rank discount with a `Tensor` of the caller's graph has no table.
+    exponent = tf.constant(0.5)
+    closure_weight = ranking_losses.DCGLambdaWeight(
+        rank_discount_fn=lambda rank: tf.pow(rank, -exponent))
+    closure_weights = closure_weight.pair_weights(tf.constant(labels))
+    self.assertIsNone(closure_weight._rank_pair_tables[3])
+    placeholder = tf.compat.v1.placeholder(tf.float32, shape=[None, None])
+    dynamic_weights = lambda_weight.pair_weights(placeholder)
+    with self.cached_session() as sess:
+      static_weights, closure_weights, dynamic_weights = sess.run(
+          [static_weights, closure_weights, dynamic_weights],
+          feed_dict={placeholder: labels})
+      self.assertAllClose(static_weights, dynamic_weights)
+      self.assertAllClose(closure_weights, dynamic_weights)
+
   def test_create_p_list_mle_lambda_weight(self):
     sorted_labels = [[1.0, 2.0]]
     lambda_weight = ranking_losses.create_p_list_mle_lambda_weight(2)
@@ -155,6 +216,20 @@ class PrecisionLambdaWeightTest(tf.test.TestCase):
           lambda_weight.pair_weights(sorted_labels).eval(),
           [[[0., 0., 1.], [0., 0., 0.], [1., 0., 0.]]])
 
+  def test_rank_pair_table(self):
+    labels = [[2.0, 1.0, 0.0], [0.0, 1.0, 1.0]]
+    lambda_weight = ranking_losses.PrecisionLambdaWeight(topn=1)
+    static_weights = lambda_weight.pair_weights(tf.constant(labels))
+    self.assertEqual(list(lambda_weight._rank_pair_tables), [3])
+    placeholder = tf.compat.v1.placeholder(tf.float32, shape=[None, None])
+    dynamic_weights = lambda_weight.pair_weights(placeholder)
+    with self.cached_session() as sess:
+      static_weights, dynamic_weights = sess.run(
+          [static_weights, dynamic_weights], feed_dict={placeholder: labels})
+      self.assertAllClose(static_weights, dynamic_weights)
+      self.assertAllClose(static_weights[1],
+                          [[0., 1., 1.], [1., 0., 0.], [1., 0., 0.]])
+
 
 def _pairwise_loss(labels, scores, weights, loss_form, rank_discount_form=None):
   """Returns the pairwise loss given the loss form.
@@ -683,6 +758,61 @@ class LossesTest(tf.test.TestCase):
             (3*ln(3./(3+2+1)) + 1*ln(2./(2+1)) + 0*ln(1./1))) / 3,
           places=5)
 
+  def test_top_k_list_mle_loss(self):
+    scores = [[0., ln(3), ln(2)],
+              [0., ln(2), ln(3)],
+              [0., ln(2), ln(3)]]
+    labels = [[0., 2., 1.],
+              [1., 0., 2.],
+              [0., -1., 1.]]
+
+    with self.cached_session():
+      self.assertAlmostEqual(
+          ranking_losses._list_mle_loss(labels, scores, topn=1).eval(),
+          -(ln(3./(3+2+1)) + ln(3./(3+2+1)) + ln(3./(3+1))) / 3,
+          places=5)
+      self.assertAlmostEqual(
+          ranking_losses._list_mle_loss(labels, scores, topn=2).eval(),
+          -((ln(3./(3+2+1)) + ln(2./(2+1))) +
+            (ln(3./(3+2+1)) + ln(1./(1+2))) +
+            (ln(3./(3+1)) + ln(1./1))) / 3,
+          places=5)
+      # The invalid item does not contribute.
+      self.assertAlmostEqual(
+          ranking_losses._list_mle_loss(labels, scores, topn=3).eval(),
+          -((ln(3./(3+2+1)) + ln(2./(2+1)) + ln(1./1)) +
+            (ln(3./(3+2+1)) + ln(1./(1+2)) + ln(2./2)) +
+            (ln(3./(3+1)) + ln(1./1))) / 3,
+          places=5)
+
+  def test_top_k_list_mle_loss_matches_full_list(self):
+    logits = tf.constant([[1., 3., 2., -1.], [4., -2., 0., 1.]])
+    labels = [[0., 3., 1., 2.], [1., 0., 3., 2.]]
+    lw = ranking_losses.create_p_list_mle_lambda_weight(4)
+    full_loss = ranking_losses._list_mle_loss(
+        labels, logits, lambda_weight=lw, seed=1)
+    top_k_loss = ranking_losses._list_mle_loss(
+        labels, logits, lambda_weight=lw, seed=1, topn=10)
+    with self.cached_session() as sess:
+      self.assertAllClose(
+          sess.run([full_loss] + tf.gradients(ys=full_loss, xs=[logits])),
+          sess.run([top_k_loss] + tf.gradients(ys=top_k_loss, xs=[logits])))
+
+  def test_top_k_list_mle_loss_ties(self):
+    scores = [[0., ln(2), ln(3)]]
+    labels = [[1., 1., 0.]]
+    with self.cached_session():
+      for seed in range(5):
+        loss = ranking_losses._list_mle_loss(
+            labels, scores, seed=seed, topn=1).eval()
+        self.assertTrue(
+            np.isclose(loss, -ln(1. / 6)) or np.isclose(loss, -ln(2. / 6)),
+            loss)
+
+  def test_top_k_list_mle_loss_invalid_topn(self):
+    with self.assertRaises(ValueError):
+      ranking_losses._list_mle_loss([[1., 0.]], [[1., 2.]], topn=0)
+
   def test_make_list_mle_loss_fn(self):
     scores = [[0., ln(3), ln(2)],
               [0., ln(2), ln(3)]]
@@ -746,6 +876,79 @@ class LossesTest(tf.test.TestCase):
           -(2 * (1/(3/ln(2) + 1/ln(3))) * (3/ln(4) + 1/ln(3)) +
             1 * (1/(7/ln(2) + 1/ln(3))) * (7/ln(2) + 1/ln(4))),
           places=5)
+      self.assertAlmostEqual(
+          ranking_losses._approx_ndcg_loss(
+              labels, scores, weights, block_size=2).eval(),
+          -(2 * (1/(3/ln(2) + 1/ln(3))) * (3/ln(4) + 1/ln(3)) +
+            1 * (1/(7/ln(2) + 1/ln(3))) * (7/ln(2) + 1/ln(4))),
+          places=5)
+
+  def test_approx_ndcg_loss_with_topn(self):
+    scores = [[1.4, -2.8, -0.4],
+              [0., 1.8, 10.2],
+              [1., 1.2, -3.2]]
+    labels = [[0., 2., 1.],
+              [1., 0., 3.],
+              [0., 0., 0.]]
+
+    def cutoff(rank, topn):
+      # The smooth cutoff with the default alpha of 10.
+      return 1. / (1. + math.exp(-10. * (topn + .5 - rank)))
+
+    with self.cached_session():
+      self.assertAlmostEqual(
+          ranking_losses._approx_ndcg_loss(labels, scores, topn=2).eval(),
+          -((1/(3/ln(2) + 1/ln(3))) *
+            (3/ln(4) * cutoff(3, 2) + 1/ln(3) * cutoff(2, 2)) +
+            (1/(7/ln(2) + 1/ln(3))) *
+            (7/ln(2) * cutoff(1, 2) + 1/ln(4) * cutoff(3, 2))),
+          places=5)
+      self.assertAlmostEqual(
+          ranking_losses._approx_ndcg_loss(
+              labels, scores, topn=1, num_candidates=2).eval(),
+          -((1/(3/ln(2))) * (1/ln(3) * cutoff(2, 1)) +
+            (1/(7/ln(2))) * (7/ln(2) * cutoff(1, 1))),
+          places=5)
+
+  def test_approx_ndcg_loss_with_topn_gradient_below_cutoff(self):
+    # The relevant item is ranked third, below the cutoff at 2.
+    scores = tf.constant([[.3, .2, 0.]])
+    labels = [[0., 0., 1.]]
+    loss = ranking_losses._approx_ndcg_loss(labels, scores, topn=2)
+    grad, = tf.gradients(ys=loss, xs=[scores])
+    with self.cached_session():
+      grad = grad.eval()
+    # Raising its logit and lowering the others decreases the loss.
+    self.assertLess(grad[0, 2], 0.)
+    self.assertGreater(grad[0, 0], 0.)
+    self.assertGreater(grad[0, 1], 0.)
+
+  def test_approx_ndcg_loss_with_candidates(self):
+    random_state = np.random.RandomState(5)
+    scores = random_state.normal(size=[4, 200]).astype(np.float32)
+    labels = random_state.randint(0, 5, size=[4, 200]).astype(np.float32)
+    labels[random_state.uniform(size=[4, 200]) < 0.7] = 0.
+    labels[:, 190:] = -1.
+    scores = tf.constant(scores)
+    loss = ranking_losses._approx_ndcg_loss(labels, scores, topn=10)
+    candidate_loss = ranking_losses._approx_ndcg_loss(
+        labels, scores, topn=10, num_candidates=40)
+    # All the candidates give the same ranks.
+    full_candidate_loss = ranking_losses._approx_ndcg_loss(
+        labels, scores, topn=10, num_candidates=200)
+    grads = tf.gradients(ys=[loss, candidate_loss], xs=[scores])
+    with self.cached_session() as sess:
+      loss, candidate_loss, full_candidate_loss = sess.run(
+          [loss, candidate_loss, full_candidate_loss])
+      self.assertAllClose(loss, full_candidate_loss)
+      self.assertAllClose(loss, candidate_loss, rtol=1e-3)
+      self.assertNotIn(None, grads)
+
+    with self.assertRaises(ValueError):
+      ranking_losses._approx_ndcg_loss(labels, scores, num_candidates=40)
+    with self.assertRaises(ValueError):
+      ranking_losses._approx_ndcg_loss(
+          labels, scores, topn=10, num_candidates=5)
 
   def test_make_approx_ndcg_fn(self):
     scores = [[1.4, -2.8, -0.4],
@@ -874,6 +1077,66 @@ class LossesTest(tf.test.TestCase):
                                    r'Invalid loss_key: invalid_key.'):
         invalid_loss_fn(labels, scores, features).eval()
 
+  def test_make_loss_fn_shares_sorting(self):
+    scores = [[0.2, 0.5, 0.3, 0.1], [0.2, 0.3, 0.5, 0.4]]
+    labels = [[0., 2., 1., -1.], [0., 0., 1., 1.]]
+    features = {'weights': [[2.], [1.]]}
+    loss_keys = [
+        ranking_losses.RankingLossKey.PAIRWISE_HINGE_LOSS,
+        ranking_losses.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,
+        ranking_losses.RankingLossKey.SOFTMAX_LOSS,
+        ranking_losses.RankingLossKey.SIGMOID_CROSS_ENTROPY_LOSS,
+        ranking_losses.RankingLossKey.MEAN_SQUARED_LOSS,
+    ]
+    with tf.Graph().as_default():
+      loss = ranking_losses.make_loss_fn(
+          loss_keys, weights_feature_name='weights')(labels, scores, features)
+      # The lists are sorted once for all the losses.
+      self.assertLen([
+          op for op in tf.compat.v1.get_default_graph().get_operations()
+          if op.type == 'TopKV2'
+      ], 1)
+      expected = tf.add_n([
+          ranking_losses.make_loss_fn(
+              loss_key, weights_feature_name='weights')(labels, scores,
+                                                        features)
+          for loss_key in loss_keys
+      ])
+      with tf.compat.v1.Session() as sess:
+        loss, expected = sess.run([loss, expected])
+    self.assertAllClose(loss, expected)
+
+  def test_make_loss_fn_with_ideal_dcg(self):
+    scores = [[0.2, 0.5, 0.3, 0.1], [0.2, 0.3, 0.5, 0.4]]
+    labels = [[0., 2., 1., -1.], [0., 0., 1., 1.]]
+    ideal_dcg = [[3. / ln(2.) + 1. / ln(3.)], [1. / ln(2.) + 1. / ln(3.)]]
+    loss_keys = [
+        ranking_losses.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,
+        ranking_losses.RankingLossKey.SOFTMAX_LOSS,
+        ranking_losses.RankingLossKey.APPROX_NDCG_LOSS,
+    ]
+    lambda_weight = ranking_losses.create_ndcg_lambda_weight()
+    with tf.Graph().as_default():
+      loss = ranking_losses.make_loss_fn(
+          loss_keys,
+          lambda_weight=lambda_weight,
+          ideal_dcg_feature_name='ideal_dcg')(labels, scores, {
+              'ideal_dcg': ideal_dcg
+          })
+      # The labels are not sorted for the ideal DCG.
+      self.assertLen([
+          op for op in tf.compat.v1.get_default_graph().get_operations()
+          if op.type == 'TopKV2'
+      ], 1)
+      # Without the feature, the ideal DCG is computed from the labels.
+      expected = ranking_losses.make_loss_fn(
+          loss_keys,
+          lambda_weight=lambda_weight,
+          ideal_dcg_feature_name='ideal_dcg')(labels, scores, {})
+      with tf.compat.v1.Session() as sess:
+        loss, expected = sess.run([loss, expected])
+    self.assertAllClose(loss, expected)
+
   def test_pairwise_logistic_loss_with_invalid_labels(self):
     scores = [[1., 3., 2.]]
     labels = [[0., -1., 1.]]
@@ -911,5 +1174,742 @@ class LossesTest(tf.test.TestCase):
           places=5)
 
 
+class BlockedPairwiseLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(BlockedPairwiseLossTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+    random_state = np.random.RandomState(7)
+    self._scores = random_state.normal(size=[3, 7]).astype(np.float32)
+    labels = random_state.randint(0, 4, size=[3, 7]).astype(np.float32)
+    labels[0, 5:] = -1.
+    self._labels = labels
+    self._weights = random_state.uniform(size=[3, 7]).astype(np.float32)
+
+  @parameterized.parameters(
+      (ranking_losses._pairwise_hinge_loss,),
+      (ranking_losses._pairwise_logistic_loss,),
+      (ranking_losses._pairwise_soft_zero_one_loss,))
+  def test_matches_dense_loss_and_gradients(self, loss_fn):
+    lambda_weights = [
+        None,
+        ranking_losses.create_ndcg_lambda_weight(topn=3, smooth_fraction=0.5),
+        ranking_losses.PrecisionLambdaWeight(topn=2),
+    ]
+    reductions = [
+        tf.compat.v1.losses.Reduction.SUM,
+        tf.compat.v1.losses.Reduction.MEAN,
+        tf.compat.v1.losses.Reduction.SUM_OVER_BATCH_SIZE,
+        tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
+    ]
+    scores = tf.constant(self._scores)
+    expected, actual = [], []
+    for lambda_weight in lambda_weights:
+      for reduction in reductions:
+        dense_loss = loss_fn(
+            self._labels,
+            scores,
+            weights=self._weights,
+            lambda_weight=lambda_weight,
+            reduction=reduction)
+        dense_grad, = tf.gradients(ys=dense_loss, xs=[scores])
+        for block_size in [1, 3, 10]:
+          blocked_loss = loss_fn(
+              self._labels,
+              scores,
+              weights=self._weights,
+              lambda_weight=lambda_weight,
+              reduction=reduction,
+              block_size=block_size)
+          blocked_grad, = tf.gradients(ys=blocked_loss, xs=[scores])
+          expected.append((dense_loss, dense_grad))
+          actual.append((blocked_loss, blocked_grad))
+    with self.cached_session() as sess:
+      expected, actual = sess.run([expected, actual])
+    for (expected_loss, expected_grad), (loss, grad) in zip(expected, actual):
+      self.assertAllClose(expected_loss, loss, rtol=1e-5, atol=1e-6)
+      self.assertAllClose(expected_grad, grad, rtol=1e-5, atol=1e-6)
+
+  def test_max_dcg_outside_of_tiles(self):
+    lambda_weight = ranking_losses.create_ndcg_lambda_weight(topn=3)
+    ranking_losses._pairwise_logistic_loss(
+        self._labels, self._scores, lambda_weight=lambda_weight, block_size=1)
+    # The labels are only sorted once for the max DCG, not once per tile.
+    self.assertEmpty([
+        op for op in tf.compat.v1.get_default_graph().get_operations()
+        if op.type == 'TopKV2' and 'while/' in op.name
+    ])
+
+  def test_make_loss_fn_with_block_size(self):
+    features = {}
+    loss_keys = [
+        ranking_losses.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,
+        ranking_losses.RankingLossKey.SOFTMAX_LOSS,
+    ]
+    # `block_size` is only passed to the pairwise loss.
+    blocked_loss_fn = ranking_losses.make_loss_fn(
+        loss_keys, extra_args={'block_size': 2})
+    loss_fn = ranking_losses.make_loss_fn(loss_keys)
+    with self.cached_session():
+      self.assertAllClose(
+          blocked_loss_fn(self._labels, self._scores, features).eval(),
+          loss_fn(self._labels, self._scores, features).eval())
+
+  def test_invalid_block_size(self):
+    with self.assertRaises(ValueError):
+      ranking_losses._pairwise_hinge_loss(
+          self._labels, self._scores, block_size=0)
+
+  def test_lambda_weight_pair_weights_at(self):
+    sorted_labels = self._labels
+    rows = tf.constant([[[4], [0]]])
+    cols = tf.constant([[[1, 6, 0]]])
+    for lambda_weight in [
+        ranking_losses.create_ndcg_lambda_weight(topn=3),
+        ranking_losses.create_reciprocal_rank_lambda_weight(),
+        ranking_losses.PrecisionLambdaWeight(topn=2),
+    ]:
+      pair_weights = lambda_weight.pair_weights(sorted_labels)
+      # Fallback of the base class.
+      expected = super(type(lambda_weight), lambda_weight)._pair_weights_at(
+          sorted_labels, rows, cols)
+      with self.cached_session() as sess:
+        pair_weights, expected, actual = sess.run([
+            pair_weights, expected,
+            lambda_weight._pair_weights_at(sorted_labels, rows, cols)
+        ])
+      self.assertAllClose(pair_weights[:, [4, 0], :][:, :, [1, 6, 0]],
+                          expected)
+      self.assertAllClose(expected, actual)
+
+
+class UnsortedPairwiseLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(UnsortedPairwiseLossTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+    random_state = np.random.RandomState(5)
+    self._scores = random_state.normal(size=[3, 6]).astype(np.float32)
+    labels = random_state.randint(0, 4, size=[3, 6]).astype(np.float32)
+    labels[0, 4:] = -1.
+    self._labels = labels
+    self._weights = random_state.uniform(size=[3, 6]).astype(np.float32)
+
+  @parameterized.parameters(
+      (None,),
+      (ranking_losses.create_ndcg_lambda_weight(topn=3, smooth_fraction=0.5),),
+      (ranking_losses.PrecisionLambdaWeight(topn=2),))
+  def test_matches_sorted_pairwise_comparison(self, lambda_weight):
+    sorted_labels, sorted_logits, sorted_weights = (
+        ranking_losses._sort_and_normalize(self._labels, self._scores,
+                                           self._weights))
+    expected = ranking_losses._pairwise_comparison(
+        sorted_labels, sorted_logits, sorted_weights, lambda_weight)
+    actual = ranking_losses._unsorted_pairwise_comparison(
+        self._labels, self._scores, self._weights, lambda_weight)
+    _, positions = ranking_losses._sorted_positions(self._labels, self._scores)
+    with self.cached_session() as sess:
+      expected, actual, positions = sess.run([expected, actual, positions])
+    for expected_pairs, pairs in zip(expected, actual):
+      for b, list_positions in enumerate(positions):
+        self.assertAllClose(
+            expected_pairs[b][list_positions][:, list_positions], pairs[b])
+
+  def test_sorted_positions(self):
+    labels = [[0., 2., -1., 1.]]
+    scores = [[1., 3., 4., 2.]]
+    sorted_labels, positions = ranking_losses._sorted_positions(labels, scores)
+    with self.cached_session() as sess:
+      sorted_labels, positions = sess.run([sorted_labels, positions])
+    # The item with an invalid label is placed last.
+    self.assertAllEqual(positions, [[2, 0, 3, 1]])
+    self.assertAllEqual(sorted_labels, [[2., 1., 0., -1.]])
+
+  @parameterized.parameters(
+      (ranking_losses._pairwise_hinge_loss,),
+      (ranking_losses._pairwise_logistic_loss,),
+      (ranking_losses._pairwise_soft_zero_one_loss,))
+  def test_matches_sorted_loss_and_gradients(self, loss_fn):
+    scores = tf.constant(self._scores)
+    expected, actual = [], []
+    for lambda_weight in [
+        ranking_losses.create_ndcg_lambda_weight(topn=3, smooth_fraction=0.5),
+        ranking_losses.PrecisionLambdaWeight(topn=2),
+    ]:
+      for reduction in [
+          tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
+          tf.compat.v1.losses.Reduction.NONE,
+      ]:
+        for unsorted_pairs, losses in [(False, expected), (True, actual)]:
+          loss = loss_fn(
+              self._labels,
+              scores,
+              weights=self._weights,
+              lambda_weight=lambda_weight,
+              reduction=reduction,
+              unsorted_pairs=unsorted_pairs)
+          losses.append((loss, tf.gradients(ys=loss, xs=[scores])[0]))
+    with self.cached_session() as sess:
+      expected, actual = sess.run([expected, actual])
+    for (expected_loss, expected_grad), (loss, grad) in zip(expected, actual):
+      self.assertAllClose(expected_loss, loss, rtol=1e-5, atol=1e-6)
+      self.assertAllClose(expected_grad, grad, rtol=1e-5, atol=1e-6)
+
+  def test_no_sort_without_lambda_weight(self):
+    ranking_losses._pairwise_logistic_loss(self._labels, self._scores)
+    self.assertEmpty([
+        op for op in tf.compat.v1.get_default_graph().get_operations()
+        if op.type == 'TopKV2'
+    ])
+
+  def test_gradient_has_no_gathers(self):
+    scores = tf.constant(self._scores)
+    loss = ranking_losses._pairwise_logistic_loss(
+        self._labels,
+        scores,
+        weights=self._weights,
+        lambda_weight=ranking_losses.create_ndcg_lambda_weight(topn=3),
+        unsorted_pairs=True)
+    grad, = tf.gradients(ys=loss, xs=[scores])
+    gathers = [
+        op for op in tf.compat.v1.get_default_graph().get_operations()
+        if op.type in ('GatherV2', 'ScatterNd', 'UnsortedSegmentSum')
+    ]
+    # The only gathers and scatters are of the labels and the ranks.
+    self.assertNotIn(scores, [op.inputs[0] for op in gathers])
+    self.assertEmpty(
+        [op for op in gathers if op.name.startswith('gradients/')])
+    self.assertIsNotNone(grad)
+
+  def test_invalid_options(self):
+    with self.assertRaises(ValueError):
+      ranking_losses._pairwise_hinge_loss(
+          self._labels, self._scores, unsorted_pairs=True, sparse_pairs=True)
+
+
+class SampledPairwiseLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(SampledPairwiseLossTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+    random_state = np.random.RandomState(3)
+    self._scores = random_state.normal(size=[2, 8]).astype(np.float32)
+    labels = random_state.randint(0, 4, size=[2, 8]).astype(np.float32)
+    labels[0, 6:] = -1.
+    self._labels = labels
+
+  @parameterized.parameters(ranking_losses.PairSamplingKey.UNIFORM,
+                            ranking_losses.PairSamplingKey.STRATIFIED)
+  def test_sampled_pairs(self, pair_sampling):
+    labels = [[0., 2., 1., 2., -1.], [1., 1., 1., 0., 0.],
+              [1., 1., -1., 0., 1.], [3., 3., 3., 3., 3.]]
+    rows, cols, importance_weights = ranking_losses._sample_pairs(
+        tf.constant(labels), 5000, pair_sampling, seed=1)
+    with self.cached_session() as sess:
+      rows, cols, importance_weights = sess.run(
+          [rows, cols, importance_weights])
+    labels = np.array(labels)
+    row_labels = np.take_along_axis(labels, rows, axis=1)
+    col_labels = np.take_along_axis(labels, cols, axis=1)
+    # All pairs with l_i > l_j and 0 importance weights without any.
+    self.assertTrue(np.all(row_labels[:3] > col_labels[:3]))
+    self.assertTrue(np.all(col_labels[:3] >= 0.))
+    self.assertAllEqual(importance_weights[3], np.zeros([5000]))
+    # The importance weights sum to the number of pairs in expectation.
+    self.assertAllClose(
+        np.sum(importance_weights, axis=1), [5., 6., 3., 0.], rtol=0.05)
+    if pair_sampling == ranking_losses.PairSamplingKey.STRATIFIED:
+      # The grade pairs (1, 0), (2, 0) and (2, 1) are equally likely.
+      grade_pairs = list(zip(row_labels[0], col_labels[0]))
+      for grade_pair in [(1., 0.), (2., 0.), (2., 1.)]:
+        self.assertAllClose(
+            grade_pairs.count(grade_pair) / 5000., 1. / 3., atol=0.03)
+
+  @parameterized.parameters(
+      (ranking_losses._pairwise_hinge_loss,
+       ranking_losses.PairSamplingKey.UNIFORM),
+      (ranking_losses._pairwise_logistic_loss,
+       ranking_losses.PairSamplingKey.STRATIFIED),
+      (ranking_losses._pairwise_soft_zero_one_loss,
+       ranking_losses.PairSamplingKey.UNIFORM))
+  def test_matches_dense_loss_in_expectation(self, loss_fn, pair_sampling):
+    lambda_weights = [
+        None,
+        ranking_losses.create_ndcg_lambda_weight(topn=3),
+        ranking_losses.PrecisionLambdaWeight(topn=2),
+    ]
+    reductions = [
+        tf.compat.v1.losses.Reduction.SUM,
+        tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
+    ]
+    expected, actual = [], []
+    for lambda_weight in lambda_weights:
+      for reduction in reductions:
+        expected.append(
+            loss_fn(
+                self._labels,
+                self._scores,
+                lambda_weight=lambda_weight,
+                reduction=reduction))
+        actual.append(
+            loss_fn(
+                self._labels,
+                self._scores,
+                lambda_weight=lambda_weight,
+                reduction=reduction,
+                num_sampled_pairs=20000,
+                pair_sampling=pair_sampling,
+                seed=1))
+    with self.cached_session() as sess:
+      expected, actual = sess.run([expected, actual])
+    self.assertAllClose(expected, actual, rtol=0.05)
+
+  def test_make_loss_fn_with_sampled_pairs(self):
+    loss_fn = ranking_losses.make_loss_fn(
+        ranking_losses.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,
+        reduction=tf.compat.v1.losses.Reduction.SUM,
+        seed=1,
+        extra_args={
+            'num_sampled_pairs': 20000,
+            'pair_sampling': ranking_losses.PairSamplingKey.STRATIFIED,
+        })
+    scores = tf.constant(self._scores)
+    loss = loss_fn(self._labels, scores, {})
+    grad, = tf.gradients(ys=loss, xs=[scores])
+    with self.cached_session() as sess:
+      self.assertAllClose(
+          sess.run(loss),
+          ranking_losses._pairwise_logistic_loss(
+              self._labels,
+              self._scores,
+              reduction=tf.compat.v1.losses.Reduction.SUM).eval(),
+          rtol=0.05)
+      # Gradients flow to the logits of the items in sampled pairs only.
+      self.assertAllEqual(sess.run(grad)[0, 6:], [0., 0.])
+
+  def test_invalid_args(self):
+    with self.assertRaises(ValueError):
+      ranking_losses._pairwise_hinge_loss(
+          self._labels, self._scores, num_sampled_pairs=0)
+    with self.assertRaises(ValueError):
+      ranking_losses._pairwise_hinge_loss(
+          self._labels, self._scores, num_sampled_pairs=4, block_size=2)
+    with self.assertRaises(ValueError):
+      ranking_losses._pairwise_hinge_loss(
+          self._labels,
+          self._scores,
+          num_sampled_pairs=4,
+          pair_sampling='invalid')
+
+
+class SampledSoftmaxLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(SampledSoftmaxLossTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+    # The last lists have no negatives or no positives.
+    self._labels = [[0., 2., 1., 0., 0.], [1., 0., 0., -1., 0.],
+                    [1., 1., 2., 2., -1.], [0., 0., 0., -1., 0.]]
+    self._scores = [[1., 2., .5, -1., 3.], [0., 1., -2., 4., .3],
+                    [1., 2., 3., 4., 5.], [1., 1., 1., 1., 1.]]
+    self._weights = [[2.], [1.], [1.], [3.]]
+
+  def test_logit_sampling_is_exact(self):
+    with self.cached_session():
+      self.assertAllClose(
+          ranking_losses._sampled_softmax_loss(
+              self._labels,
+              self._scores,
+              self._weights,
+              num_sampled_negatives=2,
+              negative_sampling=ranking_losses.NegativeSamplingKey.LOGIT,
+              seed=1).eval(),
+          ranking_losses._softmax_loss(self._labels, self._scores,
+                                       self._weights).eval())
+
+  @parameterized.parameters(ranking_losses.NegativeSamplingKey.UNIFORM,
+                            ranking_losses.NegativeSamplingKey.LOGIT)
+  def test_sampled_softmax_loss_and_gradients(self, negative_sampling):
+    scores = tf.constant(self._scores)
+    loss = ranking_losses._sampled_softmax_loss(
+        self._labels,
+        scores,
+        num_sampled_negatives=20000,
+        negative_sampling=negative_sampling,
+        seed=1)
+    expected_loss = ranking_losses._softmax_loss(self._labels, scores)
+    with self.cached_session() as sess:
+      self.assertAllClose(
+          sess.run([loss] + tf.gradients(ys=loss, xs=[scores])),
+          sess.run([expected_loss] +
+                   tf.gradients(ys=expected_loss, xs=[scores])),
+          atol=5e-3)
+
+  def test_sampled_softmax_loss_with_lambda_weight(self):
+    lambda_weight = ranking_losses.create_ndcg_lambda_weight()
+    with self.cached_session():
+      self.assertAllClose(
+          ranking_losses._sampled_softmax_loss(
+              self._labels,
+              self._scores,
+              lambda_weight=lambda_weight,
+              num_sampled_negatives=20000,
+              seed=1).eval(),
+          ranking_losses._softmax_loss(
+              self._labels, self._scores, lambda_weight=lambda_weight).eval(),
+          atol=5e-3)
+
+  def test_num_greater_in_sorted(self):
+    with self.cached_session():
+      self.assertAllEqual(
+          ranking_losses._num_greater_in_sorted(
+              tf.constant([[3., 2., 2., 1., float('-inf')],
+                           [1., 1., 1., 1., 1.]])).eval(),
+          [[0., 1., 1., 3., 4.], [0., 0., 0., 0., 0.]])
+      self.assertAllEqual(
+          ranking_losses._num_greater_in_sorted(tf.zeros([2, 0])).eval(),
+          tf.zeros([2, 0]).eval())
+
+  def test_make_sampled_softmax_loss_fn(self):
+    loss_fn = ranking_losses.make_loss_fn(
+        ranking_losses.RankingLossKey.SAMPLED_SOFTMAX_LOSS,
+        weights_feature_name='weights',
+        reduction=tf.compat.v1.losses.Reduction.NONE,
+        extra_args={
+            'num_sampled_negatives': 3,
+            'negative_sampling': ranking_losses.NegativeSamplingKey.LOGIT
+        })
+    with self.cached_session():
+      self.assertAllClose(
+          loss_fn(self._labels, self._scores, {
+              'weights': self._weights
+          }).eval(),
+          ranking_losses._softmax_loss(
+              self._labels,
+              self._scores,
+              self._weights,
+              reduction=tf.compat.v1.losses.Reduction.NONE).eval())
+
+  def test_invalid_args(self):
+    with self.assertRaises(ValueError):
+      ranking_losses._sampled_softmax_loss(
+          self._labels, self._scores, num_sampled_negatives=0)
+    with self.assertRaises(ValueError):
+      ranking_losses._sampled_softmax_loss(
+          self._labels, self._scores, negative_sampling='stratified')
+
+
+class SparsePairwiseLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(SparsePairwiseLossTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+
+  def test_contributing_pairs(self):
+    labels = [[0., 2., 1., -1.], [1., 0., 0., 0.], [1., 1., 1., 1.]]
+    rows, cols = ranking_losses._contributing_pairs(tf.constant(labels))
+    with self.cached_session() as sess:
+      rows, cols = sess.run([rows, cols])
+    self.assertEqual(rows.shape, (3, 3))
+    for list_labels, list_rows, list_cols in zip(labels, rows, cols):
+      pairs = set(zip(list_rows, list_cols)) - {(0, 0)}
+      expected_pairs = {(i, j)
+                        for i, label_i in enumerate(list_labels)
+                        for j, label_j in enumerate(list_labels)
+                        if label_i > label_j >= 0.}
+      self.assertEqual(pairs, expected_pairs)
+      self.assertEqual(
+          len(expected_pairs), np.count_nonzero(list_rows + list_cols))
+
+  @parameterized.parameters(
+      (ranking_losses._pairwise_hinge_loss,),
+      (ranking_losses._pairwise_logistic_loss,),
+      (ranking_losses._pairwise_soft_zero_one_loss,))
+  def test_matches_dense_loss_and_gradients(self, loss_fn):
+    random_state = np.random.RandomState(5)
+    scores = tf.constant(random_state.normal(size=[3, 9]).astype(np.float32))
+    labels = random_state.binomial(1, 0.2, size=[3, 9]).astype(np.float32)
+    labels[0, 7:] = -1.
+    labels[1] = 0.
+    weights = random_state.uniform(size=[3, 9]).astype(np.float32)
+    expected, actual = [], []
+    for lambda_weight in [
+        None,
+        ranking_losses.create_ndcg_lambda_weight(smooth_fraction=0.5),
+        ranking_losses.PrecisionLambdaWeight(topn=3),
+    ]:
+      for reduction in [
+          tf.compat.v1.losses.Reduction.SUM,
+          tf.compat.v1.losses.Reduction.MEAN,
+          tf.compat.v1.losses.Reduction.SUM_OVER_BATCH_SIZE,
+          tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
+      ]:
+        for sparse_pairs, outputs in [(False, expected), (True, actual)]:
+          loss = loss_fn(
+              labels,
+              scores,
+              weights=weights,
+              lambda_weight=lambda_weight,
+              reduction=reduction,
+              sparse_pairs=sparse_pairs)
+          outputs.append((loss, tf.gradients(ys=loss, xs=[scores])[0]))
+    with self.cached_session() as sess:
+      expected, actual = sess.run([expected, actual])
+    for (expected_loss, expected_grad), (loss, grad) in zip(expected, actual):
+      self.assertAllClose(expected_loss, loss, rtol=1e-5, atol=1e-6)
+      self.assertAllClose(expected_grad, grad, rtol=1e-5, atol=1e-6)
+
+  def test_invalid_args(self):
+    with self.assertRaises(ValueError):
+      ranking_losses._pairwise_hinge_loss([[1., 0.]], [[1., 2.]],
+                                          sparse_pairs=True,
+                                          block_size=1)
+
+
+class LambdaGradientPairwiseLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(LambdaGradientPairwiseLossTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+
+  @parameterized.parameters(
+      (ranking_losses._pairwise_hinge_loss,),
+      (ranking_losses._pairwise_logistic_loss,),
+      (ranking_losses._pairwise_soft_zero_one_loss,))
+  def test_matches_dense_loss_and_gradients(self, loss_fn):
+    random_state = np.random.RandomState(3)
+    scores = tf.constant(random_state.normal(size=[2, 6]).astype(np.float32))
+    labels = random_state.randint(0, 3, size=[2, 6]).astype(np.float32)
+    labels[1, 4:] = -1.
+    weights = random_state.uniform(size=[2, 1]).astype(np.float32)
+    expected, actual = [], []
+    for lambda_weight in [
+        None,
+        ranking_losses.create_ndcg_lambda_weight(topn=3),
+    ]:
+      for reduction in [
+          tf.compat.v1.losses.Reduction.SUM,
+          tf.compat.v1.losses.Reduction.MEAN,
+          tf.compat.v1.losses.Reduction.SUM_OVER_BATCH_SIZE,
+          tf.compat.v1.losses.Reduction.SUM_BY_NONZERO_WEIGHTS,
+      ]:
+        for lambda_gradients, outputs in [(False, expected), (True, actual)]:
+          loss = loss_fn(
+              labels,
+              scores,
+              weights=weights,
+              lambda_weight=lambda_weight,
+              reduction=reduction,
+              lambda_gradients=lambda_gradients)
+          outputs.append((loss, tf.gradients(ys=loss, xs=[scores])[0]))
+    with self.cached_session() as sess:
+      expected, actual = sess.run([expected, actual])
+    for (expected_loss, expected_grad), (loss, grad) in zip(expected, actual):
+      self.assertAllClose(expected_loss, loss, rtol=1e-5, atol=1e-6)
+      self.assertAllClose(expected_grad, grad, rtol=1e-5, atol=1e-6)
+
+  def test_gradient_does_not_use_pair_tensors(self):
+    scores = tf.compat.v1.placeholder(tf.float32, shape=[None, 4])
+    loss = ranking_losses._pairwise_logistic_loss([[1., 0., 2., 0.]],
+                                                  scores,
+                                                  lambda_gradients=True)
+    grad, = tf.gradients(ys=loss, xs=[scores])
+    pending = [grad.op]
+    visited = set()
+    while pending:
+      op = pending.pop()
+      if op in visited or 'gradients' not in op.name:
+        continue
+      visited.add(op)
+      for tensor in op.inputs:
+        self.assertLess(tensor.get_shape().ndims or 0, 3, tensor)
+        pending.append(tensor.op)
+
+  def test_invalid_args(self):
+    with self.assertRaises(ValueError):
+      ranking_losses._pairwise_hinge_loss([[1., 0.]], [[1., 2.]],
+                                          lambda_gradients=True,
+                                          sparse_pairs=True)
+
+
+class PerListLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(PerListLossTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+    self._labels = np.array(
+        [[0., 2., 1., -1.], [1., 0., 3., 2.], [0., 0., 0., 0.]],
+        dtype=np.float32)
+    self._scores = np.array(
+        [[1.4, -2.8, -0.4, 1.], [0., 1.8, 10.2, 1.], [1., 1.2, -3.2, 0.]],
+        dtype=np.float32)
+    self._features = {
+        'weights': np.array([[2.], [1.], [3.]], dtype=np.float32)
+    }
+
+  @parameterized.parameters(
+      (ranking_losses.RankingLossKey.PAIRWISE_HINGE_LOSS,),
+      (ranking_losses.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,),
+      (ranking_losses.RankingLossKey.PAIRWISE_SOFT_ZERO_ONE_LOSS,),
+      (ranking_losses.RankingLossKey.SOFTMAX_LOSS,),
+      (ranking_losses.RankingLossKey.SAMPLED_SOFTMAX_LOSS,),
+      (ranking_losses.RankingLossKey.SIGMOID_CROSS_ENTROPY_LOSS,),
+      (ranking_losses.RankingLossKey.MEAN_SQUARED_LOSS,),
+      (ranking_losses.RankingLossKey.LIST_MLE_LOSS,),
+      (ranking_losses.RankingLossKey.APPROX_NDCG_LOSS,))
+  def test_per_list_losses_sum_to_sum_reduction(self, loss_key):
+    per_list_losses, summed = [
+        ranking_losses.make_loss_fn(
+            loss_key,
+            weights_feature_name='weights',
+            reduction=reduction,
+            seed=1)(self._labels, self._scores, self._features)
+        for reduction in [
+            tf.compat.v1.losses.Reduction.NONE,
+            tf.compat.v1.losses.Reduction.SUM
+        ]
+    ]
+    self.assertEqual(per_list_losses.get_shape().ndims, 1)
+    with self.cached_session() as sess:
+      per_list_losses, summed = sess.run([per_list_losses, summed])
+    self.assertEqual(per_list_losses.shape, (3,))
+    self.assertAllClose(np.sum(per_list_losses), summed)
+
+  @parameterized.parameters(
+      ({'block_size': 2},),
+      ({'lambda_gradients': True},),
+      ({'sparse_pairs': True},))
+  def test_pairwise_options(self, options):
+    scores = tf.constant(self._scores)
+    dy = np.array([1., 2., 3.], dtype=np.float32)
+    outputs = []
+    for kwargs in [{}, options]:
+      loss = ranking_losses._pairwise_logistic_loss(
+          self._labels,
+          scores,
+          lambda_weight=ranking_losses.create_ndcg_lambda_weight(),
+          reduction=tf.compat.v1.losses.Reduction.NONE,
+          **kwargs)
+      outputs.append(
+          (loss, tf.gradients(ys=loss, xs=[scores], grad_ys=[dy])[0]))
+    with self.cached_session() as sess:
+      expected, actual = sess.run(outputs)
+    self.assertAllClose(expected[0], actual[0])
+    self.assertAllClose(expected[1], actual[1])
+
+  def test_sampled_pairs(self):
+    loss = ranking_losses._pairwise_logistic_loss(
+        self._labels,
+        self._scores,
+        reduction=tf.compat.v1.losses.Reduction.NONE,
+        num_sampled_pairs=4,
+        seed=1)
+    with self.cached_session() as sess:
+      self.assertEqual(sess.run(loss).shape, (3,))
+
+
+class XlaLossesTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(XlaLossesTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+
+  @parameterized.parameters(
+      (ranking_losses.RankingLossKey.PAIRWISE_HINGE_LOSS,),
+      (ranking_losses.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,),
+      (ranking_losses.RankingLossKey.PAIRWISE_SOFT_ZERO_ONE_LOSS,),
+      (ranking_losses.RankingLossKey.SOFTMAX_LOSS,),
+      (ranking_losses.RankingLossKey.SIGMOID_CROSS_ENTROPY_LOSS,),
+      (ranking_losses.RankingLossKey.MEAN_SQUARED_LOSS,),
+      (ranking_losses.RankingLossKey.LIST_MLE_LOSS,),
+      (ranking_losses.RankingLossKey.APPROX_NDCG_LOSS,))
+  def test_xla_compiled_loss(self, loss_key):
+    # Labels without ties make ListMLE deterministic. The last list is masked
+    # out by the losses that skip lists without relevant items.
+    labels = np.array(
+        [[0., 2., 1., -1.], [1., 0., 3., 2.], [0., -1., -1., -1.]],
+        dtype=np.float32)
+    scores = np.array([[1.4, -2.8, -0.4, 1.], [0., 1.8, 10.2, 1.],
+                       [1., 1.2, -3.2, 0.]],
+                      dtype=np.float32)
+    features = {'weights': np.array([[2.], [1.], [1.]], dtype=np.float32)}
+    loss_fn = ranking_losses.make_loss_fn(
+        loss_key, weights_feature_name='weights', seed=1)
+
+    def _loss_and_grad(labels, scores):
+      loss = loss_fn(labels, scores, features)
+      return loss, tf.gradients(ys=loss, xs=[scores])[0]
+
+    expected = _loss_and_grad(tf.constant(labels), tf.constant(scores))
+    actual = tf.compat.v1.xla.experimental.compile(
+        _loss_and_grad, [tf.constant(labels), tf.constant(scores)])
+    with self.cached_session() as sess:
+      expected, actual = sess.run([expected, actual])
+    self.assertAllClose(expected[0], actual[0], rtol=1e-5)
+    self.assertAllClose(expected[1], actual[1], rtol=1e-5, atol=1e-6)
+
+
+class MixedPrecisionLossesTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(MixedPrecisionLossesTest, self).setUp()
+    tf.compat.v1.reset_default_graph()
+
+  @parameterized.parameters(
+      (ranking_losses.RankingLossKey.PAIRWISE_HINGE_LOSS,),
+      (ranking_losses.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,),
+      (ranking_losses.RankingLossKey.PAIRWISE_SOFT_ZERO_ONE_LOSS,),
+      (ranking_losses.RankingLossKey.SOFTMAX_LOSS,),
+      (ranking_losses.RankingLossKey.SAMPLED_SOFTMAX_LOSS,),
+      (ranking_losses.RankingLossKey.SIGMOID_CROSS_ENTROPY_LOSS,),
+      (ranking_losses.RankingLossKey.MEAN_SQUARED_LOSS,),
+      (ranking_losses.RankingLossKey.LIST_MLE_LOSS,),
+      (ranking_losses.RankingLossKey.APPROX_NDCG_LOSS,))
+  def test_low_precision_logits(self, loss_key):
+    labels = np.array([[0., 2., 1., -1.], [1., 0., 3., 2.]], dtype=np.float32)
+    # Logits that are exactly representable in half precision.
+    logits = np.array([[1.5, -2.75, -0.5, 1.], [0., 1.75, 10.25, 1.]],
+                      dtype=np.float32)
+    loss_fn = ranking_losses.make_loss_fn(
+        loss_key,
+        lambda_weight=ranking_losses.create_ndcg_lambda_weight(),
+        seed=1)
+    expected = loss_fn(labels, logits, {})
+    actual = []
+    for dtype in [tf.float16, tf.bfloat16]:
+      low_precision_logits = tf.cast(logits, dtype=dtype)
+      loss = loss_fn(tf.cast(labels, dtype=dtype), low_precision_logits, {})
+      self.assertEqual(loss.dtype, tf.float32)
+      grad, = tf.gradients(ys=loss, xs=[low_precision_logits])
+      self.assertEqual(grad.dtype, dtype)
+      actual.append((loss, tf.cast(grad, dtype=tf.float32)))
+    with self.cached_session() as sess:
+      expected, actual = sess.run([expected, actual])
+    for loss, grad in actual:
+      self.assertAllClose(expected, loss)
+      self.assertTrue(np.all(np.isfinite(grad)))
+
+  def test_lambda_weights_with_low_precision_labels(self):
+    sorted_labels = tf.constant([[2.0, 1.0, 0.0]])
+    for lambda_weight in [
+        ranking_losses.create_ndcg_lambda_weight(),
+        ranking_losses.PrecisionLambdaWeight(topn=1),
+        ranking_losses.create_p_list_mle_lambda_weight(3),
+    ]:
+      expected = [
+          lambda_weight.pair_weights(sorted_labels),
+          lambda_weight.individual_weights(sorted_labels)
+      ]
+      labels = tf.cast(sorted_labels, dtype=tf.float16)
+      actual = [
+          lambda_weight.pair_weights(labels),
+          lambda_weight.individual_weights(labels)
+      ]
+      with self.cached_session() as sess:
+        expected, actual = sess.run([expected, actual])
+      self.assertAllClose(expected[0], actual[0])
+      self.assertAllClose(expected[1], actual[1])
+
+
 if __name__ == '__main__':
   tf.test.main()
@@ -52,9 +52,16 @@ class RankingMetricKey(object):
 def make_ranking_metric_fn(metric_key,
                            weights_feature_name=None,
                            topn=None,
-                           name=None):
+                           name=None,
+                           ideal_dcg_feature_name=None,
+                           block_size=None):
   """Factory method to create a ranking metric function.
 
+  Ordered pair accuracy compares all the pairs of items, which takes
+  O(list_size^2) memory per list, while the other metrics take O(list_size).
+  With `block_size`, it takes O(block_size * list_size) memory instead, so that
+  every metric key can be used on lists with thousands of items.
+
   Args:
     metric_key: A key in `RankingMetricKey`.
     weights_feature_name: A `string` specifying the name of the weights feature
@@ -62,6 +69,13 @@ def make_ranking_metric_fn(metric_key,
     topn: An `integer` specifying the cutoff of how many items are considered in
       the metric.
     name: A `string` used as the name for this metric.
+    ideal_dcg_feature_name: A `string` specifying the name of the context
+      feature in `features` dict with the precomputed ideal DCG at `topn` of
+      each list, e.g., from `data.compute_ideal_dcg`. When the feature is
+      present, NDCG uses it instead of sorting the labels.
+    block_size: An optional `integer`. If set, the pairs of ordered pair
+      accuracy are compared over tiles of `block_size` rows, see
+      `ordered_pair_accuracy`.
 
   Returns:
     A metric fn with the following Args:
@@ -77,6 +91,10 @@ def make_ranking_metric_fn(metric_key,
   def _get_weights(features):
     return features[weights_feature_name] if weights_feature_name else None
 
+  def _get_ideal_dcg(features):
+    return (features.get(ideal_dcg_feature_name)
+            if ideal_dcg_feature_name else None)
+
   def _average_relevance_position_fn(labels, predictions, features):
     """Returns average relevance position as the metric."""
     return average_relevance_position(
@@ -94,7 +112,8 @@ def make_ranking_metric_fn(metric_key,
         predictions,
         weights=_get_weights(features),
         topn=topn,
-        name=name)
+        name=name,
+        ideal_dcg=_get_ideal_dcg(features))
 
   def _discounted_cumulative_gain_fn(labels, predictions, features):
     """Returns discounted cumulative gain as the metric."""
@@ -117,7 +136,11 @@ def make_ranking_metric_fn(metric_key,
   def _ordered_pair_accuracy_fn(labels, predictions, features):
     """Returns ordered pair accuracy as the metric."""
     return ordered_pair_accuracy(
-        labels, predictions, weights=_get_weights(features), name=name)
+        labels,
+        predictions,
+        weights=_get_weights(features),
+        name=name,
+        block_size=block_size)
 
   metric_fn_dict = {
       RankingMetricKey.ARP: _average_relevance_position_fn,
@@ -224,6 +247,24 @@ def _prepare_and_validate_params(labels, predictions, weights=None, topn=None):
   return labels, predictions, example_weights, topn
 
 
+def _sort_by_predictions(context, predictions, features_list, topn):
+  """Sorts the features by `predictions`, with the sort of `context` if set.
+
+  Args:
+    context: The `utils.RankingContext` of the labels and predictions passed to
+      the metric, or None.
+    predictions: The predictions from `_prepare_and_validate_params`.
+    features_list: A list of `Tensor`s with the same shape as `predictions`.
+    topn: The cutoff from `_prepare_and_validate_params`.
+
+  Returns:
+    A list of the sorted features.
+  """
+  if context is None:
+    return utils.sort_by_scores(predictions, features_list, topn=topn)
+  return context.sort_by_scores(features_list, topn=topn)
+
+
 def mean_reciprocal_rank(labels, predictions, weights=None, name=None):
   """Computes mean reciprocal rank (MRR).
 
@@ -242,9 +283,10 @@ def mean_reciprocal_rank(labels, predictions, weights=None, name=None):
   with tf.compat.v1.name_scope(name, 'mean_reciprocal_rank',
                                (labels, predictions, weights)):
     _, list_size = tf.unstack(tf.shape(input=predictions))
+    context = utils.RankingContext.get(labels, predictions)
     labels, predictions, weights, topn = _prepare_and_validate_params(
         labels, predictions, weights, list_size)
-    sorted_labels, = utils.sort_by_scores(predictions, [labels], topn=topn)
+    sorted_labels, = _sort_by_predictions(context, predictions, [labels], topn)
     # Relevance = 1.0 when labels >= 1.0 to accommodate graded relevance.
     relevance = tf.cast(tf.greater_equal(sorted_labels, 1.0), dtype=tf.float32)
     reciprocal_rank = 1.0 / tf.cast(tf.range(1, topn + 1), dtype=tf.float32)
@@ -275,10 +317,11 @@ def average_relevance_position(labels, predictions, weights=None, name=None):
   with tf.compat.v1.name_scope(name, 'average_relevance_position',
                                (labels, predictions, weights)):
     _, list_size = tf.unstack(tf.shape(input=predictions))
+    context = utils.RankingContext.get(labels, predictions)
     labels, predictions, weights, topn = _prepare_and_validate_params(
         labels, predictions, weights, list_size)
-    sorted_labels, sorted_weights = utils.sort_by_scores(
-        predictions, [labels, weights], topn=topn)
+    sorted_labels, sorted_weights = _sort_by_predictions(
+        context, predictions, [labels, weights], topn)
     relevance = sorted_labels * sorted_weights
     position = tf.cast(tf.range(1, topn + 1), dtype=tf.float32)
     # TODO: Consider to add a cap poistion topn + 1 when there is no
@@ -305,10 +348,11 @@ def precision(labels, predictions, weights=None, topn=None, name=None):
   """
   with tf.compat.v1.name_scope(name, 'precision',
                                (labels, predictions, weights)):
+    context = utils.RankingContext.get(labels, predictions)
     labels, predictions, weights, topn = _prepare_and_validate_params(
         labels, predictions, weights, topn)
-    sorted_labels, sorted_weights = utils.sort_by_scores(
-        predictions, [labels, weights], topn=topn)
+    sorted_labels, sorted_weights = _sort_by_predictions(
+        context, predictions, [labels, weights], topn)
     # Relevance = 1.0 when labels >= 1.0.
     relevance = tf.cast(tf.greater_equal(sorted_labels, 1.0), dtype=tf.float32)
     per_list_precision = _safe_div(
@@ -329,7 +373,8 @@ def normalized_discounted_cumulative_gain(labels,
                                           predictions,
                                           weights=None,
                                           topn=None,
-                                          name=None):
+                                          name=None,
+                                          ideal_dcg=None):
   """Computes normalized discounted cumulative gain (NDCG).
 
   Args:
@@ -340,23 +385,56 @@ def normalized_discounted_cumulative_gain(labels,
       former case is per-example and the latter case is per-list.
     topn: A cutoff for how many examples to consider for this metric.
     name: A string used as the name for this metric.
+    ideal_dcg: An optional `Tensor` with shape [batch_size] or [batch_size, 1]
+      for the precomputed ideal DCG at `topn` of each list, e.g., from
+      `data.compute_ideal_dcg`. If set, the labels are not sorted for the ideal
+      ranking and `weights` must be per list.
 
   Returns:
     A metric for the weighted normalized discounted cumulative gain of the
     batch.
+
+  Raises:
+    ValueError: If `ideal_dcg` is set with per-example weights.
   """
+  # Whether the weights are known to be the same for all the examples of a
+  # list.
+  is_per_list_weights = True
+  if weights is not None:
+    weights_shape = tf.convert_to_tensor(value=weights).get_shape()
+    if ideal_dcg is not None and weights_shape.ndims == 2 and (
+        tf.compat.dimension_value(weights_shape[1]) != 1):
+      raise ValueError('ideal_dcg requires per-list weights, got shape '
+                       '{}.'.format(weights_shape))
+    is_per_list_weights = weights_shape.ndims == 0 or (
+        weights_shape.ndims == 2 and
+        tf.compat.dimension_value(weights_shape[1]) == 1)
   with tf.compat.v1.name_scope(name, 'normalized_discounted_cumulative_gain',
                                (labels, predictions, weights)):
+    context = utils.RankingContext.get(labels, predictions)
     labels, predictions, weights, topn = _prepare_and_validate_params(
         labels, predictions, weights, topn)
-    sorted_labels, sorted_weights = utils.sort_by_scores(
-        predictions, [labels, weights], topn=topn)
+    sorted_labels, sorted_weights = _sort_by_predictions(
+        context, predictions, [labels, weights], topn)
     dcg = _discounted_cumulative_gain(sorted_labels, sorted_weights)
-    # Sorting over the weighted labels to get ideal ranking.
-    ideal_sorted_labels, ideal_sorted_weights = utils.sort_by_scores(
-        weights * labels, [labels, weights], topn=topn)
-    ideal_dcg = _discounted_cumulative_gain(ideal_sorted_labels,
-                                            ideal_sorted_weights)
+    if ideal_dcg is None and context is not None and is_per_list_weights:
+      # With the same non-negative weight for all the examples of a list,
+      # sorting by the labels gives the same ideal DCG as sorting by the
+      # weighted labels.
+      ideal_sorted_labels, ideal_sorted_weights = context.sort_by_labels(
+          [labels, weights], topn=topn)
+      ideal_dcg = _discounted_cumulative_gain(ideal_sorted_labels,
+                                              ideal_sorted_weights)
+    elif ideal_dcg is None:
+      # Sorting over the weighted labels to get ideal ranking.
+      ideal_sorted_labels, ideal_sorted_weights = utils.sort_by_scores(
+          weights * labels, [labels, weights], topn=topn)
+      ideal_dcg = _discounted_cumulative_gain(ideal_sorted_labels,
+                                              ideal_sorted_weights)
+    else:
+      # The weights are the same for all the examples of a list.
+      ideal_dcg = tf.reshape(
+          tf.cast(ideal_dcg, dtype=tf.float32), [-1, 1]) * weights[:, :1]
     per_list_ndcg = _safe_div(dcg, ideal_dcg)
     per_list_weights = _per_example_weights_to_per_list_weights(
         weights=weights,
@@ -385,10 +463,11 @@ def discounted_cumulative_gain(labels,
   """
   with tf.compat.v1.name_scope(name, 'discounted_cumulative_gain',
                                (labels, predictions, weights)):
+    context = utils.RankingContext.get(labels, predictions)
     labels, predictions, weights, topn = _prepare_and_validate_params(
         labels, predictions, weights, topn)
-    sorted_labels, sorted_weights = utils.sort_by_scores(
-        predictions, [labels, weights], topn=topn)
+    sorted_labels, sorted_weights = _sort_by_predictions(
+        context, predictions, [labels, weights], topn)
     dcg = _discounted_cumulative_gain(sorted_labels,
                                       sorted_weights) * tf.math.log1p(1.0)
     per_list_weights = _per_example_weights_to_per_list_weights(
@@ -398,7 +477,11 @@ def discounted_cumulative_gain(labels,
         _safe_div(dcg, per_list_weights), per_list_weights)
 
 
-def ordered_pair_accuracy(labels, predictions, weights=None, name=None):
+def ordered_pair_accuracy(labels,
+                          predictions,
+                          weights=None,
+                          name=None,
+                          block_size=None):
   """Computes the percentage of correctedly ordered pair.
 
   For any pair of examples, we compare their orders determined by `labels` and
@@ -406,6 +489,12 @@ def ordered_pair_accuracy(labels, predictions, weights=None, name=None):
   That is, labels l_i > l_j and predictions s_i > s_j and the weight for this
   pair is the weight from the l_i.
 
+  All the pairs are compared at once in [batch_size, list_size, list_size]
+  tensors. With `block_size`, the correct pairs and the pair weights of each
+  list are instead summed over tiles of `block_size` rows, so that the peak
+  memory is O(batch_size * block_size * list_size). The metric is the same up
+  to the floating point summation order.
+
   Args:
     labels: A `Tensor` of the same shape as `predictions`.
     predictions: A `Tensor` with shape [batch_size, list_size]. Each value is
@@ -413,15 +502,24 @@ def ordered_pair_accuracy(labels, predictions, weights=None, name=None):
     weights: A `Tensor` of the same shape of predictions or [batch_size, 1]. The
       former case is per-example and the latter case is per-list.
     name: A string used as the name for this metric.
+    block_size: An optional int for the number of rows of pairs per tile.
 
   Returns:
     A metric for the accuracy or ordered pairs.
+
+  Raises:
+    ValueError: If `block_size` is not positive.
   """
+  if block_size is not None and block_size <= 0:
+    raise ValueError('block_size must be positive: {}'.format(block_size))
   with tf.compat.v1.name_scope(name, 'ordered_pair_accuracy',
                                (labels, predictions, weights)):
     clean_labels, predictions, weights, _ = _prepare_and_validate_params(
         labels, predictions, weights)
     label_valid = tf.equal(clean_labels, labels)
+    if block_size is not None:
+      return _blocked_ordered_pair_accuracy(clean_labels, predictions, weights,
+                                            label_valid, block_size)
     valid_pair = tf.logical_and(
         tf.expand_dims(label_valid, 2), tf.expand_dims(label_valid, 1))
     pair_label_diff = tf.expand_dims(clean_labels, 2) - tf.expand_dims(
@@ -438,3 +536,55 @@ def ordered_pair_accuracy(labels, predictions, weights=None, name=None):
             weights, 2) * tf.cast(
                 valid_pair, dtype=tf.float32)
     return tf.compat.v1.metrics.mean(correct_pairs, pair_weights)
+
+
+def _blocked_ordered_pair_accuracy(clean_labels, predictions, weights,
+                                   label_valid, block_size):
+  """Computes ordered pair accuracy over tiles of `block_size` rows of pairs.
+
+  Args:
+    clean_labels: A `Tensor` with shape [batch_size, list_size] of labels with
+      the invalid ones reset to 0.
+    predictions: A `Tensor` with shape [batch_size, list_size].
+    weights: A `Tensor` with shape [batch_size, list_size] or [batch_size, 1].
+    label_valid: A boolean `Tensor` with shape [batch_size, list_size].
+    block_size: An int for the number of rows of pairs per tile.
+
+  Returns:
+    A metric for the accuracy or ordered pairs.
+  """
+  # The weight of a pair (i, j) is the weight of its row i, so the sums of the
+  # rows are weighted once they are reduced.
+  row_weights = weights * tf.ones_like(predictions) * tf.cast(
+      label_valid, dtype=tf.float32)
+  col_valid = tf.expand_dims(tf.cast(label_valid, dtype=tf.float32), 1)
+
+  def _row_pairs(start, end):
+    return col_valid * tf.cast(
+        tf.expand_dims(clean_labels[:, start:end], 2) > tf.expand_dims(
+            clean_labels, 1),
+        dtype=tf.float32)
+
+  def _row_correct_pairs(start, end):
+    return tf.reduce_sum(
+        input_tensor=_row_pairs(start, end) * tf.cast(
+            tf.expand_dims(predictions[:, start:end], 2) > tf.expand_dims(
+                predictions, 1),
+            dtype=tf.float32),
+        axis=2)
+
+  def _row_num_pairs(start, end):
+    return tf.reduce_sum(input_tensor=_row_pairs(start, end), axis=2)
+
+  correct_pairs = tf.reduce_sum(
+      input_tensor=row_weights * utils.sum_over_row_blocks(
+          _row_correct_pairs, predictions, block_size),
+      axis=1)
+  pair_weights = tf.reduce_sum(
+      input_tensor=row_weights * utils.sum_over_row_blocks(
+          _row_num_pairs, predictions, block_size),
+      axis=1)
+  # The mean of the per-list accuracies weighted by their pair weights is the
+  # same as the mean over all the pairs.
+  return tf.compat.v1.metrics.mean(
+      _safe_div(correct_pairs, pair_weights), pair_weights)
@@ -0,0 +1,108 @@
+# Copyright 2019 The TensorFlow Ranking Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmarks for metrics.py.
+
+Run with:
+
+  python -m tensorflow_ranking.python.metrics_benchmark --benchmarks=.
+
+or with `--benchmark_filter=.` on TensorFlow 2.x.
+
+The wall time of the update ops of an eval graph with several metrics is
+reported per list size, together with the number of gathers in the graph. As in
+the ranking head, the metrics share the sorts of a `utils.RankingContext`,
+whose gathers are fused or not.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow_ranking.python import metrics as metrics_lib
+from tensorflow_ranking.python import utils
+
+_BATCH_SIZE = 32
+_LIST_SIZES = [100, 1000]
+_TOPNS = [1, 3, 5, 10]
+_WEIGHTS_FEATURE_NAME = 'weights'
+
+
+class EvalMetricsBenchmark(tf.test.Benchmark):
+  """Benchmarks the metrics of a typical eval graph."""
+
+  def _run(self, name, metric_keys, list_size, fused):
+    random_state = np.random.RandomState(1)
+    shape = [_BATCH_SIZE, list_size]
+    with tf.Graph().as_default():
+      labels = tf.constant(
+          random_state.randint(0, 4, size=shape).astype(np.float32))
+      predictions = tf.Variable(
+          random_state.normal(size=shape).astype(np.float32))
+      features = {
+          _WEIGHTS_FEATURE_NAME:
+              tf.constant(random_state.uniform(size=shape).astype(np.float32))
+      }
+      update_ops = []
+      with utils.RankingContext(labels, predictions, fused=fused):
+        for metric_key in metric_keys:
+          for topn in _TOPNS:
+            metric_fn = metrics_lib.make_ranking_metric_fn(
+                metric_key,
+                weights_feature_name=_WEIGHTS_FEATURE_NAME,
+                topn=topn)
+            _, update_op = metric_fn(labels, predictions, features)
+            update_ops.append(update_op)
+      num_gathers = len([
+          op for op in tf.compat.v1.get_default_graph().get_operations()
+          if op.type == 'GatherV2'
+      ])
+      with tf.compat.v1.Session() as sess:
+        sess.run([
+            tf.compat.v1.global_variables_initializer(),
+            tf.compat.v1.local_variables_initializer()
+        ])
+        self.run_op_benchmark(
+            sess,
+            update_ops,
+            min_iters=20,
+            name='{}_{}_list_size_{}'.format(
+                name, 'fused' if fused else 'unfused', list_size),
+            extras={
+                'list_size': list_size,
+                'num_gathers': num_gathers
+            })
+
+  def benchmark_ndcg(self):
+    for fused in [False, True]:
+      for list_size in _LIST_SIZES:
+        self._run('ndcg', [metrics_lib.RankingMetricKey.NDCG], list_size, fused)
+
+  def benchmark_all_metrics(self):
+    metric_keys = [
+        metrics_lib.RankingMetricKey.NDCG,
+        metrics_lib.RankingMetricKey.DCG,
+        metrics_lib.RankingMetricKey.MRR,
+        metrics_lib.RankingMetricKey.PRECISION,
+    ]
+    for fused in [False, True]:
+      for list_size in _LIST_SIZES:
+        self._run('all_metrics', metric_keys, list_size, fused)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -19,6 +19,8 @@ from __future__ import division
 from __future__ import print_function
 
 import math
+import numpy as np
+
 import tensorflow as tf
 
 from tensorflow_ranking.python import metrics as metrics_lib
@@ -272,6 +274,44 @@ class MetricsTest(tf.test.TestCase):
         (m([[0., 0., 0.]], [scores[0]], weights[0], topn=1), 0.),
     ])
 
+  def test_normalized_discounted_cumulative_gain_with_ideal_dcg(self):
+    scores = [[1., 3., 2.], [1., 2., 3.]]
+    labels = [[0., 0., 1.], [0., 1., 2.]]
+    list_weights = [[1.], [2.]]
+    # The metric discounts by the natural log.
+    ideal_dcg = [
+        _dcg(1., 1) / math.log(2.), (_dcg(2., 1) + _dcg(1., 2)) / math.log(2.)
+    ]
+    ideal_dcg_1 = [_dcg(1., 1) / math.log(2.), _dcg(2., 1) / math.log(2.)]
+    m = metrics_lib.normalized_discounted_cumulative_gain
+    expected_ndcg_1 = (_dcg(0., 1) + _dcg(1., 2) + _dcg(0., 3)) / (
+        _dcg(1., 1) + _dcg(0., 2) + _dcg(0., 3))
+    expected_ndcg_2 = 1.0
+    self._check_metrics([
+        (m(labels, scores, ideal_dcg=ideal_dcg),
+         (expected_ndcg_1 + expected_ndcg_2) / 2.),
+        (m(labels, scores, topn=1, ideal_dcg=ideal_dcg_1),
+         (0. + expected_ndcg_2) / 2.),
+        (m(labels, scores, list_weights, ideal_dcg=ideal_dcg),
+         (expected_ndcg_1 + 2. * expected_ndcg_2) / 3.),
+    ])
+    with self.assertRaises(ValueError):
+      m(labels, scores, [[1., 2., 3.], [4., 5., 6.]], ideal_dcg=ideal_dcg)
+
+  def test_make_normalized_discounted_cumulative_gain_fn_with_ideal_dcg(self):
+    scores = [[1., 3., 2.], [1., 2., 3.]]
+    labels = [[0., 0., 1.], [0., 1., 2.]]
+    m = metrics_lib.make_ranking_metric_fn(
+        metrics_lib.RankingMetricKey.NDCG, ideal_dcg_feature_name='ideal_dcg')
+    # A wrong ideal DCG shows that the feature is used when present.
+    features = {'ideal_dcg': [[_dcg(1., 1) / math.log(2.)], [1e6]]}
+    expected_ndcg_1 = (_dcg(0., 1) + _dcg(1., 2) + _dcg(0., 3)) / (
+        _dcg(1., 1) + _dcg(0., 2) + _dcg(0., 3))
+    self._check_metrics([
+        (m(labels, scores, features), expected_ndcg_1 / 2.),
+        (m(labels, scores, {}), (expected_ndcg_1 + 1.) / 2.),
+    ])
+
   def test_make_normalized_discounted_cumulative_gain_fn(self):
     scores = [[1., 3., 2.], [1., 2., 3.]]
     labels = [[0., 0., 1.], [0., 1., 2.]]
@@ -365,6 +405,23 @@ class MetricsTest(tf.test.TestCase):
          (0. + 2. + 3. + 3.) / (1. + 2. + 3. + 3.)),
     ])
 
+  def test_ordered_pair_accuracy_with_block_size(self):
+    scores = [[1., 3., 2.], [1., 2., 3.]]
+    labels = [[-1., 0., 1.], [0., 1., 2.]]
+    weights = [[1.], [2.]]
+    item_weights = [[1., 1., 1.], [2., 2., 3.]]
+    m = metrics_lib.ordered_pair_accuracy
+    self._check_metrics([
+        (m(labels, scores, block_size=2), (0. + 3.) / (1. + 3.)),
+        (m(labels, scores, weights, block_size=1),
+         (0. + 3. * 2.) / (1. + 3. * 2.)),
+        (m(labels, scores, item_weights, block_size=2),
+         (0. + 2. + 3. + 3.) / (1. + 2. + 3. + 3.)),
+        (m([[-1., -1., -1.]], [[1., 2., 3.]], block_size=2), 0.),
+    ])
+    with self.assertRaises(ValueError):
+      m(labels, scores, block_size=0)
+
   def test_make_ordered_pair_accuracy_fn(self):
     scores = [[1., 3., 2.], [1., 2., 3.]]
     labels = [[0., 0., 1.], [0., 1., 2.]]
@@ -376,6 +433,27 @@ class MetricsTest(tf.test.TestCase):
         (m(labels, scores, {}), (1. + 3.) / (2. + 3.)),
     ])
 
+  def test_make_ordered_pair_accuracy_fn_with_block_size(self):
+    random_state = np.random.RandomState(1)
+    labels = random_state.randint(-1, 3, size=[3, 50]).astype(np.float32)
+    scores = random_state.normal(size=[3, 50]).astype(np.float32)
+    features = {
+        'weights': random_state.uniform(size=[3, 50]).astype(np.float32)
+    }
+    m = metrics_lib.make_ranking_metric_fn(
+        metrics_lib.RankingMetricKey.ORDERED_PAIR_ACCURACY,
+        weights_feature_name='weights')
+    m_blocked = metrics_lib.make_ranking_metric_fn(
+        metrics_lib.RankingMetricKey.ORDERED_PAIR_ACCURACY,
+        weights_feature_name='weights',
+        block_size=16)
+    with self.test_session() as sess:
+      metric, update_op = m(labels, scores, features)
+      blocked_metric, blocked_update_op = m_blocked(labels, scores, features)
+      sess.run(tf.compat.v1.local_variables_initializer())
+      sess.run([update_op, blocked_update_op])
+      self.assertAllClose(sess.run(blocked_metric), sess.run(metric))
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -133,6 +133,8 @@ def make_groupwise_ranking_fn(group_score_fn,
       * Returns: Tensor of shape [batch_size, group_size] containing per-example
         scores.
     group_size: An integer denoting the number of examples in `group_score_fn`.
+      Each list forms list_size groups, so the features of the groups take
+      O(list_size * group_size) memory per list.
     ranking_head: A `head._RankingHead` object.
     transform_fn: Function transforming the raw features into dense tensors. It
       has the following signature:
@@ -175,8 +177,16 @@ def make_groupwise_ranking_fn(group_score_fn,
   def _groupwise_dnn_v2(features, labels, mode, params, config):
     """Defines the dnn for groupwise scoring functions."""
     with tf.compat.v1.name_scope('transform'):
+      # Passthrough features, e.g., document IDs, are not used for scoring.
+      passthrough_feature_names = getattr(ranking_head,
+                                          'passthrough_feature_names', None)
+      scoring_features = {
+          name: value
+          for name, value in six.iteritems(features)
+          if name not in (passthrough_feature_names or [])
+      }
       context_features, per_example_features = _call_transform_fn(
-          features, mode)
+          scoring_features, mode)
 
     def _score_fn(context_features, group_features, reuse):
       with tf.compat.v1.variable_scope('group_score', reuse=reuse):
@@ -19,11 +19,13 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import numpy as np
 import tensorflow as tf
 
 from tensorflow_ranking.python import feature
 from tensorflow_ranking.python import head
 from tensorflow_ranking.python import losses
+from tensorflow_ranking.python import metrics
 from tensorflow_ranking.python import model
 
 # Names of variables created by the model.
@@ -287,6 +289,132 @@ class GroupwiseRankingEstimatorTest(tf.test.TestCase):
     self.assertAllClose([253., 239.5, 229., 244.5], list(next(predictions)))
     self.assertAllClose([253., 239.5, 229., 244.5], list(next(predictions)))
 
+  def test_predict_with_passthrough_features(self):
+    """Passthrough features are returned and not used for scoring."""
+    model_fn = model.make_groupwise_ranking_fn(
+        _group_score_fn,
+        group_size=2,
+        transform_fn=feature.make_identity_transform_fn(['context']),
+        ranking_head=head.create_ranking_head(
+            loss_fn=losses.make_loss_fn(
+                losses.RankingLossKey.PAIRWISE_HINGE_LOSS),
+            optimizer=tf.compat.v1.train.AdagradOptimizer(learning_rate=0.1),
+            passthrough_feature_names=['docid']))
+    estimator = tf.estimator.Estimator(model_fn, self._model_dir)
+    self._initialize_checkpoint()
+
+    features = {
+        'context': [[178.], [155.]],
+        'age': [[[10.], [20.]], [[50.], [30.]]],
+        'docid': np.array([[[1], [2]], [[3], [-1]]], dtype=np.int64),
+    }
+    predictions = estimator.predict(input_fn=lambda: (features, None))
+    prediction = next(predictions)
+    self.assertAllClose([254., 254.], prediction['logits'])
+    self.assertAllEqual([[1], [2]], prediction['docid'])
+    prediction = next(predictions)
+    self.assertAllClose([356., 356.], prediction['logits'])
+    self.assertAllEqual([[3], [-1]], prediction['docid'])
+
+
+class LargeListGroupwiseRankingTest(tf.test.TestCase):
+  """Groupwise ranking model on lists of 10,000 items."""
+
+  def _peak_memory_bytes(self, sess, fetches):
+    """Runs `fetches` and returns the peak allocator memory of the run."""
+    run_metadata = tf.compat.v1.RunMetadata()
+    sess.run(
+        fetches,
+        options=tf.compat.v1.RunOptions(
+            trace_level=tf.compat.v1.RunOptions.FULL_TRACE),
+        run_metadata=run_metadata)
+    return max([
+        memory.allocator_bytes_in_use
+        for device_stats in run_metadata.step_stats.dev_stats
+        for node_stats in device_stats.node_stats
+        for memory in node_stats.memory
+    ] or [0])
+
+  def test_train_and_eval_with_all_losses_and_metrics(self):
+    batch_size, list_size, block_size = 2, 10000, 256
+    random_state = np.random.RandomState(1)
+    labels = random_state.randint(0, 3, size=[batch_size, list_size])
+    labels = labels.astype(np.float32)
+    labels[:, -100:] = -1.
+    features = {
+        'context': np.array([[1.], [2.]], dtype=np.float32),
+        'age':
+            random_state.normal(size=[batch_size, list_size, 1]).astype(
+                np.float32),
+    }
+    loss_keys = [
+        losses.RankingLossKey.PAIRWISE_HINGE_LOSS,
+        losses.RankingLossKey.PAIRWISE_LOGISTIC_LOSS,
+        losses.RankingLossKey.PAIRWISE_SOFT_ZERO_ONE_LOSS,
+        losses.RankingLossKey.SOFTMAX_LOSS,
+        losses.RankingLossKey.SAMPLED_SOFTMAX_LOSS,
+        losses.RankingLossKey.SIGMOID_CROSS_ENTROPY_LOSS,
+        losses.RankingLossKey.MEAN_SQUARED_LOSS,
+        losses.RankingLossKey.LIST_MLE_LOSS,
+        losses.RankingLossKey.APPROX_NDCG_LOSS,
+    ]
+    metric_keys = [
+        metrics.RankingMetricKey.ARP,
+        metrics.RankingMetricKey.MRR,
+        metrics.RankingMetricKey.NDCG,
+        metrics.RankingMetricKey.DCG,
+        metrics.RankingMetricKey.PRECISION,
+        metrics.RankingMetricKey.ORDERED_PAIR_ACCURACY,
+    ]
+    model_fn = model.make_groupwise_ranking_fn(
+        _group_score_fn,
+        group_size=2,
+        transform_fn=feature.make_identity_transform_fn(['context']),
+        ranking_head=head.create_ranking_head(
+            loss_fn=losses.make_loss_fn(
+                loss_keys,
+                lambda_weight=losses.create_ndcg_lambda_weight(),
+                seed=1,
+                extra_args={'block_size': block_size}),
+            eval_metric_fns={
+                metric_key: metrics.make_ranking_metric_fn(
+                    metric_key, topn=10, block_size=block_size)
+                for metric_key in metric_keys
+            },
+            optimizer=tf.compat.v1.train.AdagradOptimizer(learning_rate=0.1)))
+    # A single dense [batch_size, list_size, list_size] tensor of pairs.
+    pair_matrix_bytes = batch_size * list_size * list_size * 4
+
+    for mode in [tf.estimator.ModeKeys.TRAIN, tf.estimator.ModeKeys.EVAL]:
+      with tf.Graph().as_default():
+        tf.compat.v1.train.create_global_step()
+        spec = model_fn(
+            {name: tf.constant(value) for name, value in features.items()},
+            tf.constant(labels), mode, None, None)
+        with tf.compat.v1.Session() as sess:
+          sess.run([
+              tf.compat.v1.global_variables_initializer(),
+              tf.compat.v1.local_variables_initializer()
+          ])
+          if mode == tf.estimator.ModeKeys.TRAIN:
+            fetches = [spec.loss, spec.train_op]
+          else:
+            fetches = [spec.loss] + [
+                update_op for _, update_op in spec.eval_metric_ops.values()
+            ]
+          self.assertLess(
+              self._peak_memory_bytes(sess, fetches), pair_matrix_bytes)
+          self.assertTrue(np.isfinite(sess.run(spec.loss)))
+          if mode == tf.estimator.ModeKeys.EVAL:
+            metric_values = sess.run({
+                name: value for name, (value, _) in spec.eval_metric_ops.items()
+            })
+            for metric_key in metric_keys:
+              self.assertTrue(np.isfinite(metric_values[metric_key]))
+            self.assertBetween(
+                metric_values[metrics.RankingMetricKey.ORDERED_PAIR_ACCURACY],
+                0., 1.)
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -18,6 +18,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import threading
+
 import tensorflow as tf
 
 
@@ -27,7 +29,7 @@ def is_label_valid(labels):
   return tf.greater_equal(labels, 0.)
 
 
-def sort_by_scores(scores, features_list, topn=None):
+def sort_by_scores(scores, features_list, topn=None, fused=False):
   """Sorts example features according to per-example scores.
 
   Args:
@@ -36,29 +38,201 @@ def sort_by_scores(scores, features_list, topn=None):
     features_list: A list of `Tensor`s with the same shape as scores to be
       sorted.
     topn: An integer as the cutoff of examples in the sorted list.
+    fused: If True, the features of the same dtype are stacked and sorted by a
+      single gather, instead of a gather per feature. This saves ops, e.g.,
+      where the per-op overhead dominates, but copies the features to stack
+      and unstack them.
 
   Returns:
     A list of `Tensor`s as the list of sorted features by `scores`.
   """
   scores = tf.convert_to_tensor(value=scores)
   scores.get_shape().assert_has_rank(2)
-  batch_size, list_size = tf.unstack(tf.shape(input=scores))
+  list_size = tf.shape(input=scores)[1]
   if topn is None:
     topn = list_size
   topn = tf.minimum(topn, list_size)
   _, indices = tf.nn.top_k(scores, topn, sorted=True)
+  return _gather_sorted(indices, features_list, fused=fused)
+
+
+def _gather_sorted(indices, features_list, fused=False):
+  """Gathers the features in the order of the sort `indices`.
+
+  Args:
+    indices: An int `Tensor` with shape [batch_size, topn] of the indices of
+      the items in sorted order, e.g., from `tf.nn.top_k`.
+    features_list: A list of `Tensor`s with shape [batch_size, list_size].
+    fused: See `sort_by_scores`.
+
+  Returns:
+    A list of `Tensor`s with shape [batch_size, topn] of the sorted features.
+  """
+  features_list = [
+      tf.convert_to_tensor(value=feature) for feature in features_list
+  ]
+  batch_size, topn = tf.unstack(tf.shape(input=indices))
+  list_size = tf.shape(input=features_list[0])[1]
   list_offsets = tf.expand_dims(tf.range(batch_size) * list_size, 1)
   # The shape of `indices` is [batch_size, topn] and the shape of
   # `list_offsets` is [batch_size, 1]. Broadcasting is used here.
   gather_indices = tf.reshape(indices + list_offsets, [-1])
   output_shape = tf.stack([batch_size, topn])
-  # Each feature is first flattened to a 1-D vector and then gathered by the
-  # indices from sorted scores and then re-shaped.
-  return [
-      tf.reshape(
-          tf.gather(tf.reshape(feature, [-1]), gather_indices), output_shape)
-      for feature in features_list
-  ]
+
+  # The groups of indices in `features_list` that are gathered together.
+  groups = [[i] for i in range(len(features_list))]
+  if fused:
+    groups_by_dtype = {}
+    for i, feature in enumerate(features_list):
+      groups_by_dtype.setdefault(feature.dtype, []).append(i)
+    groups = sorted(groups_by_dtype.values())
+  sorted_features = [None] * len(features_list)
+  for group in groups:
+    if len(group) == 1:
+      # Each feature is first flattened to a 1-D vector and then gathered by
+      # the indices from sorted scores and then re-shaped.
+      sorted_features[group[0]] = tf.reshape(
+          tf.gather(tf.reshape(features_list[group[0]], [-1]), gather_indices),
+          output_shape)
+    else:
+      # The features are stacked to [batch_size * list_size, len(group)] so
+      # that a single gather takes the rows of all of them.
+      stacked = tf.reshape(
+          tf.stack([features_list[i] for i in group], axis=2),
+          [-1, len(group)])
+      sorted_stacked = tf.reshape(
+          tf.gather(stacked, gather_indices),
+          tf.concat([output_shape, [len(group)]], axis=0))
+      for i, sorted_feature in zip(
+          group, tf.unstack(sorted_stacked, num=len(group), axis=2)):
+        sorted_features[i] = sorted_feature
+  return sorted_features
+
+
+class RankingContext(object):
+  """The sorts of a batch of lists shared by the losses and the metrics.
+
+  The ranking losses and metrics each sort the lists by the scores, and NDCG
+  also sorts them by the labels. A context is built once for a batch, e.g., in
+  the ranking head, and the losses and metrics called within it on the same
+  `labels` and `scores` `Tensor`s gather with its permutations instead of
+  sorting again:
+
+    with RankingContext(labels, logits):
+      loss = loss_fn(labels, logits, features)
+      eval_metric_ops = {name: metric_fn(labels, logits, features) ...}
+
+  Each permutation is created on first use, over the full lists, and cut to
+  the `topn` of each caller.
+  """
+
+  _local = threading.local()
+
+  def __init__(self, labels, scores, fused=False):
+    """Constructor.
+
+    Args:
+      labels: A `Tensor` with shape [batch_size, list_size] of graded relevance,
+        where the items with labels < 0 are invalid.
+      scores: A `Tensor` with shape [batch_size, list_size] of the ranking
+        scores of the items.
+      fused: If True, `sort_by_scores` and `sort_by_labels` gather the features
+        that share a dtype with a single gather, see `sort_by_scores`.
+    """
+    self._labels = labels
+    self._scores = scores
+    self._fused = fused
+    self._cache = {}
+
+  def __enter__(self):
+    self._contexts().append(self)
+    return self
+
+  def __exit__(self, *args):
+    self._contexts().pop()
+
+  @classmethod
+  def _contexts(cls):
+    """Returns the stack of the entered contexts of this thread."""
+    if not hasattr(cls._local, 'contexts'):
+      cls._local.contexts = []
+    return cls._local.contexts
+
+  @classmethod
+  def get(cls, labels, scores):
+    """Returns the innermost entered context for `labels` and `scores`.
+
+    Args:
+      labels: The labels passed to a loss or a metric.
+      scores: The scores passed to a loss or a metric.
+
+    Returns:
+      The `RankingContext` built on the very same `labels` and `scores`
+      `Tensor`s, or None.
+    """
+    for context in reversed(cls._contexts()):
+      if context._labels is labels and context._scores is scores:  # pylint: disable=protected-access
+        return context
+    return None
+
+  def _get(self, key, fn):
+    """Returns the cached `fn()` for `key`."""
+    if key not in self._cache:
+      with tf.compat.v1.name_scope('ranking_context'):
+        self._cache[key] = fn()
+    return self._cache[key]
+
+  def is_label_valid(self):
+    """Returns the boolean mask of the valid labels."""
+    return self._get('is_label_valid', lambda: is_label_valid(self._labels))
+
+  def sort_indices(self):
+    """Returns the indices of the items sorted by the scores.
+
+    Returns:
+      An int `Tensor` with shape [batch_size, list_size]. The items with
+      invalid labels are placed last.
+    """
+
+    def _sort_indices():
+      scores = tf.convert_to_tensor(value=self._scores)
+      # Only sort entries with valid labels that are >= 0.
+      scores = tf.where(
+          self.is_label_valid(), scores, -1e-6 * tf.ones_like(scores) +
+          tf.reduce_min(input_tensor=scores, axis=1, keepdims=True))
+      return tf.nn.top_k(scores, tf.shape(input=scores)[1], sorted=True)[1]
+
+    return self._get('sort_indices', _sort_indices)
+
+  def ideal_sort_indices(self):
+    """Returns the indices of the items sorted by the labels.
+
+    Returns:
+      An int `Tensor` with shape [batch_size, list_size]. The items with
+      invalid labels are placed last.
+    """
+    return self._get(
+        'ideal_sort_indices', lambda: tf.nn.top_k(
+            self._labels, tf.shape(input=self._labels)[1], sorted=True)[1])
+
+  def sort_by_scores(self, features_list, topn=None):
+    """Like `sort_by_scores` by the scores of the context, without sorting."""
+    return _gather_sorted(
+        _top_indices(self.sort_indices(), topn), features_list,
+        fused=self._fused)
+
+  def sort_by_labels(self, features_list, topn=None):
+    """Like `sort_by_scores` by the labels of the context, without sorting."""
+    return _gather_sorted(
+        _top_indices(self.ideal_sort_indices(), topn), features_list,
+        fused=self._fused)
+
+
+def _top_indices(indices, topn=None):
+  """Returns the first `topn` of the sort `indices`."""
+  if topn is None:
+    return indices
+  return indices[:, :tf.minimum(topn, tf.shape(input=indices)[1])]
 
 
 def shuffle_valid_indices(is_valid, seed=None):
@@ -88,15 +262,29 @@ def organize_valid_indices(is_valid, shuffle=True, seed=None):
   output_shape = tf.shape(input=is_valid)
 
   if shuffle:
+    # A random permutation per list needs a sort anyway, so a single top_k
+    # both shuffles the valid items and moves them to the front.
     values = tf.random.uniform(output_shape, seed=seed)
+    rand = tf.where(is_valid, values, tf.ones(output_shape) * -1e-6)
+    # shape(indices) = [batch_size, list_size]
+    _, indices = tf.nn.top_k(rand, output_shape[1], sorted=True)
   else:
-    values = (
-        tf.ones_like(is_valid, tf.float32) *
-        tf.reverse(tf.cast(tf.range(output_shape[1]), dtype=tf.float32), [-1]))
-
-  rand = tf.where(is_valid, values, tf.ones(output_shape) * -1e-6)
-  # shape(indices) = [batch_size, list_size]
-  _, indices = tf.nn.top_k(rand, output_shape[1], sorted=True)
+    # A stable partition in linear time: the valid items are counted before
+    # each valid item and the invalid ones before each invalid item, which
+    # gives the position of each item once organized.
+    valid = tf.cast(is_valid, dtype=tf.int32)
+    num_valid = tf.reduce_sum(input_tensor=valid, axis=1, keepdims=True)
+    positions = tf.where(
+        is_valid, tf.cumsum(valid, axis=1, exclusive=True),
+        num_valid + tf.cumsum(1 - valid, axis=1, exclusive=True))
+    # The positions offset by list are a permutation of the flattened batch,
+    # whose inverse gives the organized indices.
+    list_offsets = tf.expand_dims(tf.range(output_shape[0]) * output_shape[1],
+                                  1)
+    # shape(indices) = [batch_size, list_size]
+    indices = tf.reshape(
+        tf.math.invert_permutation(tf.reshape(positions + list_offsets, [-1])),
+        output_shape) - list_offsets
   # shape(batch_ids) = [batch_size, list_size]
   batch_ids = tf.ones_like(indices) * tf.expand_dims(
       tf.range(output_shape[0]), 1)
@@ -126,7 +314,41 @@ def reshape_first_ndims(tensor, first_ndims, new_shape):
   return tf.reshape(tensor, new_shape)
 
 
-def approx_ranks(logits, alpha=10.):
+def sum_over_row_blocks(row_fn, logits, block_size):
+  """Evaluates `row_fn` on tiles of `block_size` rows of a list.
+
+  Args:
+    row_fn: A function that maps (start, end) to a `Tensor` with shape
+      [batch_size, end - start] for the items [start, end) of each list.
+    logits: A `Tensor` with shape [batch_size, list_size].
+    block_size: An int for the number of items per tile.
+
+  Returns:
+    A `Tensor` with the same shape as `logits` that concatenates the outputs of
+    `row_fn` over the tiles.
+  """
+  list_size = tf.shape(input=logits)[1]
+
+  def _cond(start, unused_outputs):
+    return tf.less(start, list_size)
+
+  def _body(start, outputs):
+    end = tf.minimum(start + block_size, list_size)
+    outputs += tf.pad(
+        tensor=row_fn(start, end), paddings=[[0, 0], [start, list_size - end]])
+    return end, outputs
+
+  # The tiles are evaluated one at a time, otherwise the loop keeps several of
+  # them alive in parallel iterations.
+  _, outputs = tf.compat.v1.while_loop(
+      _cond,
+      _body, [tf.constant(0), tf.zeros_like(logits)],
+      back_prop=False,
+      parallel_iterations=1)
+  return outputs
+
+
+def approx_ranks(logits, alpha=10., block_size=None):
   r"""Computes approximate ranks given a list of logits.
 
   Given a list of logits, the rank of an item in the list is simply
@@ -144,25 +366,61 @@ def approx_ranks(logits, alpha=10.):
   of "A general approximation framework for direct optimization of
   information retrieval measures" by Qin et al.
 
+  The pairs are formed by broadcasting, so there is a single [batch_size,
+  list_size, list_size] tensor of pairs at a time. With `block_size`, the ranks
+  and their gradients are instead computed over tiles of `block_size` items,
+  so that the peak memory is O(batch_size * block_size * list_size).
+
   Args:
     logits: A `Tensor` with shape [batch_size, list_size]. Each value is the
       ranking score of the corresponding item.
     alpha: Exponent of the generalized sigmoid function.
+    block_size: An optional int for the number of items per tile.
 
   Returns:
     A `Tensor` of ranks with the same shape as logits.
+
+  Raises:
+    ValueError: If `block_size` is not positive.
   """
-  list_size = tf.shape(input=logits)[1]
-  x = tf.tile(tf.expand_dims(logits, 2), [1, 1, list_size])
-  y = tf.tile(tf.expand_dims(logits, 1), [1, list_size, 1])
-  pairs = tf.sigmoid(alpha * (y - x))
-  return tf.reduce_sum(input_tensor=pairs, axis=-1) + .5
+  if block_size is None:
+    pairs = tf.sigmoid(alpha *
+                       (tf.expand_dims(logits, 1) - tf.expand_dims(logits, 2)))
+    return tf.reduce_sum(input_tensor=pairs, axis=-1) + .5
+  if block_size <= 0:
+    raise ValueError('block_size must be positive: {}'.format(block_size))
+
+  @tf.custom_gradient
+  def _approx_ranks(logits):
+    """Returns the ranks and their gradient function."""
+
+    def _ranks(start, end):
+      pairs = tf.sigmoid(alpha * (tf.expand_dims(logits, 1) -
+                                  tf.expand_dims(logits[:, start:end], 2)))
+      return tf.reduce_sum(input_tensor=pairs, axis=-1)
+
+    def _grad(dy):
+      """Returns alpha * sum_j sigmoid'(alpha * (s_j - s_k)) * (dy_j - dy_k)."""
+
+      def _logit_grads(start, end):
+        z = alpha * (
+            tf.expand_dims(logits, 1) - tf.expand_dims(logits[:, start:end], 2))
+        dy_diff = tf.expand_dims(dy, 1) - tf.expand_dims(dy[:, start:end], 2)
+        return alpha * tf.reduce_sum(
+            input_tensor=tf.sigmoid(z) * tf.sigmoid(-z) * dy_diff, axis=-1)
+
+      return sum_over_row_blocks(_logit_grads, logits, block_size)
+
+    return sum_over_row_blocks(_ranks, logits, block_size) + .5, _grad
+
+  return _approx_ranks(tf.convert_to_tensor(value=logits))
 
 
 def inverse_max_dcg(labels,
                     gain_fn=lambda labels: tf.pow(2.0, labels) - 1.,
                     rank_discount_fn=lambda rank: 1. / tf.math.log1p(rank),
-                    topn=None):
+                    topn=None,
+                    ideal_dcg=None):
   """Computes the inverse of max DCG.
 
   Args:
@@ -172,15 +430,24 @@ def inverse_max_dcg(labels,
     rank_discount_fn: A discount function. By default this is set to:
       1/log(1+rank).
     topn: An integer as the cutoff of examples in the sorted list.
+    ideal_dcg: An optional `Tensor` with shape [batch_size] or [batch_size, 1]
+      for the precomputed max DCG of each list, e.g., from
+      `data.compute_ideal_dcg`. If set, the labels are not sorted and it must
+      have been computed with the same `gain_fn`, `rank_discount_fn` and
+      `topn`.
   Returns:
     A `Tensor` with shape [batch_size, 1].
   """
-  ideal_sorted_labels, = sort_by_scores(labels, [labels], topn=topn)
-  rank = tf.range(tf.shape(input=ideal_sorted_labels)[1]) + 1
-  discounted_gain = gain_fn(ideal_sorted_labels) * rank_discount_fn(
-      tf.cast(rank, dtype=tf.float32))
-  discounted_gain = tf.reduce_sum(
-      input_tensor=discounted_gain, axis=1, keepdims=True)
+  if ideal_dcg is not None:
+    discounted_gain = tf.reshape(
+        tf.cast(ideal_dcg, dtype=tf.float32), [-1, 1])
+  else:
+    ideal_sorted_labels, = sort_by_scores(labels, [labels], topn=topn)
+    rank = tf.range(tf.shape(input=ideal_sorted_labels)[1]) + 1
+    discounted_gain = gain_fn(ideal_sorted_labels) * rank_discount_fn(
+        tf.cast(rank, dtype=tf.float32))
+    discounted_gain = tf.reduce_sum(
+        input_tensor=discounted_gain, axis=1, keepdims=True)
   return tf.where(
       tf.greater(discounted_gain, 0.), 1. / discounted_gain,
       tf.zeros_like(discounted_gain))
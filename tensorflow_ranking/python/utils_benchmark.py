@@ -0,0 +1,153 @@
+# Copyright 2019 The TensorFlow Ranking Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmarks for utils.py.
+
+Run with:
+
+  python -m tensorflow_ranking.python.utils_benchmark --benchmarks=.
+
+or with `--benchmark_filter=.` on TensorFlow 2.x.
+
+The wall time and, where the runtime reports it, the peak allocator memory of
+the forward and backward pass are reported per list size.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow_ranking.python import utils
+
+_BATCH_SIZE = 32
+_LIST_SIZES = [100, 500, 1000]
+_BLOCK_SIZE = 64
+
+
+def _tiled_approx_ranks(logits, alpha=10.):
+  """The `approx_ranks` that tiles the logits into two pair tensors."""
+  list_size = tf.shape(input=logits)[1]
+  x = tf.tile(tf.expand_dims(logits, 2), [1, 1, list_size])
+  y = tf.tile(tf.expand_dims(logits, 1), [1, list_size, 1])
+  pairs = tf.sigmoid(alpha * (y - x))
+  return tf.reduce_sum(input_tensor=pairs, axis=-1) + .5
+
+
+class ApproxRanksBenchmark(tf.test.Benchmark):
+  """Benchmarks the implementations of `approx_ranks`."""
+
+  def _run(self, name, approx_ranks_fn, list_size):
+    random_state = np.random.RandomState(1)
+    with tf.Graph().as_default():
+      logits = tf.Variable(
+          random_state.normal(size=[_BATCH_SIZE, list_size]).astype(np.float32))
+      ranks = approx_ranks_fn(logits)
+      # The sum of the ranks is a constant, so the ranks are weighted to get a
+      # nonzero gradient.
+      grad, = tf.gradients(
+          ys=ranks,
+          xs=[logits],
+          grad_ys=[random_state.uniform(size=[_BATCH_SIZE, list_size])
+                   .astype(np.float32)])
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        self.run_op_benchmark(
+            sess,
+            [ranks, grad],
+            min_iters=10,
+            name='{}_list_size_{}'.format(name, list_size),
+            extras={'list_size': list_size})
+
+  def benchmark_tiled(self):
+    for list_size in _LIST_SIZES:
+      self._run('tiled', _tiled_approx_ranks, list_size)
+
+  def benchmark_broadcast(self):
+    for list_size in _LIST_SIZES:
+      self._run('broadcast', utils.approx_ranks, list_size)
+
+  def benchmark_blocked(self):
+    for list_size in _LIST_SIZES:
+      self._run(
+          'blocked',
+          lambda logits: utils.approx_ranks(logits, block_size=_BLOCK_SIZE),
+          list_size)
+
+
+class SortByScoresBenchmark(tf.test.Benchmark):
+  """Benchmarks `sort_by_scores` of labels, logits and weights."""
+
+  def _run(self, fused, list_size):
+    random_state = np.random.RandomState(1)
+    shape = [_BATCH_SIZE, list_size]
+    with tf.Graph().as_default():
+      scores = tf.Variable(random_state.normal(size=shape).astype(np.float32))
+      features_list = [
+          tf.Variable(random_state.uniform(size=shape).astype(np.float32))
+          for _ in range(3)
+      ]
+      sorted_features = utils.sort_by_scores(
+          scores, features_list, fused=fused)
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        self.run_op_benchmark(
+            sess,
+            sorted_features,
+            min_iters=50,
+            name='{}_list_size_{}'.format('fused' if fused else 'unfused',
+                                          list_size),
+            extras={'list_size': list_size})
+
+  def benchmark_unfused(self):
+    for list_size in _LIST_SIZES:
+      self._run(False, list_size)
+
+  def benchmark_fused(self):
+    for list_size in _LIST_SIZES:
+      self._run(True, list_size)
+
+
+class OrganizeValidIndicesBenchmark(tf.test.Benchmark):
+  """Benchmarks `organize_valid_indices` on lists with padding."""
+
+  def _run(self, shuffle, list_size):
+    random_state = np.random.RandomState(1)
+    with tf.Graph().as_default():
+      is_valid = tf.Variable(
+          random_state.uniform(size=[_BATCH_SIZE, list_size]) > 0.1)
+      indices = utils.organize_valid_indices(is_valid, shuffle=shuffle, seed=1)
+      with tf.compat.v1.Session() as sess:
+        sess.run(tf.compat.v1.global_variables_initializer())
+        self.run_op_benchmark(
+            sess,
+            indices,
+            min_iters=50,
+            name='{}_list_size_{}'.format(
+                'shuffle' if shuffle else 'no_shuffle', list_size),
+            extras={'list_size': list_size})
+
+  def benchmark_shuffle(self):
+    for list_size in _LIST_SIZES:
+      self._run(True, list_size)
+
+  def benchmark_no_shuffle(self):
+    for list_size in _LIST_SIZES:
+      self._run(False, list_size)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -18,6 +18,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import numpy as np
 import tensorflow as tf
 
 from tensorflow_ranking.python import utils
@@ -57,6 +58,57 @@ class UtilsTest(tf.test.TestCase):
       self.assertAllEqual(sorted_positions, [[2, 3, 1]])
       self.assertAllEqual(sorted_names, [[b'b', b'c', b'a']])
 
+  def test_sort_by_scores_fused(self):
+    scores = [[1., 3., 2.], [1., 2., 3.]]
+    features_list = [
+        [[1., 2., 3.], [4., 5., 6.]],
+        [[1, 2, 3], [4, 5, 6]],
+        [[.1, .2, .3], [.4, .5, .6]],
+        [['a', 'b', 'c'], ['d', 'e', 'f']],
+    ]
+    with tf.compat.v1.Session() as sess:
+      for topn in [None, 2]:
+        fused, unfused = sess.run([
+            utils.sort_by_scores(
+                scores, features_list, topn=topn, fused=True),
+            utils.sort_by_scores(scores, features_list, topn=topn)
+        ])
+        self.assertLen(fused, 4)
+        for fused_feature, unfused_feature in zip(fused, unfused):
+          self.assertAllEqual(fused_feature, unfused_feature)
+        self.assertAllClose(fused[2][:, :2], [[.2, .3], [.6, .5]])
+
+  def test_ranking_context(self):
+    labels = tf.constant([[0., 2., -1., 1.], [1., 0., 3., 2.]])
+    scores = tf.constant([[1., 3., 4., 2.], [1., 2., 4., 3.]])
+    weights = tf.constant([[1., 2., 3., 4.], [5., 6., 7., 8.]])
+    context = utils.RankingContext(labels, scores)
+    fused_context = utils.RankingContext(labels, scores, fused=True)
+    self.assertIsNone(utils.RankingContext.get(labels, scores))
+    with context:
+      self.assertIs(utils.RankingContext.get(labels, scores), context)
+      self.assertIsNone(utils.RankingContext.get(scores, labels))
+    self.assertIsNone(utils.RankingContext.get(labels, scores))
+
+    # Items with invalid labels are placed last.
+    valid_scores = tf.where(utils.is_label_valid(labels), scores,
+                            tf.zeros_like(scores))
+    with tf.compat.v1.Session() as sess:
+      for topn in [None, 2, 10]:
+        expected, actual = sess.run([
+            utils.sort_by_scores(valid_scores, [labels, weights], topn=topn) +
+            utils.sort_by_scores(labels, [labels, weights], topn=topn),
+            context.sort_by_scores([labels, weights], topn=topn) +
+            context.sort_by_labels([labels, weights], topn=topn)
+        ])
+        for expected_feature, feature in zip(expected, actual):
+          self.assertAllEqual(expected_feature, feature)
+        actual = sess.run(
+            fused_context.sort_by_scores([labels, weights], topn=topn) +
+            fused_context.sort_by_labels([labels, weights], topn=topn))
+        for expected_feature, feature in zip(expected, actual):
+          self.assertAllEqual(expected_feature, feature)
+
   def test_organize_valid_indices(self):
     tf.compat.v1.set_random_seed(1)
     labels = [[1.0, 0.0, -1.0], [-1.0, 1.0, 2.0]]
@@ -71,6 +123,21 @@ class UtilsTest(tf.test.TestCase):
       self.assertAllEqual(organized_indices,
                           [[[0, 0], [0, 1], [0, 2]], [[1, 1], [1, 2], [1, 0]]])
 
+  def test_organize_valid_indices_without_shuffle(self):
+    is_valid = np.random.RandomState(1).uniform(size=[4, 9]) > 0.4
+    organized_indices = utils.organize_valid_indices(is_valid, shuffle=False)
+    with tf.compat.v1.Session() as sess:
+      organized_indices = sess.run(organized_indices)
+    for i, is_valid_of_list in enumerate(is_valid):
+      # Valid items first, then invalid ones, each in their original order.
+      self.assertAllEqual(organized_indices[i, :, 0], [i] * 9)
+      self.assertAllEqual(
+          organized_indices[i, :, 1],
+          np.concatenate([
+              np.where(is_valid_of_list)[0],
+              np.where(np.logical_not(is_valid_of_list))[0]
+          ]))
+
   def test_reshape_first_ndims_dense_tensor(self):
     # Batch size = 2, list size = 5, embedding size = 10.
     tensor = tf.reshape(tf.range(100), shape=(2, 5, 10))
@@ -113,6 +180,28 @@ class UtilsTest(tf.test.TestCase):
       approx_ranks = sess.run(approx_ranks)
       self.assertAllClose(approx_ranks, target_ranks)
 
+  def test_blocked_approx_ranks(self):
+    logits = tf.constant(
+        np.random.RandomState(1).normal(size=[3, 7]).astype(np.float32))
+    dy = np.random.RandomState(2).normal(size=[3, 7]).astype(np.float32)
+    ranks = utils.approx_ranks(logits, alpha=2.)
+    grad, = tf.gradients(ys=ranks, xs=[logits], grad_ys=[dy])
+    blocked = []
+    for block_size in [1, 3, 10]:
+      blocked_ranks = utils.approx_ranks(
+          logits, alpha=2., block_size=block_size)
+      blocked.append(
+          (blocked_ranks,
+           tf.gradients(ys=blocked_ranks, xs=[logits], grad_ys=[dy])[0]))
+    with tf.compat.v1.Session() as sess:
+      ranks, grad, blocked = sess.run([ranks, grad, blocked])
+    for blocked_ranks, blocked_grad in blocked:
+      self.assertAllClose(blocked_ranks, ranks)
+      self.assertAllClose(blocked_grad, grad)
+
+    with self.assertRaises(ValueError):
+      utils.approx_ranks(logits, block_size=0)
+
   def test_inverse_max_dcg(self):
     labels = [[1., 4., 1., 0.], [4., 2., 0., 3.], [0., 0., 0., 0.]]
     target = [[0.04297], [0.033139], [0.]]
@@ -126,6 +215,14 @@ class UtilsTest(tf.test.TestCase):
       inverse_max_dcg_1 = sess.run(inverse_max_dcg_1)
       self.assertAllClose(inverse_max_dcg_1, target_1)
 
+  def test_inverse_max_dcg_with_ideal_dcg(self):
+    labels = [[1., 4., 1., 0.], [4., 2., 0., 3.], [0., 0., 0., 0.]]
+    ideal_dcg = [1. / 0.04297, 1. / 0.033139, 0.]
+    with tf.compat.v1.Session() as sess:
+      self.assertAllClose(
+          sess.run(utils.inverse_max_dcg(labels, ideal_dcg=ideal_dcg)),
+          [[0.04297], [0.033139], [0.]])
+
 
 if __name__ == '__main__':
   tf.test.main()